@@ -0,0 +1,81 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import torch
+import argparse
+import json
+import numpy as np
+import tempfile
+import time
+from utils.ann_index import IVFIndex, brute_force_search, codebook_vectors
+from utils.get_model_arch import get_model_arch
+
+
+def recall(ids: torch.Tensor, true_ids: torch.Tensor):
+    """Fraction of the true top-k found in the approximate top-k"""
+    hits = (ids[:, :, None] == true_ids[:, None, :]).any(dim=1)
+    return hits.float().mean().item()
+
+
+def timed(fn):
+    start = time.perf_counter()
+    out = fn()
+    return out, time.perf_counter() - start
+
+
+def main(args: dict):
+    torch.manual_seed(0)
+    torch.set_num_threads(args["num_threads"])
+
+    if args["embeddings_path"]:
+        # e.g. the --out_path of trainers/train_glove.py
+        vectors = torch.from_numpy(np.load(args["embeddings_path"]))
+    elif args["config_file"]:
+        config = json.load(open(args["config_file"]))
+        # A random codebook (and FSQ projection) says nothing about the learned one
+        assert (
+            "model_checkpoint_path" in config and config["model_checkpoint_path"]
+        ), "config_file needs the model_checkpoint_path of a trained tokenizer"
+        model = get_model_arch(config["model_arch"])(**config)
+        model.load_state_dict(torch.load(f=config["model_checkpoint_path"], map_location="cpu"))
+        vectors = codebook_vectors(model.quantizer)
+    else:
+        # Clustered synthetic vectors, uniform ones have no neighbourhood structure to exploit
+        centers = torch.randn(args["num_vectors"] // 100, args["dim"])
+        vectors = centers.repeat_interleave(100, dim=0) + 0.3 * torch.randn(args["num_vectors"], args["dim"])
+
+    queries = vectors[torch.randint(len(vectors), size=[args["num_queries"]])]
+    queries = queries + 0.1 * torch.randn_like(queries)
+    k = args["k"]
+    print(f"{tuple(vectors.shape)} vectors, {len(queries)} queries, top {k}")
+
+    (_, true_ids), brute_time = timed(lambda: brute_force_search(vectors, queries, k))
+    print(f"brute force: {len(queries) / brute_time:.0f} queries/sec")
+
+    index, build_time = timed(lambda: IVFIndex(vectors, args["num_lists"]))
+    print(f"IVF with {index.num_lists} lists built in {build_time:.1f} s")
+
+    with tempfile.TemporaryDirectory() as index_dir:
+        index.save(index_dir)
+        index = IVFIndex.load(index_dir)
+        for num_probe in args["num_probes"]:
+            (_, ids), search_time = timed(lambda: index.search(queries, k, num_probe))
+            print(
+                f"num_probe {num_probe}: recall@{k} {recall(ids, true_ids):.3f}, "
+                f"{len(queries) / search_time:.0f} queries/sec"
+            )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--embeddings_path", type=str, default=None, help=".npy of (N, D) embeddings")
+    arg_parser.add_argument("--config_file", type=str, default=None, help="Index the codebook of the tokenizer config, loaded from its model_checkpoint_path")
+    arg_parser.add_argument("--num_vectors", type=int, default=200000)
+    arg_parser.add_argument("--dim", type=int, default=64)
+    arg_parser.add_argument("--num_queries", type=int, default=2000)
+    arg_parser.add_argument("--num_lists", type=int, default=None)
+    arg_parser.add_argument("--num_probes", type=int, nargs="+", default=[1, 4, 16, 64])
+    arg_parser.add_argument("--k", type=int, default=10)
+    arg_parser.add_argument("--num_threads", type=int, default=os.cpu_count())
+    main(vars(arg_parser.parse_args()))
@@ -0,0 +1,59 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import torch
+import argparse
+import time
+from classes.Attention import BACKENDS, set_attention_backend
+from classes.Transformers import Block
+from classes.Swin import SingleSwinBlock
+from classes.TokenLearner import TokenToSpatialTransformer
+
+
+def forward_backward_time(module: torch.nn.Module, x: torch.Tensor, num_steps: int):
+    # Warmup
+    module(x).sum().backward()
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        module(x).sum().backward()
+    return (time.perf_counter() - start) / num_steps
+
+
+def main(args: dict):
+    torch.manual_seed(0)
+    B, dim = args["batch_size"], args["dim"]
+    H, W = args["input_res"]
+
+    modules = {
+        "Block (causal)": (
+            lambda x, block=Block(dim, 8): block(x, is_causal=True),
+            torch.randn(B, args["context"], dim),
+        ),
+        "SingleSwinBlock (SW-MSA)": (
+            SingleSwinBlock(dim, [H, W], 8, window_size=8, shift_size=4),
+            torch.randn(B, H * W, dim),
+        ),
+        "TokenToSpatialTransformer": (
+            TokenToSpatialTransformer(H, W, dim),
+            torch.randn(B, 16, dim),
+        ),
+    }
+
+    for name, (module, x) in modules.items():
+        timings = []
+        for backend in BACKENDS:
+            set_attention_backend(backend)
+            step_time = forward_backward_time(module, x, args["num_steps"])
+            timings.append(f"{backend} {step_time * 1000:.1f}ms")
+        print(f"{name}: " + ", ".join(timings))
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--dim", type=int, default=128)
+    arg_parser.add_argument("--batch_size", type=int, default=8)
+    arg_parser.add_argument("--context", type=int, default=512)
+    arg_parser.add_argument("--input_res", type=int, nargs=2, default=[32, 32])
+    arg_parser.add_argument("--num_steps", type=int, default=5)
+    main(vars(arg_parser.parse_args()))
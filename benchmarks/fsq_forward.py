@@ -0,0 +1,49 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import torch
+import argparse
+import time
+import warnings
+from classes.FSQ import FSQ
+
+
+def throughput(fsq: FSQ, z: torch.Tensor, num_steps: int):
+    with torch.no_grad():
+        fsq(z)  # Warmup
+        start = time.perf_counter()
+        for _ in range(num_steps):
+            fsq(z)
+        elapsed = time.perf_counter() - start
+    return num_steps * z.shape[0] * z.shape[1] / elapsed
+
+
+def main(args: dict):
+    # torch.cuda.amp.autocast warns on every call without CUDA
+    warnings.filterwarnings("ignore")
+    torch.manual_seed(0)
+    torch.set_num_threads(args["num_threads"])
+    z = torch.randn(args["batch_size"], args["num_tokens"], args["dim"])
+
+    for debug in [False, True]:
+        fsq = FSQ(levels=args["levels"], dim=args["dim"], debug=debug)
+        if debug:
+            # Keep the prints of the debug mode out of the terminal
+            stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+        tokens_per_sec = throughput(fsq, z, args["num_steps"])
+        if debug:
+            sys.stdout.close()
+            sys.stdout = stdout
+        print(f"debug: {debug}, {tokens_per_sec:.0f} tokens/sec")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--levels", type=int, nargs="+", default=[9, 7, 7, 7])
+    arg_parser.add_argument("--dim", type=int, default=256)
+    arg_parser.add_argument("--batch_size", type=int, default=128)
+    arg_parser.add_argument("--num_tokens", type=int, default=64)
+    arg_parser.add_argument("--num_steps", type=int, default=50)
+    arg_parser.add_argument("--num_threads", type=int, default=1)
+    main(vars(arg_parser.parse_args()))
@@ -0,0 +1,74 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import torch
+import argparse
+import resource
+import time
+import multiprocessing as mp
+from classes.Transformers import GPT
+
+
+def run(args: dict, loss_chunk_size, queue):
+    torch.manual_seed(0)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    # GPT of the vq_gpt trainer, model_archs/vq_transformer.py
+    gpt = GPT(
+        context=512,
+        emb_dims=args["dim"],
+        vocab_size=args["vocab_size"],
+        num_heads=args["num_heads"],
+        loss_chunk_size=loss_chunk_size,
+        tie_weights=args["tie_weights"],
+    ).to(device)
+    optim = torch.optim.AdamW(gpt.parameters(), lr=3e-4)
+    x = torch.randint(
+        0, args["vocab_size"], size=[args["batch_size"], 513], device=device
+    )
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    for _ in range(args["num_steps"]):
+        _, loss = gpt.forward(x[:, :-1], x[:, 1:])
+        optim.zero_grad()
+        loss.backward()
+        optim.step()
+    elapsed = time.perf_counter() - start
+
+    if device == "cuda":
+        peak = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        # ru_maxrss is in KiB on linux, only the growth during training is of interest
+        peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss) / 2**10
+
+    tokens_per_sec = args["num_steps"] * args["batch_size"] * 512 / elapsed
+    queue.put((peak, tokens_per_sec))
+
+
+def main(args: dict):
+    # Every run gets a fresh process so that the peak memory does not carry over
+    ctx = mp.get_context("spawn")
+    for loss_chunk_size in [None, args["loss_chunk_size"]]:
+        queue = ctx.Queue()
+        process = ctx.Process(target=run, args=(args, loss_chunk_size, queue))
+        process.start()
+        peak, tokens_per_sec = queue.get()
+        process.join()
+        print(
+            f"loss_chunk_size: {loss_chunk_size}, peak memory {peak:.0f} MiB, "
+            f"{tokens_per_sec:.0f} tokens/sec"
+        )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--dim", type=int, default=256)
+    arg_parser.add_argument("--num_heads", type=int, default=8)
+    arg_parser.add_argument("--vocab_size", type=int, default=3087)
+    arg_parser.add_argument("--batch_size", type=int, default=16)
+    arg_parser.add_argument("--num_steps", type=int, default=3)
+    arg_parser.add_argument("--loss_chunk_size", type=int, default=1024)
+    arg_parser.add_argument("--tie_weights", action="store_true")
+    main(vars(arg_parser.parse_args()))
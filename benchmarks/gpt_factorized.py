@@ -0,0 +1,61 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import torch
+import argparse
+import math
+import time
+from classes.Transformers import GPT, FactorizedGPT
+
+
+def train_step_time(gpt: GPT, x: torch.Tensor, num_steps: int):
+    optim = torch.optim.AdamW(gpt.parameters(), lr=3e-4)
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        logits, loss = gpt.forward(x[:, :-1], x[:, 1:])
+        optim.zero_grad()
+        loss.backward()
+        optim.step()
+    return (time.perf_counter() - start) / num_steps, logits.numel()
+
+
+def main(args: dict):
+    torch.manual_seed(0)
+    levels = args["codebook_levels"]
+    vocab_size = math.prod(levels)
+    x = torch.randint(0, vocab_size, size=[args["batch_size"], args["context"] + 1])
+
+    models = {
+        "GPT": GPT(args["context"], args["dim"], vocab_size, args["num_heads"]),
+        "FactorizedGPT": FactorizedGPT(
+            args["context"], args["dim"], levels, args["num_heads"]
+        ),
+    }
+
+    for name, gpt in models.items():
+        step_time, logits_numel = train_step_time(gpt, x, args["num_steps"])
+        num_params = sum(param.numel() for param in gpt.parameters()) / 1e6
+
+        start = time.perf_counter()
+        with torch.no_grad():
+            gpt.eval().generate(x[:, :1], args["num_sample_tokens"])
+        sample_time = time.perf_counter() - start
+
+        print(
+            f"{name}: {num_params:.2f}M parameters, logits {logits_numel * 4 / 2**20:.1f} MiB, "
+            f"train step {step_time * 1000:.0f}ms, "
+            f"sampling {args['batch_size'] * args['num_sample_tokens'] / sample_time:.0f} tokens/sec"
+        )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--codebook_levels", type=int, nargs="+", default=[9, 7, 7, 7])
+    arg_parser.add_argument("--dim", type=int, default=256)
+    arg_parser.add_argument("--num_heads", type=int, default=8)
+    arg_parser.add_argument("--context", type=int, default=256)
+    arg_parser.add_argument("--batch_size", type=int, default=8)
+    arg_parser.add_argument("--num_steps", type=int, default=5)
+    arg_parser.add_argument("--num_sample_tokens", type=int, default=128)
+    main(vars(arg_parser.parse_args()))
@@ -0,0 +1,43 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import torch
+import argparse
+import time
+from classes.Transformers import GPT
+
+
+def tokens_per_sec(gpt: GPT, num_samples: int, num_tokens: int, use_cache: bool):
+    start_tokens = torch.zeros(size=[num_samples, 1], dtype=torch.long)
+    start = time.perf_counter()
+    gpt.generate(start_tokens, num_tokens, use_cache=use_cache)
+    elapsed = time.perf_counter() - start
+    return num_samples * num_tokens / elapsed
+
+
+@torch.no_grad()
+def main(args: dict):
+    torch.manual_seed(0)
+
+    # Same GPT as the VQ prior in model_archs/vq_transformer.py
+    gpt = GPT(
+        context=512,
+        emb_dims=args["dim"],
+        vocab_size=args["vocab_size"],
+        num_heads=args["num_heads"],
+    ).eval()
+
+    for use_cache in [False, True]:
+        tps = tokens_per_sec(gpt, args["num_samples"], args["num_tokens"], use_cache)
+        print(f"KV cache: {use_cache}, {tps:.1f} tokens/sec")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--dim", type=int, default=256)
+    arg_parser.add_argument("--num_heads", type=int, default=8)
+    arg_parser.add_argument("--vocab_size", type=int, default=3087)
+    arg_parser.add_argument("--num_samples", type=int, default=4)
+    arg_parser.add_argument("--num_tokens", type=int, default=512)
+    main(vars(arg_parser.parse_args()))
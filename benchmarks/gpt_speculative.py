@@ -0,0 +1,64 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import torch
+import argparse
+import time
+from classes.Transformers import GPT
+
+
+@torch.no_grad()
+def main(args: dict):
+    torch.manual_seed(0)
+
+    # Target is the VQ prior GPT of model_archs/vq_transformer.py, the draft a narrower GPT over the same vocab
+    gpt = GPT(
+        context=512,
+        emb_dims=args["dim"],
+        vocab_size=args["vocab_size"],
+        num_heads=args["num_heads"],
+    ).eval()
+    draft = GPT(
+        context=512,
+        emb_dims=args["draft_dim"],
+        vocab_size=args["vocab_size"],
+        num_heads=args["draft_num_heads"],
+    ).eval()
+
+    if args["gpt_checkpoint_path"]:
+        gpt.load_state_dict(torch.load(f=args["gpt_checkpoint_path"]))
+    if args["draft_checkpoint_path"]:
+        draft.load_state_dict(torch.load(f=args["draft_checkpoint_path"]))
+
+    start_tokens = torch.zeros(size=[args["num_samples"], 1], dtype=torch.long)
+
+    start = time.perf_counter()
+    gpt.generate(start_tokens, args["num_tokens"])
+    baseline = time.perf_counter() - start
+    print(f"Baseline (KV cache): {baseline:.2f}s")
+
+    start = time.perf_counter()
+    _, acceptance_rate = gpt.speculative_generate(
+        start_tokens, args["num_tokens"], draft, args["num_draft_tokens"]
+    )
+    speculative = time.perf_counter() - start
+    print(
+        f"Speculative (k={args['num_draft_tokens']}): {speculative:.2f}s, "
+        f"acceptance rate {acceptance_rate:.3f}, speedup {baseline / speculative:.2f}x"
+    )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--dim", type=int, default=512)
+    arg_parser.add_argument("--num_heads", type=int, default=8)
+    arg_parser.add_argument("--draft_dim", type=int, default=64)
+    arg_parser.add_argument("--draft_num_heads", type=int, default=4)
+    arg_parser.add_argument("--vocab_size", type=int, default=3087)
+    arg_parser.add_argument("--num_samples", type=int, default=1)
+    arg_parser.add_argument("--num_tokens", type=int, default=256)
+    arg_parser.add_argument("--num_draft_tokens", type=int, default=4)
+    arg_parser.add_argument("--gpt_checkpoint_path", type=str, default=None)
+    arg_parser.add_argument("--draft_checkpoint_path", type=str, default=None)
+    main(vars(arg_parser.parse_args()))
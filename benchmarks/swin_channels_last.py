@@ -0,0 +1,65 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import torch
+import argparse
+import json
+import time
+from torch.profiler import profile
+from classes.Swin import ConvPatchMerge, ConvPatchExpand, PatchMerge, PatchExpand
+from utils.get_model_arch import get_model_arch
+
+STAGE_TYPES = (ConvPatchMerge, ConvPatchExpand, PatchMerge, PatchExpand)
+
+
+def count_copies(module: torch.nn.Module, x: torch.Tensor):
+    # Every materializing copy (contiguous, clone, permute + reshape, ..) ends up in aten::copy_
+    with profile() as prof:
+        module(x)
+    return sum(
+        event.count for event in prof.key_averages() if event.key == "aten::copy_"
+    )
+
+
+def main(args: dict):
+    torch.manual_seed(0)
+    config = json.load(open(args["config_file"]))
+    model = get_model_arch(config["model_arch"])(**config)
+    x = torch.randn(args["batch_size"], config["num_channels"], *config["input_res"])
+
+    # Capture the input of every stage transition
+    stage_inputs = []
+    hooks = [
+        module.register_forward_pre_hook(
+            lambda module, inputs: stage_inputs.append((module, inputs[0]))
+        )
+        for module in model.modules()
+        if isinstance(module, STAGE_TYPES)
+    ]
+    with torch.no_grad():
+        model(x)
+    for hook in hooks:
+        hook.remove()
+
+    with torch.no_grad():
+        for idx, (module, stage_input) in enumerate(stage_inputs):
+            print(
+                f"Stage {idx} {type(module).__name__}: {count_copies(module, stage_input)} copies"
+            )
+
+    # Warmup
+    model(x)[0].sum().backward()
+    start = time.perf_counter()
+    for _ in range(args["num_steps"]):
+        model(x)[0].sum().backward()
+    elapsed = time.perf_counter() - start
+    print(f"{args['num_steps'] * args['batch_size'] / elapsed:.1f} images/sec (fwd + bwd)")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--config_file", type=str, default="./configs/train-config.json")
+    arg_parser.add_argument("--batch_size", type=int, default=16)
+    arg_parser.add_argument("--num_steps", type=int, default=5)
+    main(vars(arg_parser.parse_args()))
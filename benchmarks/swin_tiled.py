@@ -0,0 +1,68 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import torch
+import argparse
+import json
+import resource
+import time
+import multiprocessing as mp
+from utils.get_model_arch import get_model_arch
+from utils.tiled_tokenizer import tiled_encode, tiled_decode
+
+
+def run(args: dict, size: int, tiled: bool, queue):
+    torch.manual_seed(0)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    config = json.load(open(args["config_file"]))
+    model = get_model_arch(config["model_arch"])(**config).to(device).eval()
+    img = torch.randn(1, config["num_channels"], size, size, device=device)
+    tile_args = dict(
+        tile_size=args["tile_size"], overlap=args["overlap"], batch_size=args["batch_size"]
+    )
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        if tiled:
+            recon = tiled_decode(model, tiled_encode(model, img, **tile_args), **tile_args)
+        else:
+            recon = model.forward(img)[0]
+    if device == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+
+    if device == "cuda":
+        peak = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        # ru_maxrss is in KiB on linux, only the growth while tokenizing is of interest
+        peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss) / 2**10
+
+    queue.put((peak, size * size / 1e6 / elapsed, recon.shape))
+
+
+def main(args: dict):
+    # Every run gets a fresh process so that the peak memory does not carry over
+    ctx = mp.get_context("spawn")
+    for size in args["image_sizes"]:
+        for tiled in [False, True]:
+            queue = ctx.Queue()
+            process = ctx.Process(target=run, args=(args, size, tiled, queue))
+            process.start()
+            peak, megapixels_per_sec, shape = queue.get()
+            process.join()
+            print(
+                f"{size}x{size} {'tiled' if tiled else 'whole'}: peak memory {peak:.0f} MiB, "
+                f"{megapixels_per_sec:.3f} MP/s (encode + decode)"
+            )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--config_file", type=str, default="./configs/train-config.json")
+    arg_parser.add_argument("--image_sizes", type=int, nargs="+", default=[128, 256, 512])
+    arg_parser.add_argument("--tile_size", type=int, default=64)
+    arg_parser.add_argument("--overlap", type=int, default=16)
+    arg_parser.add_argument("--batch_size", type=int, default=8)
+    main(vars(arg_parser.parse_args()))
@@ -0,0 +1,41 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import torch
+import argparse
+import json
+import time
+from classes.Swin import SingleSwinBlock
+from utils.get_model_arch import get_model_arch
+
+
+def forward_backward_time(model: torch.nn.Module, x: torch.Tensor, num_steps: int):
+    # Warmup
+    model(x)[0].sum().backward()
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        model(x)[0].sum().backward()
+    return (time.perf_counter() - start) / num_steps
+
+
+def main(args: dict):
+    torch.manual_seed(0)
+    config = json.load(open(args["config_file"]))
+    model = get_model_arch(config["model_arch"])(**config)
+    x = torch.randn(args["batch_size"], config["num_channels"], *config["input_res"])
+
+    blocks = [m for m in model.modules() if isinstance(m, SingleSwinBlock)]
+    for fused in [False, True]:
+        for block in blocks:
+            block.fused = fused
+        step_time = forward_backward_time(model, x, args["num_steps"])
+        print(f"fused: {fused}, {len(blocks)} Swin blocks, {step_time * 1000:.1f}ms per step")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--config_file", type=str, default="./configs/train-config.json")
+    arg_parser.add_argument("--batch_size", type=int, default=16)
+    arg_parser.add_argument("--num_steps", type=int, default=5)
+    main(vars(arg_parser.parse_args()))
@@ -0,0 +1,43 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import argparse
+import time
+from classes.Transformers import ByteTokenizer
+from classes.BPE import BPETokenizer
+
+
+def timed(fn):
+    start = time.perf_counter()
+    out = fn()
+    return out, time.perf_counter() - start
+
+
+def main(args: dict):
+    text = open(args["path"], encoding="utf-8").read()
+    num_chars = len(text)
+
+    byte_tokenizer = ByteTokenizer(sorted(set(text)))
+    ids, encode_time = timed(lambda: byte_tokenizer.encode(text))
+    _, decode_time = timed(lambda: byte_tokenizer.decode(ids))
+    print(
+        f"ByteTokenizer: encode {num_chars / encode_time / 1e6:.1f} M chars/sec, "
+        f"decode {num_chars / decode_time / 1e6:.1f} M chars/sec"
+    )
+
+    bpe, train_time = timed(lambda: BPETokenizer.train([text], args["vocab_size"]))
+    ids, encode_time = timed(lambda: bpe.encode(text))
+    _, decode_time = timed(lambda: bpe.decode(ids))
+    print(
+        f"BPETokenizer ({bpe.vocab_size} ids): trained in {train_time:.1f} s, "
+        f"encode {num_chars / encode_time / 1e6:.2f} M chars/sec, decode {num_chars / decode_time / 1e6:.2f} M chars/sec, "
+        f"{num_chars / len(ids):.2f} chars/token, {bpe.encode_word.cache_info()}"
+    )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--path", type=str, required=True, help="Text file to tokenize")
+    arg_parser.add_argument("--vocab_size", type=int, default=1024)
+    main(vars(arg_parser.parse_args()))
@@ -0,0 +1,69 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import torch
+import argparse
+import json
+import tempfile
+import time
+from torch.utils.data import DataLoader
+from utils.get_model_arch import get_model_arch
+from utils.get_dataset import get_dataset
+from utils.token_archive import write_token_archive, TokenArchive
+
+
+def main(args: dict):
+    config = json.load(open(args["config_file"]))
+    model = get_model_arch(config["model_arch"])(**config).eval()
+    if args["model_checkpoint_path"]:
+        model.load_state_dict(torch.load(f=args["model_checkpoint_path"]))
+
+    dataset = get_dataset(
+        config["dataset"],
+        config["input_res"],
+        config["dataset_mean"],
+        config["dataset_std"],
+    )
+    loader = DataLoader(dataset, batch_size=args["batch_size"])
+
+    indices = []
+    num_tokenized = 0
+    for x, _ in loader:
+        indices.append(model.encode_to_indices(x))
+        num_tokenized += x.shape[0]
+        if num_tokenized >= args["num_images"]:
+            break
+    indices = torch.cat(indices)[: args["num_images"]]
+    codebook_size = model.quantizer.codebook_size
+    print(f"{config['model_arch']}: {tuple(indices.shape)} tokens, codebook {codebook_size}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for archive_model in ["unigram", "positional"]:
+            path = os.path.join(tmp_dir, f"{archive_model}.tkar")
+            start = time.perf_counter()
+            stats = write_token_archive(path, indices, codebook_size, model=archive_model)
+            encode_time = time.perf_counter() - start
+
+            archive = TokenArchive(path)
+            start = time.perf_counter()
+            for idx in range(len(archive)):
+                assert torch.equal(archive[idx].long(), indices[idx].long())
+            decode_time = time.perf_counter() - start
+
+            print(
+                f"{archive_model}: {stats['bits_per_token']:.3f} bits/token "
+                f"({stats['file_bits_per_token']:.3f} with tables), raw {stats['raw_bits_per_token']} bits, "
+                f"{32 / stats['file_bits_per_token']:.2f}x smaller than int32, "
+                f"encode {indices.numel() / encode_time:.0f} tokens/sec, "
+                f"decode {indices.numel() / decode_time:.0f} tokens/sec"
+            )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--config_file", type=str, default="./configs/train-config.json")
+    arg_parser.add_argument("--model_checkpoint_path", type=str, default=None)
+    arg_parser.add_argument("--num_images", type=int, default=2048)
+    arg_parser.add_argument("--batch_size", type=int, default=256)
+    main(vars(arg_parser.parse_args()))
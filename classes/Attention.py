@@ -0,0 +1,128 @@
+import torch
+from torch.nn import functional
+from functools import lru_cache
+from typing import Union
+
+# Backend used by attention() when none is given, see set_attention_backend
+_backend = "sdpa"
+_chunk_size = 256
+
+BACKENDS = ["sdpa", "chunked", "math"]
+
+
+def set_attention_backend(backend: str, chunk_size: Union[None, int] = None):
+    """
+    Selects the attention implementation for every module going through attention().
+        sdpa: torch scaled_dot_product_attention (flash / memory efficient kernels when available)
+        chunked: plain PyTorch, processes chunk_size queries at a time so only (chunk_size, L_k) scores exist at once
+        math: reference implementation, materializes the whole (L_q, L_k) attention matrix
+    """
+    global _backend, _chunk_size
+    assert backend in BACKENDS, f"backend must be one of {BACKENDS}"
+    _backend = backend
+    if chunk_size is not None:
+        _chunk_size = chunk_size
+
+
+def get_attention_backend():
+    return _backend
+
+
+@lru_cache(maxsize=8)
+def _full_causal_mask(size: int, device: torch.device):
+    return torch.ones(size, size, dtype=torch.bool, device=device).tril()
+
+
+def causal_mask(C_query: int, C_key: int, device: torch.device):
+    """
+    (C_query, C_key) boolean mask, True means attending. Aligned to the bottom right, so queries are the last C_query
+    positions of the keys (as with a KV cache). A view of one mask cached per device, its size the next power of two
+    of C_key, so growing KV caches do not build a new mask every step.
+    """
+    size = 1 << max(C_key - 1, 0).bit_length()
+    return _full_causal_mask(size, device)[C_key - C_query : C_key, :C_key]
+
+
+def _math_attention(q, k, v, attn_mask, dropout_p, scale):
+    attn = (q * scale) @ k.transpose(-2, -1)  # (..., L_q, L_k)
+    if attn_mask is not None:
+        if attn_mask.dtype == torch.bool:
+            attn = attn.masked_fill(~attn_mask, float("-inf"))
+        else:
+            attn = attn + attn_mask
+    attn = functional.softmax(attn, dim=-1)
+    if dropout_p > 0:
+        attn = functional.dropout(attn, p=dropout_p)
+    return attn @ v
+
+
+def _chunked_attention(q, k, v, attn_mask, dropout_p, scale, chunk_size):
+    C_query = q.shape[-2]
+    if C_query <= chunk_size:
+        return _math_attention(q, k, v, attn_mask, dropout_p, scale)
+
+    out = q.new_empty(*q.shape[:-1], v.shape[-1])
+    for start in range(0, C_query, chunk_size):
+        end = start + chunk_size
+        # Masks broadcasting along the queries are shared by every chunk
+        mask_chunk = attn_mask
+        if attn_mask is not None and attn_mask.shape[-2] != 1:
+            mask_chunk = attn_mask[..., start:end, :]
+        out[..., start:end, :] = _math_attention(
+            q[..., start:end, :], k, v, mask_chunk, dropout_p, scale
+        )
+    return out
+
+
+def attention(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    attn_mask: Union[None, torch.Tensor] = None,
+    is_causal=False,
+    dropout_p=0.0,
+    scale: Union[None, float] = None,
+    backend: Union[None, str] = None,
+):
+    """
+    Args:
+        q: (..., L_q, H), k: (..., L_k, H), v: (..., L_k, H_v)
+        attn_mask: boolean (True means attending) or additive mask broadcastable to (..., L_q, L_k)
+        is_causal: causal mask aligned to the bottom right, combined with attn_mask if both are given
+        backend: one of BACKENDS, defaults to the one set with set_attention_backend
+
+    Returns:
+        (..., L_q, H_v)
+    """
+    backend = backend or _backend
+    scale = scale if scale is not None else q.shape[-1] ** -0.5
+    C_query, C_key = q.shape[-2], k.shape[-2]
+
+    # A single query, e.g. decoding with a KV cache, sees every key
+    if is_causal and C_query == 1:
+        is_causal = False
+
+    if backend == "sdpa" and is_causal and attn_mask is None and C_query == C_key:
+        return functional.scaled_dot_product_attention(
+            q, k, v, dropout_p=dropout_p, is_causal=True, scale=scale
+        )
+
+    if is_causal:
+        mask = causal_mask(C_query, C_key, q.device)
+        if attn_mask is None:
+            attn_mask = mask
+        elif attn_mask.dtype == torch.bool:
+            attn_mask = attn_mask & mask
+        else:
+            attn_mask = attn_mask.masked_fill(~mask, float("-inf"))
+
+    if backend == "sdpa":
+        return functional.scaled_dot_product_attention(
+            q, k, v, attn_mask=attn_mask, dropout_p=dropout_p, scale=scale
+        )
+    elif backend == "chunked":
+        return _chunked_attention(q, k, v, attn_mask, dropout_p, scale, _chunk_size)
+    elif backend == "math":
+        return _math_attention(q, k, v, attn_mask, dropout_p, scale)
+
+    raise ValueError(f"Unknown attention backend: {backend}, must be one of {BACKENDS}")
@@ -0,0 +1,154 @@
+import math
+import torch
+from torch import nn
+from torch.nn import functional
+from typing import List, Tuple, Union
+
+# Luma weights of RGB and the RGB to YIQ transform, hue is a rotation of the I, Q plane
+GRAY_WEIGHTS = [0.2989, 0.587, 0.114]
+RGB_TO_YIQ = [
+    [0.299, 0.587, 0.114],
+    [0.596, -0.274, -0.322],
+    [0.211, -0.523, 0.312],
+]
+
+
+class BatchAugmentation(nn.Module):
+    """
+    Random augmentation of whole normalized (B, C, H, W) batches after collation, on their device. Every sample gets
+    its own parameters, drawn as (B) tensors and applied with batched ops: crop and flip through one affine grid
+    sample, color jitter through per sample factors, patch shift through one gather. As in torchvision's ColorJitter
+    the jitter ops run in a random order, drawn once per batch, and clamp to [0, 1] after each. Brightness, contrast
+    and saturation match its functional ops, hue is a rotation of the YIQ chroma plane rather than of the HSV hue.
+
+    Args:
+        mean, std: Normalization of the batches, jitter works on [0, 1] colors,
+        crop_scale: Range of the area fraction of the random crop resized back to (H, W), (1, 1) for no crop,
+        crop_ratio: Range of the aspect ratio of the crop,
+        flip: Probability of a horizontal flip,
+        brightness, contrast, saturation: Factors drawn from [1 - value, 1 + value],
+        hue: Hue rotation drawn from [-hue, hue] turns,
+        patch_shift: Maximum shift in pixels of the random translation, zero filled as in classes/SPT.py, usually
+            patch_size // 2
+    """
+
+    def __init__(
+        self,
+        mean: List[float],
+        std: List[float],
+        crop_scale: Tuple[float, float] = (1.0, 1.0),
+        crop_ratio: Tuple[float, float] = (3 / 4, 4 / 3),
+        flip=0.0,
+        brightness=0.0,
+        contrast=0.0,
+        saturation=0.0,
+        hue=0.0,
+        patch_shift=0,
+    ):
+        super().__init__()
+        self.crop_scale = crop_scale
+        self.crop_ratio = crop_ratio
+        self.flip = flip
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+        self.patch_shift = patch_shift
+
+        self.register_buffer("mean", torch.tensor(mean).reshape(1, -1, 1, 1), persistent=False)
+        self.register_buffer("std", torch.tensor(std).reshape(1, -1, 1, 1), persistent=False)
+        self.register_buffer("gray_weights", torch.tensor(GRAY_WEIGHTS), persistent=False)
+        self.register_buffer("rgb_to_yiq", torch.tensor(RGB_TO_YIQ), persistent=False)
+
+    def uniform(self, low: float, high: float, B: int, x: torch.Tensor, generator: Union[None, torch.Generator]):
+        return low + (high - low) * torch.rand(B, device=x.device, generator=generator)
+
+    def crop_flip(self, x: torch.Tensor, generator: Union[None, torch.Generator]):
+        B = x.shape[0]
+        flip = torch.where(self.uniform(0, 1, B, x, generator) < self.flip, -1.0, 1.0)
+        if tuple(self.crop_scale) == (1.0, 1.0):
+            return torch.where(flip[:, None, None, None] < 0, x.flip(-1), x)
+
+        # Crop width and height as fractions of the image, centers anywhere keeping the crop inside
+        area = self.uniform(*self.crop_scale, B, x, generator)
+        log_ratio = self.uniform(math.log(self.crop_ratio[0]), math.log(self.crop_ratio[1]), B, x, generator)
+        w = torch.sqrt(area * torch.exp(log_ratio)).clamp(max=1.0)
+        h = torch.sqrt(area / torch.exp(log_ratio)).clamp(max=1.0)
+        cx = self.uniform(-1, 1, B, x, generator) * (1 - w)
+        cy = self.uniform(-1, 1, B, x, generator) * (1 - h)
+
+        zeros = torch.zeros_like(w)
+        theta = torch.stack(
+            [torch.stack([w * flip, zeros, cx], dim=-1), torch.stack([zeros, h, cy], dim=-1)], dim=1
+        )
+        grid = functional.affine_grid(theta, list(x.shape), align_corners=False)
+        return functional.grid_sample(x, grid, mode="bilinear", padding_mode="reflection", align_corners=False)
+
+    def color_jitter(self, x: torch.Tensor, generator: Union[None, torch.Generator]):
+        B, C = x.shape[:2]
+        img = x * self.std + self.mean
+
+        def luma(img: torch.Tensor):
+            return img if C != 3 else torch.einsum("c,bchw->bhw", self.gray_weights, img)[:, None]
+
+        ops = []
+        if self.brightness:
+            b = self.uniform(1 - self.brightness, 1 + self.brightness, B, x, generator)[:, None, None, None]
+            ops.append(lambda img: img * b)
+
+        if self.contrast:
+            c = self.uniform(1 - self.contrast, 1 + self.contrast, B, x, generator)[:, None, None, None]
+
+            def contrast(img: torch.Tensor):
+                mean = luma(img).mean(dim=(-3, -2, -1), keepdim=True)
+                return (img - mean) * c + mean
+
+            ops.append(contrast)
+
+        if C == 3 and self.saturation:
+            s = self.uniform(1 - self.saturation, 1 + self.saturation, B, x, generator)[:, None, None, None]
+            ops.append(lambda img: s * img + (1 - s) * luma(img))
+
+        if C == 3 and self.hue:
+            # Rotation of the I, Q plane, one (B, 3, 3) RGB matrix per sample
+            angle = self.uniform(-self.hue, self.hue, B, x, generator) * 2 * math.pi
+            cos, sin = torch.cos(angle), torch.sin(angle)
+            rotation = torch.zeros(B, 3, 3, device=x.device)
+            rotation[:, 0, 0] = 1
+            rotation[:, 1, 1], rotation[:, 1, 2] = cos, -sin
+            rotation[:, 2, 1], rotation[:, 2, 2] = sin, cos
+            hue = torch.linalg.inv(self.rgb_to_yiq) @ rotation @ self.rgb_to_yiq
+            ops.append(lambda img: torch.einsum("bij,bjhw->bihw", hue, img))
+
+        # Random order of the ops for the whole batch, clamped after each as in ColorJitter
+        order = torch.randperm(
+            len(ops), generator=generator, device=generator.device if generator is not None else "cpu"
+        )
+        for idx in order.tolist():
+            img = ops[idx](img).clamp(0, 1)
+
+        return (img - self.mean) / self.std
+
+    def shift(self, x: torch.Tensor, generator: Union[None, torch.Generator]):
+        B, C, H, W = x.shape
+        s = self.patch_shift
+        dy = torch.randint(-s, s + 1, (B,), device=x.device, generator=generator)
+        dx = torch.randint(-s, s + 1, (B,), device=x.device, generator=generator)
+
+        # Pixel (i, j) of sample b comes from (i - dy, j - dx) of the zero padded batch
+        x_pad = functional.pad(x, (s, s, s, s))
+        rows = torch.arange(H, device=x.device)[None] + s - dy[:, None]  # (B, H)
+        cols = torch.arange(W, device=x.device)[None] + s - dx[:, None]  # (B, W)
+        batch = torch.arange(B, device=x.device)[:, None, None]
+        return x_pad.permute(0, 2, 3, 1)[batch, rows[:, :, None], cols[:, None, :]].permute(0, 3, 1, 2)
+
+    @torch.no_grad()
+    def forward(self, x: torch.Tensor, generator: Union[None, torch.Generator] = None):
+        """x: (B, C, H, W) normalized batch, generator: Seeded generator on the device of x"""
+        if self.flip or tuple(self.crop_scale) != (1.0, 1.0):
+            x = self.crop_flip(x, generator)
+        if self.brightness or self.contrast or self.saturation or self.hue:
+            x = self.color_jitter(x, generator)
+        if self.patch_shift:
+            x = self.shift(x, generator)
+        return x.contiguous()
@@ -0,0 +1,148 @@
+"""
+Byte level byte-pair encoding, text is split into words (a leading space is kept with the word, GPT-2 style) whose UTF-8
+bytes are merged pairwise. Ids 0-255 are the raw bytes, merge i creates id 256 + i.
+"""
+
+import heapq
+import json
+import re
+import numpy as np
+from collections import Counter, defaultdict
+from functools import lru_cache
+from typing import Iterable, List, Tuple
+
+WORD_PATTERN = re.compile(r" ?[^\s]+|\s+")
+
+
+def pretokenize(text: str) -> List[str]:
+    return WORD_PATTERN.findall(text)
+
+
+def word_pairs(symbols: Tuple[int, ...]):
+    return zip(symbols, symbols[1:])
+
+
+def merge_symbols(symbols: Tuple[int, ...], pair: Tuple[int, int], new_id: int):
+    merged = []
+    idx = 0
+    while idx < len(symbols):
+        if idx < len(symbols) - 1 and (symbols[idx], symbols[idx + 1]) == pair:
+            merged.append(new_id)
+            idx += 2
+        else:
+            merged.append(symbols[idx])
+            idx += 1
+    return tuple(merged)
+
+
+class BPETokenizer:
+    """
+    Args:
+        merges (List[Tuple[int, int]]): Pairs merged in order, from train or load,
+        cache_size (int): Number of words whose encoding is memoized
+    """
+
+    def __init__(self, merges: List[Tuple[int, int]] = [], cache_size=2**16):
+        self.merges = [tuple(pair) for pair in merges]
+        self.ranks = {pair: rank for rank, pair in enumerate(self.merges)}
+
+        self.vocab = [bytes([byte]) for byte in range(256)]
+        for first, second in self.merges:
+            self.vocab.append(self.vocab[first] + self.vocab[second])
+        self.vocab_size = len(self.vocab)
+
+        # Words repeat a lot in natural text, each one is merged once
+        self.encode_word = lru_cache(maxsize=cache_size)(self._encode_word)
+
+    @classmethod
+    def train(cls, texts: Iterable[str], vocab_size: int, **kwargs):
+        """
+        Learns vocab_size - 256 merges. Pair counts are built once over the distinct words and then only updated for
+        the words containing the merged pair, the most frequent pair comes from a max heap with lazy deletion (stale
+        entries are skipped when their count no longer matches).
+        """
+        assert vocab_size >= 256, "vocab_size must cover the 256 bytes"
+        word_counts = Counter()
+        for text in texts:
+            word_counts.update(pretokenize(text))
+
+        words = [tuple(word.encode("utf-8")) for word in word_counts]
+        counts = list(word_counts.values())
+
+        pair_counts = defaultdict(int)
+        pair_words = defaultdict(set)  # Words containing each pair
+        for word_idx, symbols in enumerate(words):
+            for pair in word_pairs(symbols):
+                pair_counts[pair] += counts[word_idx]
+                pair_words[pair].add(word_idx)
+
+        # Ties break towards the smallest pair so training is deterministic
+        heap = [(-count, pair) for pair, count in pair_counts.items()]
+        heapq.heapify(heap)
+
+        merges = []
+        while len(merges) < vocab_size - 256 and heap:
+            neg_count, pair = heapq.heappop(heap)
+            if pair_counts.get(pair, 0) != -neg_count:
+                continue
+            if -neg_count <= 0:
+                break
+            new_id = 256 + len(merges)
+            merges.append(pair)
+
+            changed = set()
+            for word_idx in pair_words.pop(pair):
+                symbols = words[word_idx]
+                count = counts[word_idx]
+                for old_pair in word_pairs(symbols):
+                    pair_counts[old_pair] -= count
+                    changed.add(old_pair)
+                symbols = merge_symbols(symbols, pair, new_id)
+                words[word_idx] = symbols
+                for new_pair in word_pairs(symbols):
+                    pair_counts[new_pair] += count
+                    pair_words[new_pair].add(word_idx)
+                    changed.add(new_pair)
+
+            for changed_pair in changed:
+                count = pair_counts[changed_pair]
+                if count > 0:
+                    heapq.heappush(heap, (-count, changed_pair))
+                else:
+                    del pair_counts[changed_pair]
+                    pair_words.pop(changed_pair, None)
+
+        return cls(merges, **kwargs)
+
+    def _encode_word(self, word: str) -> Tuple[int, ...]:
+        symbols = tuple(word.encode("utf-8"))
+        while len(symbols) > 1:
+            # Earliest learned merge first, as during training
+            pair = min(word_pairs(symbols), key=lambda pair: self.ranks.get(pair, np.inf))
+            if pair not in self.ranks:
+                break
+            symbols = merge_symbols(symbols, pair, 256 + self.ranks[pair])
+        return symbols
+
+    def encode(self, text: str):
+        ids = [idx for word in pretokenize(text) for idx in self.encode_word(word)]
+        return np.array(ids, dtype=np.int64)
+
+    def decode(self, arr):
+        return b"".join(self.vocab[idx] for idx in np.asarray(arr).tolist()).decode(
+            "utf-8", errors="replace"
+        )
+
+    def encode_batch(self, texts: List[str]):
+        return [self.encode(text) for text in texts]
+
+    def decode_batch(self, arrs):
+        return [self.decode(arr) for arr in arrs]
+
+    def save(self, path: str):
+        with open(path, "w") as file:
+            json.dump({"merges": self.merges}, file)
+
+    @classmethod
+    def load(cls, path: str, **kwargs):
+        return cls(json.load(open(path))["merges"], **kwargs)
@@ -73,11 +73,25 @@ class FSQ(Module):
         projection_has_bias: bool = True,
         return_indices=True,
         force_quantization_f32=True,
+        bound_eps: float = 1e-3,
+        debug=False,
     ):
         super().__init__()
+        # Validated once here instead of on every forward, bound only handles odd levels
+        assert all(level % 2 != 0 for level in levels), "Not all elements are odd"
         _levels = torch.tensor(levels, dtype=int32)
         self.register_buffer("_levels", _levels, persistent=False)
 
+        # Constants of bound and the renormalization, kept on the device of the module
+        self.bound_eps = bound_eps
+        half_l = (_levels - 1) * (1 - bound_eps) / 2
+        self.register_buffer("_half_l", half_l, persistent=False)
+        half_width = _levels // 2
+        self.register_buffer("_half_width", half_width, persistent=False)
+
+        # Prints the bounded inputs on every forward, syncs with the device
+        self.debug = debug
+
         _basis = torch.cumprod(torch.tensor([1] + levels[:-1]), dim=0, dtype=int32)
         self.register_buffer("_basis", _basis, persistent=False)
 
@@ -123,13 +137,16 @@ class FSQ(Module):
         self.allowed_dtypes = allowed_dtypes
         self.force_quantization_f32 = force_quantization_f32
 
-    def bound(self, z, eps=1e-3):
-        print("Z: ", z)
+    def bound(self, z, eps: float | None = None):
         """Bound `z`, an array of shape (..., d)."""
-        assert all(x % 2 != 0 for x in self._levels), "Not all elements are odd"
-        half_l = (self._levels - 1) * (1 - eps) / 2
-        print(torch.tanh(z) * half_l.to(z.device))
-        return torch.tanh(z) * half_l.to(z.device)
+        half_l = self._half_l
+        if eps is not None and eps != self.bound_eps:
+            half_l = (self._levels - 1) * (1 - eps) / 2
+        bound_z = torch.tanh(z) * half_l
+        if self.debug:
+            print("Z: ", z)
+            print(bound_z)
+        return bound_z
 
     '''
     def bound(self, z, eps: float = 1e-3):
@@ -144,16 +161,24 @@ class FSQ(Module):
         """Quantizes z, returns quantized zhat, same shape as z."""
         bound_z = self.bound(z)
         quantized = round_ste(bound_z)
-        half_width = self._levels // 2  # Renormalize to [-1, 1].
-        return quantized / half_width
+        return quantized / self._half_width  # Renormalize to [-1, 1].
+
+    def quantize_with_indices(self, z):
+        """
+        quantize and codes_to_indices in one pass, the indices come straight from the rounded levels instead of
+        scaling the normalized codes back.
+        """
+        quantized = round_ste(self.bound(z))
+        codes = quantized / self._half_width
+        level_indices = quantized.detach().to(int32) + self._half_width
+        indices = (level_indices * self._basis).sum(dim=-1, dtype=int32)
+        return codes, indices
 
     def _scale_and_shift(self, zhat_normalized):
-        half_width = self._levels // 2
-        return (zhat_normalized * half_width) + half_width
+        return (zhat_normalized * self._half_width) + self._half_width
 
     def _scale_and_shift_inverse(self, zhat):
-        half_width = self._levels // 2
-        return (zhat - half_width) / half_width
+        return (zhat - self._half_width) / self._half_width
 
     def _indices_to_codes(self, indices):
         level_indices = self.indices_to_level_indices(indices)
@@ -230,14 +255,14 @@ class FSQ(Module):
             if force_f32 and orig_dtype not in self.allowed_dtypes:
                 z = z.float()
 
-            codes = self.quantize(z)
-
             # returning indices could be optional
 
             indices = None
 
             if self.return_indices:
-                indices = self.codes_to_indices(codes)
+                codes, indices = self.quantize_with_indices(z)
+            else:
+                codes = self.quantize(z)
 
             codes = rearrange(codes, "b n c d -> b n (c d)")
 
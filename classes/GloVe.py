@@ -1,44 +1,59 @@
 import torch
 from torch import nn
-from collections import Counter
 import numpy as np
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+from utils.cooccurrence import build_co_occurrence
 
 
 class GloVe(nn.Module):
-    def __init__(self, vocab_size, embedding_dim):
+    """
+    Word vectors w, context vectors w_tilde and their biases, log X_ij is predicted as w_i . w_tilde_j + b_i + b_tilde_j
+    so a pair costs O(embedding_dim). With sparse=True the gradients only cover the rows of the batch, for
+    torch.optim.SparseAdam or Adagrad.
+    """
+
+    def __init__(self, vocab_size, embedding_dim, sparse=True):
         super(GloVe, self).__init__()
         self.vocab_size = vocab_size
         self.embedding_dim = embedding_dim
-        self.embedding = nn.Embedding(vocab_size, embedding_dim)
-        self.linear1 = nn.Linear(embedding_dim, vocab_size)
-        self.linear2 = nn.Linear(embedding_dim, vocab_size)
+        self.embedding = nn.Embedding(vocab_size, embedding_dim, sparse=sparse)
+        self.context_embedding = nn.Embedding(vocab_size, embedding_dim, sparse=sparse)
+        self.bias = nn.Embedding(vocab_size, 1, sparse=sparse)
+        self.context_bias = nn.Embedding(vocab_size, 1, sparse=sparse)
         self.init_weights()
 
     def init_weights(self):
         initrange = 0.5 / self.embedding_dim
         self.embedding.weight.data.uniform_(-initrange, initrange)
-        self.linear1.weight.data.uniform_(-initrange, initrange)
-        self.linear1.bias.data.zero_()
-        self.linear2.weight.data.uniform_(-initrange, initrange)
-        self.linear2.bias.data.zero_()
+        self.context_embedding.weight.data.uniform_(-initrange, initrange)
+        self.bias.weight.data.zero_()
+        self.context_bias.weight.data.zero_()
 
     def forward(self, i_indices, j_indices):
-        i_embeds = self.embedding(i_indices)
-        j_embeds = self.embedding(j_indices)
-        out1 = self.linear1(i_embeds).squeeze(1)
-        out2 = self.linear2(j_embeds).squeeze(1)
-        return out1, out2
+        """Predicted log co-occurrence of every (i, j) pair"""
+        dot = (self.embedding(i_indices) * self.context_embedding(j_indices)).sum(dim=-1)
+        return dot + self.bias(i_indices).squeeze(-1) + self.context_bias(j_indices).squeeze(-1)
+
+    def loss(self, i_indices, j_indices, co_occurrences, x_max=100.0, alpha=0.75):
+        """Weighted least squares f(X_ij) (w_i . w_tilde_j + b_i + b_tilde_j - log X_ij) ** 2, averaged over the batch"""
+        weights = (co_occurrences / x_max).pow(alpha).clamp(max=1.0)
+        error = self.forward(i_indices, j_indices) - torch.log(co_occurrences)
+        return (weights * error.pow(2)).mean()
+
+    def embeddings(self):
+        """w + w_tilde, the final word vectors of the paper"""
+        return self.embedding.weight.data + self.context_embedding.weight.data
 
 
 def create_co_occurrence_matrix(corpus, window_size, vocab_size):
-    co_occurrence_matrix = np.zeros((vocab_size, vocab_size), dtype=np.float32)
-    word_counts = Counter(corpus)
-    for i, target_word in enumerate(corpus):
-        target_index = i
-        context_indices = list(range(max(0, i - window_size), i)) + list(
-            range(i + 1, min(len(corpus), i + window_size + 1))
-        )
-        for context_index in context_indices:
-            co_occurrence_matrix[target_word, corpus[context_index]] += 1
-            co_occurrence_matrix[corpus[context_index], target_word] += 1
-    return co_occurrence_matrix
+    """
+    Dense (vocab_size, vocab_size) counts of a small corpus, every co-occurrence counted twice in both directions.
+    Goes through the sparse builder, use utils.cooccurrence.build_co_occurrence directly for real corpora.
+    """
+    co_occurrence = build_co_occurrence(
+        np.asarray(corpus, dtype=np.int64), vocab_size, window_size, weighting=False
+    )
+    return 2 * co_occurrence.to_dense()
@@ -6,6 +6,7 @@ import numpy as np
 
 sys.path.append(os.path.abspath("."))
 from typing import Union
+from classes.Swin import to_channels_last, from_channels_last
 
 import os
 
@@ -207,26 +208,26 @@ class BilinearUpsample(nn.Module):
             embedding_dim=out_dim // 2, padding_idx=0, init_size=out_dim // 2
         )
 
-    def forward(self, x):
+    def forward(self, x, input_res: Union[None, list[int]] = None):
         """
         x: B, H*W, C
+        input_res: defaults to input_resolution
         """
-        H, W = self.input_resolution
+        H, W = input_res or self.input_resolution
         B, L, C = x.shape
         assert L == H * W, "input feature has wrong size"
         assert C == self.dim, "wrong in PatchMerging"
 
-        x = x.view(B, H, W, -1)
-        x = x.permute(0, 3, 1, 2).contiguous()  # B,C,H,W
+        x = to_channels_last(x, H, W)  # B,C,H,W in channels_last
         x = self.upsample(x)
-        x = x.permute(0, 2, 3, 1).contiguous().view(B, L * 4, C)  # B,H,W,C
+        x = from_channels_last(x)  # B,H*W,C
         x = self.norm(x)
         x = self.reduction(x)
 
         # Add SPE
-        x = x.reshape(B, H * 2, W * 2, self.out_dim).permute(0, 3, 1, 2)
+        x = to_channels_last(x, H * 2, W * 2)
         x += self.sin_pos_embed.make_grid2d(H * 2, W * 2, B) * self.alpha
-        x = x.permute(0, 2, 3, 1).contiguous().view(B, H * 2 * W * 2, self.out_dim)
+        x = from_channels_last(x)
 
         return x
 
@@ -264,30 +265,26 @@ class PoolDownsample(nn.Module):
             embedding_dim=out_dim // 2, padding_idx=0, init_size=out_dim // 2
         )
 
-    def forward(self, x):
+    def forward(self, x, input_res: Union[None, list[int]] = None):
         """
         x: B, H*W, C
+        input_res: defaults to input_resolution
         """
-        H, W = self.input_resolution
+        H, W = input_res or self.input_resolution
         B, L, C = x.shape
         assert L == H * W, "input feature has wrong size"
         assert C == self.dim, "wrong in PatchMerging"
 
-        x = x.view(B, H, W, -1)
-        x = x.permute(0, 3, 1, 2).contiguous()  # B,C,H,W
+        x = to_channels_last(x, H, W)  # B,C,H,W in channels_last
         max_pool_features = self.max_pool.forward(x)
         avg_pool_features = self.avg_pool.forward(x)
         x = torch.cat([max_pool_features, avg_pool_features], dim=1)
-        x = x.permute(0, 2, 3, 1).contiguous().view(B, L // 4, 2 * C)  # B,H,W,C
+        x = from_channels_last(x)  # B,H*W,C
         x = self.norm(x)
         x = self.reduction(x)
 
         # Add SPE
-        x = x.reshape(B, H // 2, W // 2, self.out_dim).permute(0, 3, 1, 2)
+        x = to_channels_last(x, H // 2, W // 2)
         x += self.sin_pos_embed.make_grid2d(H // 2, W // 2, B) * self.alpha
-        x = (
-            x.permute(0, 2, 3, 1)
-            .contiguous()
-            .view(B, (H // 2) * (W // 2), self.out_dim)
-        )
+        x = from_channels_last(x)
         return x
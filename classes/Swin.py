@@ -3,9 +3,11 @@ import torch.nn as nn
 import os
 import sys
 from einops import repeat
+from functools import lru_cache
 
 sys.path.append(os.path.abspath("."))
 from typing import List, Union
+from classes.Attention import attention
 
 
 # Functions
@@ -65,6 +67,93 @@ def window_combination(windows, window_size, H, W):
     return x
 
 
+def to_channels_last(x: torch.Tensor, H: int, W: int):
+    """
+    (B, H * W, C) -> (B, C, H, W) in channels_last memory format.
+    A token sequence already is NHWC in memory, so this is a view and conv / pixel (un)shuffle / pooling layers run on it directly.
+    """
+    B, L, C = x.shape
+    return x.view(B, H, W, C).permute(0, 3, 1, 2)
+
+
+def from_channels_last(x: torch.Tensor):
+    """(B, C, H, W) -> (B, H * W, C), a view when x is in channels_last memory format"""
+    B, C, H, W = x.shape
+    return x.permute(0, 2, 3, 1).reshape(B, H * W, C)
+
+
+@lru_cache(maxsize=64)
+def window_gather_indices(
+    H: int, W: int, window_size: int, shift_size: int, device: torch.device
+):
+    """
+    Gather indices for a (B, H * W, C) sequence that apply the cyclic shift and the window partition in one go.
+
+    Returns:
+        index: (H * W), x[:, index] is window ordered, viewable as (num_windows * B, window_size ** 2, C)
+        inverse: (H * W), windows[:, inverse] puts the tokens back in place, undoing the shift too
+    """
+    index = torch.arange(H * W, device=device).view(1, H, W, 1)
+    if shift_size > 0:
+        index = torch.roll(index, shifts=(-shift_size, -shift_size), dims=(1, 2))
+    index = window_partition(index, window_size).reshape(-1)
+
+    inverse = torch.empty_like(index)
+    inverse[index] = torch.arange(H * W, device=device)
+    return index, inverse
+
+
+@lru_cache(maxsize=64)
+def shifted_window_mask(
+    H: int,
+    W: int,
+    window_size: int,
+    shift_size: int,
+    device: torch.device,
+    dtype: torch.dtype = torch.float32,
+):
+    """
+    Additive (0 / -100) SW-MSA mask of shape (num_windows, M^2, M^2) for a (H, W) patch grid, None for W-MSA.
+    Memoized, so every resolution / device / dtype is only built once.
+    """
+    if shift_size == 0:
+        return None
+
+    # This handling of attention-mask is my favorite part. What a beautiful implementation.
+    # To match the dimension for window_partition function
+    img_mask = torch.zeros((1, H, W, 1))
+
+    # h_slices and w_slices divide a cyclic-shifted image to 9 regions as shown in the paper
+    h_slices = (
+        slice(0, -window_size),
+        slice(-window_size, -shift_size),
+        slice(-shift_size, None),
+    )
+
+    w_slices = (
+        slice(0, -window_size),
+        slice(-window_size, -shift_size),
+        slice(-shift_size, None),
+    )
+
+    # Fill out number for each of 9 divided regions
+    cnt = 0
+    for row in h_slices:
+        for col in w_slices:
+            img_mask[:, row, col, :] = cnt
+            cnt += 1
+
+    mask_windows = window_partition(img_mask, window_size)  # (num_windows, M, M, 1)
+    mask_windows = mask_windows.view(-1, window_size * window_size)
+
+    # Such a gorgeous code..
+    attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
+    attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(
+        attn_mask == 0, float(0.0)
+    )
+    return attn_mask.to(device=device, dtype=dtype)
+
+
 def res_scaler(input_res: list[int], factor: float) -> List[int]:
     H, W = input_res
     H, W = H * factor, W * factor
@@ -119,13 +208,13 @@ class PatchMerge(nn.Module):
         )
         self.norm = norm_layer(out_channels)
 
-    def forward(self, x):
-        H, W = self.input_res
+    def forward(self, x, input_res: Union[None, List[int]] = None):
+        H, W = input_res or self.input_res
         B, L, C = x.shape
         assert L == H * W, f"L: {L} is not equal H*W: {H}*{W}={H*W}"
-        x = x.permute(0, 2, 1).view(B, C, H, W)
+        x = to_channels_last(x, H, W)
         x = self.patch_merge(x)
-        x = x.view(B, C * 4, -1).permute(0, 2, 1)
+        x = from_channels_last(x)
         x = self.proj(x)
         x = self.norm(x)
         return x
@@ -145,13 +234,13 @@ class ConvPatchMerge(nn.Module):
             nn.Conv2d(dim * 4, dim_out, kernel_size=1, stride=1),
         )
 
-    def forward(self, x: torch.Tensor):
-        H, W = self.input_res
+    def forward(self, x: torch.Tensor, input_res: Union[None, List[int]] = None):
+        H, W = input_res or self.input_res
         B, L, C = x.shape
         assert L == H * W, f"L: {L} is not equal H*W: {H}*{W}={H*W}"
-        x = x.permute(0, 2, 1).contiguous().view(B, C, H, W)
+        x = to_channels_last(x, H, W)
         x = self.net.forward(x)
-        x = x.view(B, self.dim_out, -1).permute(0, 2, 1).contiguous()
+        x = from_channels_last(x)
         return x
 
 
@@ -175,13 +264,13 @@ class PatchExpand(nn.Module):
         )
         self.norm = norm_layer(out_channels)
 
-    def forward(self, x):
-        H, W = self.input_res
+    def forward(self, x, input_res: Union[None, List[int]] = None):
+        H, W = input_res or self.input_res
         B, L, C = x.shape
         assert L == H * W, f"L: {L} is not equal H*W: {H}*{W}={H*W}"
-        x = x.permute(0, 2, 1).view(B, C, H, W)
+        x = to_channels_last(x, H, W)
         x = self.patch_merge(x)
-        x = x.view(B, C // 4, -1).permute(0, 2, 1)
+        x = from_channels_last(x)
         x = self.proj(x)
         x = self.norm(x)
         return x
@@ -213,14 +302,14 @@ class ConvPatchExpand(nn.Module):
         self.conv.weight.data.copy_(conv_weight)
         nn.init.zeros_(self.conv.bias.data)
 
-    def forward(self, x: torch.Tensor):
-        H, W = self.input_res
+    def forward(self, x: torch.Tensor, input_res: Union[None, List[int]] = None):
+        H, W = input_res or self.input_res
         B, L, C = x.shape
         assert L == H * W, f"L: {L} is not equal H*W: {H}*{W}={H*W}"
-        x = x.permute(0, 2, 1).contiguous().view(B, C, H, W)
+        x = to_channels_last(x, H, W)
         x = self.conv.forward(x)
         x = self.net.forward(x)
-        x = x.view(B, self.dim_out, -1).permute(0, 2, 1).contiguous()
+        x = from_channels_last(x)
         return x
 
 
@@ -264,7 +353,7 @@ class WindowAttention(nn.Module):
 
         self.softmax = nn.Softmax(dim=-1)
 
-    def forward(self, x: torch.Tensor, mask=Union[None | torch.Tensor]):
+    def forward(self, x: torch.Tensor, mask: Union[None, torch.Tensor] = None):
         """
         Args:
             x: input features with shape of (num_windows * B, N, C), N refers to number of patches in a window (M^2)
@@ -293,37 +382,24 @@ class WindowAttention(nn.Module):
         # each of q, k, v has dimension of (B, num_heads, N, C // num_heads)
         q, k, v = qkv[0], qkv[1], qkv[2]  # Why not tuple-unpacking?
 
-        q = q * self.scale
-
-        # attn becomes (B_W, num_heads, N, N) shape
-        # N = M^2
-        attn = q @ k.transpose(-2, -1)
+        attn_drop = self.attn_drop.p if self.training else 0.0
 
         if mask is not None:
             num_windows = mask.shape[0]
-            mask = mask.unsqueeze(1).unsqueeze(
-                0
-            )  # (1, num_windows, 1, M^2, M^2), Unsqueeze 1 to broadcast along all heads and unsqueeze(0) to broadcast along all batches
-            attn = attn.view(
-                B_W // num_windows, num_windows, self.num_heads, N, N
-            )  # (B, num_windows, num_heads, N, N)
-            attn = attn + mask
-
-            attn = attn.view(
-                -1, self.num_heads, N, N
-            )  # attn = (num_windows * B, num_heads, N, N)
-            attn = self.softmax(attn)
-        else:
-            attn = self.softmax(attn)
+            # (B, num_windows, num_heads, N, C // num_heads) against a (1, num_windows, 1, M^2, M^2) mask,
+            # unsqueeze 1 to broadcast along all heads and unsqueeze(0) to broadcast along all batches
+            q, k, v = [
+                t.view(B_W // num_windows, num_windows, self.num_heads, N, -1)
+                for t in (q, k, v)
+            ]
+            mask = mask.unsqueeze(1).unsqueeze(0).to(q.dtype)
 
-        attn = self.attn_drop(attn)
+        # x = (num_windows * B, num_heads, N, C // num_heads)
+        x = attention(q, k, v, attn_mask=mask, dropout_p=attn_drop, scale=self.scale)
 
-        # attn = (num_windows * B, num_heads, N, N)
-        # v = (B_W, num_heads, N, C // num_heads) B_W = num_windows * B
-        # attn @ v = (num_windows * B, num_heads, N, C // num_heads)
-        # (attn @ v).transpose(1, 2) = (num_windows * B, N, num_heads, C // num_heads)
+        # x.transpose(1, 2) = (num_windows * B, N, num_heads, C // num_heads)
         # Finally, x = (num_windows*B, N, C), reshape(B_, N, C) performs concatenation of multi-headed attentions
-        x = (attn @ v).transpose(1, 2).reshape(B_W, N, C)
+        x = x.reshape(B_W, self.num_heads, N, -1).transpose(1, 2).reshape(B_W, N, C)
 
         x = self.proj(x)
         x = self.proj_drop(x)
@@ -347,6 +423,7 @@ class SingleSwinBlock(nn.Module):
         drop_path (float, optional): Stochastic depth rate. Default: 0.0
         act_layer(nn.Module, optional): Activation layer. Default: nn.GELU
         norm_layer (nn.Module, optional): Normalization layer. Default: nn.LayerNorm
+        fused (bool, optional): Shift and partition windows with a single precomputed gather instead of roll + window_partition. Default: True
     """
 
     def __init__(
@@ -363,6 +440,7 @@ class SingleSwinBlock(nn.Module):
         attn_drop=0.0,
         act_layer=nn.SiLU,
         norm_layer=nn.LayerNorm,
+        fused=True,
     ):
         super().__init__()
         self.dim = dim
@@ -371,6 +449,7 @@ class SingleSwinBlock(nn.Module):
         self.window_size = window_size
         self.shift_size = shift_size
         self.mlp_ratio = mlp_ratio
+        self.fused = fused
 
         # If window_size > input_res, no partition
         if min(self.input_res) <= self.window_size:
@@ -404,94 +483,114 @@ class SingleSwinBlock(nn.Module):
             drop=drop,
         )
 
-        # Attention Mask for SW-MSA
-        # This handling of attention-mask is my favorite part. What a beautiful implementation.
-        if self.shift_size > 0:
-            H, W = (
-                self.input_res
-            )  # H, W are the patch dimensions, not the pixel dimensions
-
-            # To match the dimension for window_partition function
-            img_mask = torch.zeros((1, H, W, 1))
-
-            # h_slices and w_slices divide a cyclic-shifted image to 9 regions as shown in the paper
-            h_slices = (
-                slice(0, -self.window_size),
-                slice(-self.window_size, -self.shift_size),
-                slice(-self.shift_size, None),
-            )
+        # Window / shift as configured, the ones above are for input_res
+        self.base_window_size = window_size
+        self.base_shift_size = shift_size
 
-            w_slices = (
-                slice(0, -self.window_size),
-                slice(-self.window_size, -self.shift_size),
-                slice(-self.shift_size, None),
-            )
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older checkpoints carry the SW-MSA mask as a buffer, it is now built per resolution by shifted_window_mask
+        state_dict.pop(prefix + "attn_mask", None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
-            # Fill out number for each of 9 divided regions
-            cnt = 0
-            for row in h_slices:
-                for col in w_slices:
-                    img_mask[:, row, col, :] = cnt
-                    cnt += 1
-
-            mask_windows = window_partition(
-                img_mask, self.window_size
-            )  # (num_windows, M, M, 1)
-            mask_windows = mask_windows.view(-1, self.window_size * self.window_size)
-
-            # Such a gorgeous code..
-            attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-            attn_mask = attn_mask.masked_fill(
-                attn_mask != 0, float(-100.0)
-            ).masked_fill(attn_mask == 0, float(0.0))
-        else:
-            attn_mask = None
-
-        self.register_buffer("attn_mask", attn_mask)
+    def window_config(self, H: int, W: int):
+        """Window and shift size for a (H, W) patch grid, if the window does not fit there is no partition"""
+        if min(H, W) <= self.base_window_size:
+            return min(H, W), 0
+        return self.base_window_size, self.base_shift_size
 
-    def forward(self, x):
-        H, W = self.input_res
+    def forward(self, x, input_res: Union[None, List[int]] = None):
+        H, W = input_res or self.input_res
         B, L, C = x.shape
         assert L == H * W, f"Input feature has wrong size; {L} is not equal {H}*{W}"
 
         residual = x  # Residual
         x = self.norm1(x)
+
+        window_size, shift_size = self.window_config(H, W)
+
+        # Pad the patch grid to a multiple of the window size
+        pad_H = (window_size - H % window_size) % window_size
+        pad_W = (window_size - W % window_size) % window_size
+        if pad_H or pad_W:
+            x = nn.functional.pad(x.view(B, H, W, C), (0, 0, 0, pad_W, 0, pad_H))
+            x = x.view(B, -1, C)
+        H_pad, W_pad = H + pad_H, W + pad_W
+
+        attn_mask = shifted_window_mask(
+            H_pad, W_pad, window_size, shift_size, x.device, x.dtype
+        )
+
+        if self.fused:
+            x = self.fused_window_attention(
+                x, H_pad, W_pad, window_size, shift_size, attn_mask
+            )
+        else:
+            x = self.window_attention(
+                x, H_pad, W_pad, window_size, shift_size, attn_mask
+            )
+
+        if pad_H or pad_W:
+            x = x.view(B, H_pad, W_pad, C)[:, :H, :W].reshape(B, H * W, C)
+
+        # Feed Forward
+        x = residual + x
+        x = x + self.mlp(self.norm2(x))
+
+        return x
+
+    def fused_window_attention(
+        self, x: torch.Tensor, H, W, window_size, shift_size, attn_mask
+    ):
+        B, L, C = x.shape
+
+        index, inverse = window_gather_indices(H, W, window_size, shift_size, x.device)
+
+        # Cyclic shift + partition windows, (num_windows * B, window_size ** 2, C)
+        x_windows = x[:, index].view(-1, window_size * window_size, C)
+
+        # W-MSA / SW-MSA, the mask is added inside the attention kernel
+        attn_windows = self.attn(x_windows, mask=attn_mask)
+
+        # Merge windows + reverse cyclic shift
+        return attn_windows.view(B, L, C)[:, inverse]
+
+    def window_attention(
+        self, x: torch.Tensor, H, W, window_size, shift_size, attn_mask
+    ):
+        B, L, C = x.shape
+
         x = x.view(
             B, H, W, C
         )  # H, W refer to the number of "patches" for width and height, not "pixels"
 
         # Cyclic Shift
-        if self.shift_size > 0:
-            x = torch.roll(x, shifts=(-self.shift_size, -self.shift_size), dims=(1, 2))
+        if shift_size > 0:
+            x = torch.roll(x, shifts=(-shift_size, -shift_size), dims=(1, 2))
 
         # Partition Windows
         x_windows = window_partition(
-            x, self.window_size
+            x, window_size
         )  # (num_windows * B, window_size, window_size, C)
         x_windows = x_windows.view(
-            -1, self.window_size * self.window_size, C
+            -1, window_size * window_size, C
         )  # (num_windows * B, window_size ** 2, C)
 
         # W-MSA / SW-MSA
 
         attn_windows = self.attn(
-            x_windows, mask=self.attn_mask
+            x_windows, mask=attn_mask
         )  # (num_windows * B, window_size * window_size, C)
 
         # Merge Windows
-        attn_windows = attn_windows.view(-1, self.window_size, self.window_size, C)
-        x = window_combination(attn_windows, self.window_size, H, W)  # (B, H', W', C)
+        attn_windows = attn_windows.view(-1, window_size, window_size, C)
+        x = window_combination(attn_windows, window_size, H, W)  # (B, H', W', C)
 
         # Reverse Cyclic Shift
-        if self.shift_size > 0:
-            x = torch.roll(x, shifts=(self.shift_size, self.shift_size), dims=(1, 2))
+        if shift_size > 0:
+            x = torch.roll(x, shifts=(shift_size, shift_size), dims=(1, 2))
 
         x = x.view(B, H * W, C)
 
-        # Feed Forward
-        x = residual + x
-        x = x + self.mlp(self.norm2(x))
-
         return x
 
 
@@ -555,6 +654,11 @@ class MultiSwinBlock(nn.Module):
         )
         self.blocks.append(final_layer)
 
-    def forward(self, x: torch.Tensor):
-        x = self.blocks.forward(x)
+    def forward(self, x: torch.Tensor, input_res: Union[None, List[int]] = None):
+        """input_res defaults to the resolution the layer was built with, any other one works as well"""
+        input_res = input_res or self.input_res
+        for block in self.blocks:
+            if isinstance(block, nn.Identity):
+                continue
+            x = block.forward(x, input_res)
         return x
@@ -2,7 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from classes.Transformers import MHAPyTorchScaledDotProduct
+from classes.Transformers import MultiHeadAttention
 
 
 class TokenLearner(nn.Module):
@@ -82,8 +82,8 @@ class TokenToSpatialTransformer(nn.Module):
         # Initialize learnable spatial grid embeddings
         self.spatial_embeddings = nn.Parameter(torch.randn(1, height * width, dim))
 
-        # Self-attention mechanism with batch_first=True
-        self.attention = MHAPyTorchScaledDotProduct(dim, num_heads=8)
+        # Cross attention from the spatial grid to the tokens
+        self.attention = MultiHeadAttention(num_heads=8, head_size=dim // 8)
 
         # Linear projection to map tokens to spatial features
 
@@ -103,7 +103,7 @@ class TokenToSpatialTransformer(nn.Module):
         )  # Shape: (batch, height * width, dim)
 
         # Apply attention: tokens attending to spatial grid
-        attended_tokens, _ = self.attention(
+        attended_tokens = self.attention(
             query=spatial_embeds, key=tokens, value=tokens
         )
 
@@ -1,7 +1,10 @@
+import math
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.nn import functional
 from typing import Union
+from classes.Attention import attention, causal_mask
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
@@ -15,21 +18,109 @@ class ByteTokenizer:
         for idx, char in enumerate(chars):
             self.stoi[char] = idx
             self.itos[idx] = char
-        pass
 
-    def encode(self, text: str):
-        output = list(range(len(text)))
-        for idx, char in enumerate(text):
-            output[idx] = self.stoi[char]
+        # Lookup tables over code points, -1 marks chars outside the vocab
+        codepoints = np.array([ord(char) for char in chars], dtype=np.uint32)
+        self.id_to_codepoint = codepoints
+        self.codepoint_to_id = np.full(int(codepoints.max()) + 1, -1, dtype=np.int64)
+        self.codepoint_to_id[codepoints] = np.arange(len(chars))
+        # ASCII only vocabs index the table with the UTF-8 bytes directly
+        self.is_ascii = bool(codepoints.max() < 128)
 
-        return output
+    def text_to_codepoints(self, text: str):
+        if self.is_ascii:
+            return np.frombuffer(text.encode("utf-8"), dtype=np.uint8)
+        return np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
 
-    def decode(self, arr: list[int]):
-        output = list(range(len(arr)))
-        for idx in range(len(arr)):
-            output[idx] = self.itos[arr[idx]]
+    def encode(self, text: str):
+        """(len(text)) int64 ids"""
+        codepoints = self.text_to_codepoints(text)
+        assert codepoints.size == 0 or codepoints.max() < len(
+            self.codepoint_to_id
+        ), "Text contains chars outside the vocab"
+        ids = self.codepoint_to_id[codepoints]
+        assert np.all(ids >= 0), "Text contains chars outside the vocab"
+        return ids
+
+    def decode(self, arr: Union["list[int]", np.ndarray, torch.Tensor]):
+        if isinstance(arr, torch.Tensor):
+            arr = arr.cpu().numpy()
+        codepoints = self.id_to_codepoint[np.asarray(arr, dtype=np.int64)]
+        return codepoints.tobytes().decode("utf-32-le")
+
+    def encode_batch(self, texts: "list[str]"):
+        # A single lookup over all the texts, split back afterwards
+        ids = self.encode("".join(texts))
+        return np.split(ids, np.cumsum([len(text) for text in texts])[:-1])
+
+    def decode_batch(self, arrs: "list[list[int]]"):
+        lengths = [len(arr) for arr in arrs]
+        text = self.decode(np.concatenate([np.asarray(arr, dtype=np.int64) for arr in arrs]))
+        ends = np.cumsum(lengths)
+        return [text[end - length : end] for end, length in zip(ends, lengths)]
+
+
+# Cross entropy of a linear head, computed in chunks of rows so that the (N, V) logits never exist at once
+class ChunkedCrossEntropy(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, x, weight, bias, targets, chunk_size):
+        # x is (N, D), weight is (V, D), bias is (V) or None and targets are (N)
+        N = x.shape[0]
+        # Half precision inputs accumulate in float32
+        acc_dtype = torch.promote_types(x.dtype, torch.float32)
+        loss = x.new_zeros((), dtype=acc_dtype)
+        for start in range(0, N, chunk_size):
+            logits = functional.linear(x[start : start + chunk_size], weight, bias)
+            loss += functional.cross_entropy(
+                logits.to(acc_dtype), targets[start : start + chunk_size], reduction="sum"
+            )
 
-        return "".join(output)
+        ctx.save_for_backward(x, weight, bias, targets)
+        ctx.chunk_size = chunk_size
+        return (loss / N).to(x.dtype)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, weight, bias, targets = ctx.saved_tensors
+        N = x.shape[0]
+        chunk_size = ctx.chunk_size
+        acc_dtype = torch.promote_types(x.dtype, torch.float32)
+
+        grad_x = torch.empty_like(x)
+        grad_weight = torch.zeros_like(weight, dtype=acc_dtype)
+        grad_bias = torch.zeros_like(bias, dtype=acc_dtype) if bias is not None else None
+
+        # d(loss)/d(logits) = (softmax - one_hot) / N, recomputed chunk by chunk
+        for start in range(0, N, chunk_size):
+            x_chunk = x[start : start + chunk_size]
+            logits = functional.linear(x_chunk, weight, bias).to(acc_dtype)
+            grad_logits = functional.softmax(logits, dim=-1)
+            grad_logits[
+                torch.arange(x_chunk.shape[0], device=x.device),
+                targets[start : start + chunk_size],
+            ] -= 1
+            grad_logits *= grad_output / N
+
+            grad_x[start : start + chunk_size] = grad_logits @ weight.to(acc_dtype)
+            grad_weight += grad_logits.T @ x_chunk.to(acc_dtype)
+            if grad_bias is not None:
+                grad_bias += grad_logits.sum(dim=0)
+
+        grad_weight = grad_weight.to(weight.dtype)
+        grad_bias = grad_bias.to(bias.dtype) if grad_bias is not None else None
+        return grad_x, grad_weight, grad_bias, None, None
+
+
+def chunked_cross_entropy(
+    x: torch.Tensor,
+    weight: torch.Tensor,
+    bias: Union[None, torch.Tensor],
+    targets: torch.Tensor,
+    chunk_size=1024,
+):
+    """Mean cross entropy of functional.linear(x, weight, bias) against targets, x is (N, D)"""
+    return ChunkedCrossEntropy.apply(x, weight, bias, targets, chunk_size)
 
 
 # Single Self Attention Head
@@ -61,17 +152,11 @@ class SelfAttentionHead(nn.Module):
         value: torch.Tensor = self.value(
             value_input
         )  # (B, C_K, D) @ (B, D, H) -> (B, C_K, H)
-        wei: torch.Tensor = (
-            query @ key.transpose(-2, -1) * self.head_size**-0.5
-        )  # (B, C_Q, H) @ (B, H, C_K) => (B, C, C)
-        # compute attention scores ("affinities")
-
-        wei = wei.masked_fill(mask, float("-inf"))  # (B, C_Q, C_K)
-        wei = functional.softmax(wei, dim=-1)  # (B, C_Q, C_K)
 
-        # perform the weighted aggregation of the values
-
-        out = wei @ value  # (B, C_Q, C_K) @ (B, C_K, H) -> (B, C_Q, H)
+        # mask is True where attention is removed, the backend takes True where attention is applied
+        out = attention(
+            query, key, value, attn_mask=~mask
+        )  # (B, C_Q, C_K) @ (B, C_K, H) -> (B, C_Q, H)
         return out
 
 # Multiple Self Attention Heads in Parallel
@@ -109,30 +194,26 @@ class MultiHeadAttention(nn.Module):
         key = self.split(self.key(key))
         value = self.split(self.value(value))
 
-        C_query = query.shape[-2]
-        C_key = key.shape[-2]
+        # Encoder attends everywhere, decoder gets the lower left tril mask
+        is_causal = mask != "encoder"
 
-        if mask == "encoder":
-            # Default mask is the encoder mask
-            mask = torch.zeros(size=(C_query, C_key)).bool().to(device=value.device)
-        else:
-            # Decoder lower left tril mask
-            mask = (
-                torch.triu(
-                    torch.full(size=(C_query, C_key), fill_value=-torch.inf), diagonal=1
+        if output_attention:
+            # The attention weights are needed, so they are computed explicitly
+            C_query, C_key = query.shape[-2], key.shape[-2]
+            wei = (query @ key.transpose(-2, -1)) * (
+                self.head_size**-0.5
+            )  # (B, N, C_Q, H) @ (B, N, H, C_K) => (B, N, C_Q, C_K)
+            if is_causal:
+                wei = wei.masked_fill(
+                    ~causal_mask(C_query, C_key, wei.device), float("-inf")
                 )
-                .bool()
-                .to(device=value.device)
-            )
-
-        wei = (query @ key.transpose(-2, -1)) * (
-            self.head_size**-0.5
-        )  # (B, N, C_Q, H) @ (B, N, H, C_K) => (B, N, C_Q, C_K)
-
-        wei = wei.masked_fill(mask, float("-inf"))  # (B, N, C_Q, C_K)
-        wei = functional.softmax(wei, dim=-1)  # (B, N, C_Q, C_K)
+            wei = functional.softmax(wei, dim=-1)  # (B, N, C_Q, C_K)
+            values = wei @ value
+        else:
+            values = attention(
+                query, key, value, is_causal=is_causal
+            )  # (B, N, C_Q, C_K) @ (B, N, C_K, H) -> (B, N, C_Q, H)
 
-        values = wei @ value  # (B, N, C_Q, C_K) @ (B, N, C_K, H) -> (B, N, C_Q, H)
         values = values.permute(0, 2, 1, 3)  # (B, C_Q, N, H)
         B, C_values, N, H = values.shape
         values = values.reshape(B, C_values, N * H)
@@ -143,6 +224,45 @@ class MultiHeadAttention(nn.Module):
 
         return values
 
+# Key/Value cache of a single attention layer for incremental decoding
+class KVCache:
+    """
+    Preallocated (B, N, max_len, H) key and value buffers. `length` is the number of cached positions,
+    rolling back is just lowering it.
+    """
+
+    def __init__(self, max_len: int):
+        self.max_len = max_len
+        self.keys: Union[None, torch.Tensor] = None
+        self.values: Union[None, torch.Tensor] = None
+        self.length = 0
+
+    def update(self, keys: torch.Tensor, values: torch.Tensor):
+        # keys and values are (B, N, T, H) for the T new positions
+        B, N, T, H = keys.shape
+        if self.keys is None or self.keys.shape[0] != B:
+            self.keys = keys.new_empty(B, N, self.max_len, H)
+            self.values = values.new_empty(B, N, self.max_len, H)
+            self.length = 0
+
+        assert (
+            self.length + T <= self.max_len
+        ), f"KVCache overflow: {self.length} + {T} > {self.max_len}"
+
+        self.keys[:, :, self.length : self.length + T] = keys
+        self.values[:, :, self.length : self.length + T] = values
+        self.length += T
+
+        # (B, N, length, H) views over everything seen so far
+        return self.keys[:, :, : self.length], self.values[:, :, : self.length]
+
+    def crop(self, length: int):
+        self.length = min(self.length, length)
+
+    def reset(self):
+        self.length = 0
+
+
 class MHAPyTorchScaledDotProduct(nn.Module):
     def __init__(self, embed_dim, num_heads, dropout=0.0, qkv_bias=False):
         super().__init__()
@@ -157,7 +277,13 @@ class MHAPyTorchScaledDotProduct(nn.Module):
         self.proj = nn.Linear(embed_dim, embed_dim)
         self.dropout = dropout
 
-    def forward(self, x: torch.Tensor, attn_mask: Union[None, torch.Tensor]=None, is_causal=False):
+    def forward(
+        self,
+        x: torch.Tensor,
+        attn_mask: Union[None, torch.Tensor] = None,
+        is_causal=False,
+        kv_cache: Union[None, KVCache] = None,
+    ):
         batch_size, num_tokens, embed_dim = x.shape
 
         # (b, num_tokens, embed_dim) --> (b, num_tokens, 3 * embed_dim)
@@ -172,10 +298,14 @@ class MHAPyTorchScaledDotProduct(nn.Module):
         # (3, b, num_heads, num_tokens, head_dim) -> 3 times (b, num_heads, num_tokens, head_dim)
         queries, keys, values = qkv
 
+        if kv_cache is not None:
+            # Attend over the cached positions as well as the new ones, the causal mask is aligned to the bottom right
+            keys, values = kv_cache.update(keys, values)
+
         use_dropout = 0. if not self.training else self.dropout
 
-        context_vec = nn.functional.scaled_dot_product_attention(
-            queries, keys, values, attn_mask=attn_mask, dropout_p=use_dropout, is_causal=is_causal)
+        context_vec = attention(
+            queries, keys, values, attn_mask=attn_mask, is_causal=is_causal, dropout_p=use_dropout)
 
         # Combine heads, where self.d_out = self.num_heads * self.head_dim
         context_vec = context_vec.transpose(1, 2).contiguous().view(batch_size, num_tokens, self.embed_dim)
@@ -222,12 +352,19 @@ class Block(nn.Module):
         self.ln1 = nn.LayerNorm(emb_dims)
         self.ln2 = nn.LayerNorm(emb_dims)
 
-    def forward(self, x, mask: Union[None, torch.Tensor] = None, is_causal = False):
+    def forward(
+        self,
+        x,
+        mask: Union[None, torch.Tensor] = None,
+        is_causal=False,
+        kv_cache: Union[None, KVCache] = None,
+    ):
         """
         For a custom mask, use "mask" but for decoder/causal mask use "is_causal".
+        Pass a "kv_cache" to only feed the new tokens while decoding.
         """
         # Residual connections allow the network to learn the simplest possible function. No matter how many complex layer we start by learning a linear function and the complex layers add in non linearity as needed to learn true function.
-        x = x + self.self_att.forward(self.ln1(x), mask)
+        x = x + self.self_att.forward(self.ln1(x), mask, is_causal, kv_cache)
         x = x + self.feed_fwd.forward(self.ln2(x))
         return x
 
@@ -240,11 +377,22 @@ class GPT(nn.Module):
         emb_dims: int,
         vocab_size: int,
         num_heads: int,
-        mask: Union[None, torch.Tensor]=None
+        mask: Union[None, torch.Tensor]=None,
+        causal=True,
+        loss_chunk_size: Union[None, int] = None,
+        tie_weights=False,
+        num_embeddings: Union[None, int] = None,
     ):
+        """
+        With "loss_chunk_size" the training loss is computed straight from the final hidden states in chunks of that
+        many tokens and forward returns no logits. "tie_weights" shares the head weight with the token embedding.
+        "num_embeddings" is the number of rows of the token embedding and outputs of the head, vocab_size by default.
+        """
         super().__init__()
 
         self.mask = mask
+        self.causal = causal
+        self.loss_chunk_size = loss_chunk_size
         self.context = context
         self.emb_dims = emb_dims
         self.num_heads = num_heads
@@ -252,7 +400,8 @@ class GPT(nn.Module):
 
         # Token embedding table is used for token identification encoding
         # Position embedding table is used for token position (in reference to the current context) encoding
-        self.token_embedding_table = nn.Embedding(vocab_size, emb_dims)
+        num_embeddings = num_embeddings or vocab_size
+        self.token_embedding_table = nn.Embedding(num_embeddings, emb_dims)
         self.position_embedding_table = nn.Embedding(context, emb_dims)
 
         self.blocks = nn.ModuleList(
@@ -267,52 +416,269 @@ class GPT(nn.Module):
         self.ln_f = nn.LayerNorm(emb_dims)
 
         # Model head used for output
-        self.head = nn.Linear(emb_dims, vocab_size)
+        self.head = nn.Linear(emb_dims, num_embeddings)
+        if tie_weights:
+            self.head.weight = self.token_embedding_table.weight
+
+    def new_kv_caches(self):
+        return [KVCache(self.context) for _ in self.blocks]
+
+    def embed_tokens(self, x: torch.Tensor):
+        return self.token_embedding_table(x)
+
+    def compute_loss(self, logits: torch.Tensor, targets: torch.Tensor):
+        B, C, D = logits.shape
+        return functional.cross_entropy(logits.view(B * C, D), targets.reshape(B * C))
 
-    def forward(self, x, targets=None):
+    def probs(self, logits: torch.Tensor):
+        """Distribution over the whole vocab from (..., D) logits"""
+        return functional.softmax(logits, dim=-1)
+
+    def sample_next(self, logits: torch.Tensor):
+        """Samples (B, 1) tokens from (B, D) logits"""
+        return torch.multinomial(self.probs(logits), num_samples=1)
+
+    def forward(self, x, targets=None, kv_caches: Union[None, "list[KVCache]"] = None):
         B, C = x.shape
 
         # x and targets are both (B,C) tensor of integers
-        tok_emb = self.token_embedding_table(x)  # (B,C,D)
+        tok_emb = self.embed_tokens(x)  # (B,C,D)
 
-        # Getting the position embedding for all the positions, starting from 0 -> context - 1
-        pos_emb = self.position_embedding_table(torch.arange(C, device="cuda"))  # (C,D)
+        # Getting the position embedding for all the positions, starting after the cached ones
+        start = kv_caches[0].length if kv_caches is not None else 0
+        pos_emb = self.position_embedding_table(
+            torch.arange(start, start + C, device=x.device)
+        )  # (C,D)
         x = tok_emb + pos_emb
-        for block in self.blocks:
-            x = block(x, self.mask)
+
+        # Causal unless a custom mask was given or the model is bidirectional
+        is_causal = self.causal and self.mask is None
+        for idx, block in enumerate(self.blocks):
+            kv_cache = kv_caches[idx] if kv_caches is not None else None
+            x = block(x, self.mask, is_causal, kv_cache)
         x = self.ln_f(x)
+
+        if targets is not None and self.loss_chunk_size:
+            loss = chunked_cross_entropy(
+                x.reshape(B * C, -1),
+                self.head.weight,
+                self.head.bias,
+                targets.reshape(B * C),
+                self.loss_chunk_size,
+            )
+            return None, loss
+
         logits = self.head(x)
 
         if targets is None:
             loss = None
         else:
-            B, C, D = logits.shape
-            logits = logits.view(B * C, D)
-            targets = targets.view(B * C)
-            loss = functional.cross_entropy(logits, targets)
+            loss = self.compute_loss(logits, targets)
 
         return logits, loss
 
-    def generate(self, idx, max_new_tokens) -> torch.Tensor:
+    def generate(
+        self,
+        idx,
+        max_new_tokens,
+        use_cache=True,
+        draft: Union[None, "GPT"] = None,
+        num_draft_tokens=4,
+    ) -> torch.Tensor:
         # idx is (B, C) array of indices in the current context
+        if draft is not None:
+            idx, _ = self.speculative_generate(
+                idx, max_new_tokens, draft, num_draft_tokens
+            )
+            return idx
+
+        kv_caches = self.new_kv_caches() if use_cache else None
+
         for _ in range(max_new_tokens):
 
-            # crop idx to the last context
-            idx_cond = idx[:, -self.context :]
+            if kv_caches is None:
+                # crop idx to the last context
+                idx_cond = idx[:, -self.context :]
+            elif kv_caches[0].length == 0 or kv_caches[0].length >= self.context:
+                # (Re)fill the cache from the cropped context. Once the window slides every token changes
+                # its position embedding, so the cached keys/values are stale and the window is recomputed.
+                for kv_cache in kv_caches:
+                    kv_cache.reset()
+                idx_cond = idx[:, -self.context :]
+            else:
+                # Only the newest token, the rest is in the cache
+                idx_cond = idx[:, -1:]
 
             # Get the predictions
-            logits, loss = self.forward(x=idx_cond)
+            logits, loss = self.forward(x=idx_cond, kv_caches=kv_caches)
 
             # Focus only on the last step which contains the output considering the entire context window
             # logits are (batch_size, context = full context considered time step, dimensionality) which is essentially the output vector for each batch
             logits = logits[:, -1, :]
 
-            # Apply softmax to get probabilities
-            probs = functional.softmax(logits, dim=1)
-
             # Sample from the distribution
-            idx_next = torch.multinomial(probs, num_samples=1)  # (B, 1)
+            idx_next = self.sample_next(logits)  # (B, 1)
 
             # Appended along the context_window hence the context keeps building up
             idx = torch.cat((idx, idx_next), dim=1)  # (batch_size, context_window + 1)
         return idx
+
+    @torch.no_grad()
+    def speculative_generate(
+        self, idx, max_new_tokens, draft: "GPT", num_draft_tokens=4
+    ):
+        """
+        Speculative sampling (https://arxiv.org/abs/2211.17192): the draft proposes num_draft_tokens tokens, this model
+        scores all of them in one forward and accepts each with probability min(1, p / q). The first rejected token is
+        resampled from max(0, p - q), so the samples follow this model's distribution exactly.
+
+        Returns the indices and the fraction of draft tokens that were accepted.
+        """
+        assert draft.vocab_size == self.vocab_size, "draft must share the vocab_size"
+
+        B, C = idx.shape
+        k = num_draft_tokens
+        target_len = C + max_new_tokens
+        kv_caches = self.new_kv_caches()
+        draft_kv_caches = draft.new_kv_caches()
+        num_accepted = 0
+        num_proposed = 0
+
+        while idx.shape[1] < target_len:
+            # Positions are absolute, once draft + verification run past a context window finish without speculation
+            if idx.shape[1] + k > min(self.context, draft.context):
+                idx = self.generate(idx, target_len - idx.shape[1])
+                break
+
+            # Draft k tokens, first feeding whatever the draft cache is missing
+            draft_tokens = []
+            draft_probs = []
+            x = idx[:, draft_kv_caches[0].length :]
+            for _ in range(k):
+                logits, _ = draft.forward(x, kv_caches=draft_kv_caches)
+                probs = draft.probs(logits[:, -1, :])
+                x = torch.multinomial(probs, num_samples=1)  # (B, 1)
+                draft_tokens.append(x)
+                draft_probs.append(probs)
+
+            draft_tokens = torch.cat(draft_tokens, dim=1)  # (B, k)
+            draft_probs = torch.stack(draft_probs, dim=1)  # (B, k, V)
+
+            # Verify all of them with a single forward, (B, k + 1, V)
+            x = torch.cat((idx[:, kv_caches[0].length :], draft_tokens), dim=1)
+            logits, _ = self.forward(x, kv_caches=kv_caches)
+            probs = self.probs(logits[:, -(k + 1) :, :])
+
+            # Accept draft token i with probability min(1, p_i / q_i)
+            p = probs[:, :k].gather(-1, draft_tokens.unsqueeze(-1)).squeeze(-1)
+            q = draft_probs.gather(-1, draft_tokens.unsqueeze(-1)).squeeze(-1)
+            accepted = torch.rand_like(p) * q < p  # (B, k)
+            accepted_len = accepted.int().cumprod(dim=-1).sum(dim=-1)  # (B,)
+            num_accepted += accepted_len.sum().item()
+            num_proposed += B * k
+
+            # Rows advance together. Any row's token at position n is a valid sample of it, be it the accepted draft
+            # token or the resampled one, so stopping every row at the shortest accepted prefix keeps them exact.
+            n = accepted_len.min().item()
+
+            if n == k:
+                next_token = torch.multinomial(probs[:, k], num_samples=1)
+            else:
+                residual = (probs[:, n] - draft_probs[:, n]).clamp(min=0)
+                # p == q leaves nothing to resample from, p is then the right distribution
+                residual = torch.where(
+                    residual.sum(dim=-1, keepdim=True) > 0, residual, probs[:, n]
+                )
+                next_token = torch.multinomial(residual, num_samples=1)
+                next_token = torch.where(
+                    accepted[:, n : n + 1], draft_tokens[:, n : n + 1], next_token
+                )
+
+            idx = torch.cat((idx, draft_tokens[:, :n], next_token), dim=1)
+
+            # Both caches must only hold tokens that were kept, the last token is fed on the next round
+            for kv_cache in kv_caches + draft_kv_caches:
+                kv_cache.crop(idx.shape[1] - 1)
+
+        acceptance_rate = num_accepted / max(num_proposed, 1)
+        return idx[:, :target_len], acceptance_rate
+
+
+class FactorizedGPT(GPT):
+    """
+    GPT over FSQ indices that embeds and predicts every FSQ level separately. The softmaxes cover sum(levels) instead
+    of prod(levels) entries and the levels of a token are sampled independently given the context.
+    Takes and returns the same flat indices as GPT, so it is a drop-in replacement.
+    """
+
+    def __init__(
+        self,
+        context: int,
+        emb_dims: int,
+        levels: "list[int]",
+        num_heads: int,
+        mask: Union[None, torch.Tensor] = None,
+        causal=True,
+        tie_weights=False,
+    ):
+        # Level tables of sum(levels) rows, the flat vocab is only counted
+        super().__init__(
+            context,
+            emb_dims,
+            math.prod(levels),
+            num_heads,
+            mask,
+            causal,
+            tie_weights=tie_weights,
+            num_embeddings=sum(levels),
+        )
+        self.levels = levels
+
+        # Same mixed radix as FSQ.codes_to_indices
+        self.register_buffer("_levels", torch.tensor(levels), persistent=False)
+        _basis = torch.cumprod(torch.tensor([1] + levels[:-1]), dim=0)
+        self.register_buffer("_basis", _basis, persistent=False)
+
+        # Each level owns a slice of the embedding rows and of the logits
+        _offsets = torch.cumsum(torch.tensor([0] + levels[:-1]), dim=0)
+        self.register_buffer("_offsets", _offsets, persistent=False)
+
+    def indices_to_level_indices(self, indices: torch.Tensor):
+        return (indices.unsqueeze(-1) // self._basis) % self._levels
+
+    def level_indices_to_indices(self, level_indices: torch.Tensor):
+        return (level_indices * self._basis).sum(dim=-1)
+
+    def embed_tokens(self, x: torch.Tensor):
+        # (B, C, L, D) -> sum over the levels -> (B, C, D)
+        level_indices = self.indices_to_level_indices(x) + self._offsets
+        return self.token_embedding_table(level_indices).sum(dim=-2)
+
+    def compute_loss(self, logits: torch.Tensor, targets: torch.Tensor):
+        # Sum of the per level losses is the loss of the whole token
+        level_targets = self.indices_to_level_indices(targets)
+        loss = 0
+        for level, level_logits in enumerate(torch.split(logits, self.levels, dim=-1)):
+            loss = loss + functional.cross_entropy(
+                level_logits.reshape(-1, self.levels[level]),
+                level_targets[..., level].reshape(-1),
+            )
+        return loss
+
+    def probs(self, logits: torch.Tensor):
+        # Joint distribution over the flat vocab as a product of the level distributions
+        all_level_indices = self.indices_to_level_indices(
+            torch.arange(self.vocab_size, device=logits.device)
+        )  # (V, L)
+        probs = 1
+        for level, level_logits in enumerate(torch.split(logits, self.levels, dim=-1)):
+            level_probs = functional.softmax(level_logits, dim=-1)
+            probs = probs * level_probs[..., all_level_indices[:, level]]
+        return probs
+
+    def sample_next(self, logits: torch.Tensor):
+        level_indices = [
+            torch.multinomial(functional.softmax(level_logits, dim=-1), num_samples=1)
+            for level_logits in torch.split(logits, self.levels, dim=-1)
+        ]
+        return self.level_indices_to_indices(torch.cat(level_indices, dim=-1)).unsqueeze(-1)
@@ -51,9 +51,17 @@ class PatchToImage(nn.Module):
             output_size=input_res, kernel_size=patch_size, stride=patch_size
         )
 
-    def forward(self, x: torch.Tensor):
+    def forward(self, x: torch.Tensor, output_res: list[int] = None):
         x = self.lin.forward(x)
         x = x.transpose(-1, -2)
+        if output_res is not None:
+            # Any other image resolution
+            return functional.fold(
+                x,
+                output_size=output_res,
+                kernel_size=self.patch_size,
+                stride=self.patch_size,
+            )
         x = self.patcher.forward(x)
         return x
 
@@ -1,3 +1,4 @@
+import os
 from torchvision import transforms, datasets
 
 
@@ -21,3 +22,33 @@ def get_dataset(input_res: list[int], mean: list[float], std: list[float]):
     )
 
     return dataset
+
+
+def get_raw_dataset(input_res: list[int]):
+    """The deterministic part of get_dataset on uint8 (C, H, W) images, what utils/dataset_cache.py stores"""
+    transform = transforms.Compose(
+        [
+            transforms.PILToTensor(),
+            transforms.CenterCrop(size=(178, 178)),
+            transforms.Resize(size=input_res),
+        ]
+    )
+
+    dataset = datasets.CelebA(
+        root="./data",
+        download=True,
+        transform=transform,
+    )
+
+    return dataset
+
+
+def get_image_paths():
+    """Paths of the uncropped images for utils/buckets.py, with 0 labels as the trainers do not use them"""
+    dataset = datasets.CelebA(
+        root="./data",
+        download=True,
+    )
+    image_dir = os.path.join(dataset.root, dataset.base_folder, "img_align_celeba")
+    paths = [os.path.join(image_dir, name) for name in dataset.filename]
+    return paths, [0] * len(paths)
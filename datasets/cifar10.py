@@ -20,3 +20,21 @@ def get_dataset(input_res: list[int], mean: list[float], std: list[float]):
     )
 
     return dataset
+
+
+def get_raw_dataset(input_res: list[int]):
+    """The deterministic part of get_dataset on uint8 (C, H, W) images, what utils/dataset_cache.py stores"""
+    transform = transforms.Compose(
+        [
+            transforms.PILToTensor(),
+            transforms.Resize(size=input_res),
+        ]
+    )
+
+    dataset = datasets.CIFAR10(
+        root="./data",
+        download=True,
+        transform=transform,
+    )
+
+    return dataset
@@ -1,6 +1,6 @@
 import os
 import sys
-from typing import List
+from typing import List, Union
 
 sys.path.append(os.path.abspath("."))
 
@@ -21,6 +21,7 @@ from classes.VIT import (
 from vector_quantize_pytorch import FSQ
 import torch
 import torch.nn as nn
+from utils.index_packing import index_dtype, indices_to_z_q
 
 
 from timm.models.layers import trunc_normal_
@@ -46,6 +47,7 @@ class Model(nn.Module):
         self.num_heads = num_heads
         self.swin_depths = swin_depths
         self.window_size = window_size
+        self.patch_size = patch_size
 
         assert len(num_heads) == len(
             swin_depths
@@ -86,6 +88,7 @@ class Model(nn.Module):
             dim *= 2
 
         self.quantizer = FSQ(levels=codebook_levels, dim=dim)
+        self.latent_res = res
 
         # Decoder Layers
         for idx in range(self.num_layers):
@@ -105,26 +108,74 @@ class Model(nn.Module):
 
         self.apply(self.init_weights)
 
+    @property
+    def downsample_factor(self):
+        """Pixels per latent token along each side"""
+        return self.patch_size * 2**self.num_layers
+
+    def check_res(self, input_res: List[int]):
+        H, W = input_res
+        factor = self.downsample_factor
+        assert (
+            H % factor == 0 and W % factor == 0
+        ), f"Image dimensions must be divisible by patch_size * 2 ** num_layers = {factor}"
+
+    def latent_res_of(self, input_res: List[int]):
+        """Latent grid of an image resolution, every encoder layer halves it"""
+        self.check_res(input_res)
+        res = res_scaler(input_res, 1 / self.patch_size)
+        return res_scaler(res, 1 / (2**self.num_layers))
+
     def encode(self, x: torch.Tensor):
+        """Any (H, W) divisible by patch_size * 2 ** num_layers works, not only input_res"""
+        self.check_res(x.shape[-2:])
+        res = res_scaler(x.shape[-2:], 1 / self.patch_size)
         x = self.patch_embedding.forward(x)
         for layer in self.encoder:
-            x = layer.forward(x)
+            x = layer.forward(x, res)
+            res = res_scaler(res, 1 / 2)
         return x
 
-    def decode(self, z_q: torch.Tensor):
+    def decode(self, z_q: torch.Tensor, latent_res: Union[None, List[int]] = None):
+        """latent_res is the (H, W) grid of z_q, defaults to the one of input_res"""
+        res = latent_res or self.latent_res
         for layer in self.decoder:
-            z_q = layer.forward(z_q)
-        z_q = self.patch_to_image.forward(z_q)
+            z_q = layer.forward(z_q, res)
+            res = res_scaler(res, 2)
+        output_res = None
+        if latent_res is not None:
+            output_res = res_scaler(res, self.patch_size)
+        z_q = self.patch_to_image.forward(z_q, output_res)
         return z_q
 
     def quantize(self, x_enc: torch.Tensor):
         z_q, indices = self.quantizer.forward(x_enc)
         return z_q, indices
 
+    @torch.no_grad()
+    def encode_to_indices(self, x: torch.Tensor, batch_size: Union[None, int] = None):
+        """(B, H_l * W_l) indices in the smallest dtype holding codebook_size, encoding batch_size images at a time"""
+        self.check_res(x.shape[-2:])
+        batch_size = batch_size or x.shape[0]
+        dtype = index_dtype(self.quantizer.codebook_size)
+        return torch.cat(
+            [
+                self.quantize(self.encode(x[idx : idx + batch_size]))[1].to(dtype)
+                for idx in range(0, x.shape[0], batch_size)
+            ]
+        )
+
+    @torch.no_grad()
+    def decode_from_indices(
+        self, indices: torch.Tensor, latent_res: Union[None, List[int]] = None
+    ):
+        """Inverse of encode_to_indices, the codes are gathered from the implicit codebook"""
+        return self.decode(indices_to_z_q(self.quantizer, indices), latent_res)
+
     def forward(self, img: torch.Tensor):
         x_enc = self.encode(img)  # Encoder
         z_q, indices = self.quantize(x_enc)  # Scalar Quantizer
-        recon_imgs = self.decode(z_q)  # Decoder
+        recon_imgs = self.decode(z_q, self.latent_res_of(img.shape[-2:]))  # Decoder
         loss = torch.tensor(data=0)  # To mimic the VQ loss which does not exists in FSQ
         return recon_imgs, indices, loss
 
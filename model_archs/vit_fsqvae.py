@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Union
 from classes.Swin import res_scaler
 from classes.VIT import (
     ViTEncoder,
@@ -7,6 +7,7 @@ from classes.VIT import (
 
 
 from classes.FSQ import FSQ
+from utils.index_packing import index_dtype, indices_to_z_q
 import math
 import torch
 import torch.nn as nn
@@ -82,6 +83,23 @@ class Model(nn.Module):
     def quantize(self, x_enc: torch.Tensor):
         return self.quantizer.forward(x_enc)
 
+    @torch.no_grad()
+    def encode_to_indices(self, x: torch.Tensor, batch_size: Union[None, int] = None):
+        """(B, L) indices in the smallest dtype holding codebook_size, encoding batch_size images at a time"""
+        batch_size = batch_size or x.shape[0]
+        dtype = index_dtype(self.quantizer.codebook_size)
+        return torch.cat(
+            [
+                self.quantize(self.encode(x[idx : idx + batch_size]))[1].to(dtype)
+                for idx in range(0, x.shape[0], batch_size)
+            ]
+        )
+
+    @torch.no_grad()
+    def decode_from_indices(self, indices: torch.Tensor):
+        """Inverse of encode_to_indices, the codes are gathered from the implicit codebook"""
+        return self.decode(indices_to_z_q(self.quantizer, indices))
+
     def forward(self, x: torch.Tensor):
         x_enc = self.encode(x)  # Encoder
         z_q, indices = self.quantize(x_enc)  # Scalar Quantizer
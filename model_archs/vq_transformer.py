@@ -1,14 +1,31 @@
 import torch
 import torch.nn as nn
+from torch.nn import functional
+import math
 import os
 import sys
 
 sys.path.append(os.path.abspath("."))
-from classes.Transformers import GPT
+from classes.Transformers import GPT, FactorizedGPT
 from classes.Swin import res_scaler
 
 
 class Model(nn.Module):
+    """
+    Args:
+        vq_model (nn.Module): Frozen tokenizer whose indices are modelled,
+        dim (int): Transformer embedding dimension,
+        num_heads (int): Number of attention heads,
+        num_codebook_embeddings (int): Codebook size of the tokenizer,
+        keep_prob (float): Probability of keeping a token when noising the inputs,
+        decoding (str): "autoregressive" for left to right sampling or "maskgit" for bidirectional masked token prediction with parallel decoding,
+        num_decoding_steps (int): Number of parallel decoding steps for "maskgit",
+        factorized (bool): Embed and predict each FSQ level separately, needs codebook_levels,
+        codebook_levels (List[int]): FSQ levels of the tokenizer,
+        loss_chunk_size (int): Compute the autoregressive loss in chunks of this many tokens without materializing the logits,
+        tie_weights (bool): Share the head weight with the token embedding
+    """
+
     def __init__(
         self,
         vq_model: nn.Module,
@@ -16,46 +33,82 @@ class Model(nn.Module):
         num_heads: int,
         num_codebook_embeddings: int,
         keep_prob=0.8,
+        decoding="autoregressive",
+        num_decoding_steps=12,
+        factorized=False,
+        codebook_levels=None,
+        loss_chunk_size=None,
+        tie_weights=False,
         **kwargs,
     ):
         super().__init__()
+        assert decoding in [
+            "autoregressive",
+            "maskgit",
+        ], "decoding must be autoregressive or maskgit"
+
         self.keep_prob = keep_prob
         self.embed_dim = dim
         self.num_codebook_embeddings = num_codebook_embeddings
         self.num_heads = num_heads
         self.vq_model = vq_model
+        self.decoding = decoding
+        self.num_decoding_steps = num_decoding_steps
         self.patch_res = res_scaler(
             self.vq_model.init_patch_res, 1 / (2**self.vq_model.num_layers)
         )
         H, W = self.patch_res
         self.num_patches = H * W
 
-        self.transformer = GPT(
-            context=512,
-            emb_dims=dim,
-            vocab_size=num_codebook_embeddings,
-            num_heads=num_heads,
-        )
+        # The masked token gets the id right after the codebook
+        self.mask_token_id = num_codebook_embeddings
+        is_maskgit = decoding == "maskgit"
+
+        if factorized:
+            assert not is_maskgit, "factorized is only supported for autoregressive"
+            assert codebook_levels is not None, "factorized needs codebook_levels"
+            assert not loss_chunk_size, "loss_chunk_size is not supported with factorized"
+            assert (
+                math.prod(codebook_levels) == num_codebook_embeddings
+            ), "prod(codebook_levels) must equal num_codebook_embeddings"
+            self.transformer = FactorizedGPT(
+                context=512,
+                emb_dims=dim,
+                levels=codebook_levels,
+                num_heads=num_heads,
+                tie_weights=tie_weights,
+            )
+        else:
+            self.transformer = GPT(
+                context=512,
+                emb_dims=dim,
+                vocab_size=num_codebook_embeddings + int(is_maskgit),
+                num_heads=num_heads,
+                causal=not is_maskgit,
+                loss_chunk_size=None if is_maskgit else loss_chunk_size,
+                tie_weights=tie_weights,
+            )
 
     def forward(self, x: torch.Tensor):
+        # Integer inputs are already indices, e.g. batches of a token cache
+        if not torch.is_floating_point(x):
+            return self.forward_indices(x)
+
         x_enc = self.vq_model.encode(x)
         B, C, D = x_enc.shape
-        z_q, indices, loss = self.vq_model.quantize(x_enc)
+        indices = self.vq_model.quantize(x_enc)[1]
+        return self.forward_indices(indices.view(B, -1))
 
-        # print(z_q.shape, indices.shape)
+    def forward_indices(self, indices: torch.Tensor):
+        """Training step from (B, L) tokenizer indices, e.g. read from a token cache (utils/token_cache.py)"""
+        B = indices.shape[0]
 
         # Indices will be fed to the transformer for prediction
-        indices = indices.view(B, -1)
-        # print(indices.shape)
+        indices = indices.view(B, -1).long()
 
         # Base indices are also the target for when predicting from noisy indices
         target = indices
 
-        # Start token so that the Transformer always has a token when generating
-        start_tokens = (
-            torch.ones(size=[B, 1], dtype=torch.long, device=indices.device) * 0
-        )
-
         mask = torch.bernoulli(self.keep_prob * torch.ones(indices.shape)).to(
             indices.device
         )
@@ -66,48 +119,106 @@ class Model(nn.Module):
         )
 
         noised_indices = mask * indices + (1 - mask) * random_indices
+
+        if self.decoding == "maskgit":
+            return self.masked_forward(noised_indices, target)
+
+        # Start token so that the Transformer always has a token when generating
+        start_tokens = (
+            torch.ones(size=[B, 1], dtype=torch.long, device=indices.device) * 0
+        )
         noised_indices = torch.cat((start_tokens, noised_indices), dim=1)[:, :-1]
 
         logits, loss = self.transformer.forward(noised_indices, target)
 
         return logits, loss
 
-    @torch.no_grad()
-    def sample(self, num_samples=16):
-
-        device = f"cuda:{torch.cuda.current_device()}"
+    def masked_forward(self, noised_indices: torch.Tensor, target: torch.Tensor):
+        B, N = noised_indices.shape
 
-        start_tokens = (
-            torch.ones(size=[num_samples, 1], dtype=torch.long, device=device) * 0
+        # Cosine schedule over the fraction of masked tokens, same as used while decoding
+        ratio = torch.cos(
+            math.pi / 2 * torch.rand(size=[B, 1], device=noised_indices.device)
         )
+        num_masked = (ratio * N).ceil().clamp(min=1)
 
-        indices = self.transformer.generate(start_tokens, 512)[:, 1:]
-        indices = indices.reshape(-1, 1)
+        # Mask the num_masked tokens with the lowest random scores
+        scores = torch.rand(size=[B, N], device=noised_indices.device)
+        ranks = scores.argsort(dim=-1).argsort(dim=-1)
+        is_masked = ranks < num_masked
 
-        encodings = torch.zeros(indices.shape[0], self.num_embeddings, device=device)
-        encodings.scatter_(1, indices, 1)
+        masked_indices = noised_indices.masked_fill(is_masked, self.mask_token_id)
+        logits, _ = self.transformer.forward(masked_indices)
 
-        # Quantize and unflatten
-        quantized = torch.matmul(encodings, self.embedding.weight).view(
-            size=(num_samples, patch_H * patch_W, 256)
-        )
-        quantized = quantized.permute(0, 3, 1, 2).contiguous()
+        # Loss only over the masked positions
+        loss = functional.cross_entropy(logits[is_masked], target[is_masked])
 
-        patch_H, patch_W = res_scaler(
-            self.vq_model.init_patch_res, 1 / (2**self.vq_model.num_layers)
+        return logits, loss
+
+    @torch.no_grad()
+    def maskgit_generate(self, num_samples: int, num_steps: int, temperature=1.0):
+        """
+        Starts from all tokens masked and at every step samples all of them in parallel, keeping the most confident
+        ones. The number of tokens left masked follows the cosine schedule and hits zero on the last step.
+        """
+        N = self.num_patches
+        assert 1 <= num_steps <= N, f"num_steps must be in 1-{N}"
+        device = next(self.parameters()).device
+
+        indices = torch.full(
+            size=[num_samples, N], fill_value=self.mask_token_id, device=device
         )
 
-        # z_q = self.vq_model.vq.embedding.forward(indices).view(
-        #     size=(num_samples, patch_H * patch_W, 256)
-        # )
+        for step in range(num_steps):
+            logits, _ = self.transformer.forward(indices)
+
+            # Never predict the mask token
+            logits[..., self.mask_token_id] = -torch.inf
+            probs = functional.softmax(logits / temperature, dim=-1)  # (B, N, V)
+
+            sampled = torch.multinomial(probs.view(num_samples * N, -1), 1)
+            sampled = sampled.view(num_samples, N)
+            confidence = probs.gather(-1, sampled.unsqueeze(-1)).squeeze(-1)
+
+            # Already decoded tokens stay fixed
+            is_masked = indices == self.mask_token_id
+            sampled = torch.where(is_masked, sampled, indices)
+            confidence = torch.where(is_masked, confidence, torch.inf)
+
+            # Number of tokens left masked after this step, at least one gets decoded
+            ratio = math.cos(math.pi / 2 * (step + 1) / num_steps)
+            num_masked = torch.clamp(
+                is_masked.sum(dim=-1, keepdim=True) - 1, min=0, max=math.floor(N * ratio)
+            )
+
+            # Re-mask the least confident tokens
+            ranks = confidence.argsort(dim=-1).argsort(dim=-1)
+            indices = sampled.masked_fill(ranks < num_masked, self.mask_token_id)
+
+        return indices
+
+    def indices_to_z_q(self, indices: torch.Tensor):
+        quantizer = self.vq_model.quantizer
+        # FSQ
+        if hasattr(quantizer, "indices_to_codes"):
+            return quantizer.indices_to_codes(indices)
+        return quantizer.get_output_from_indices(indices)
+
+    @torch.no_grad()
+    def sample(self, num_samples=16, num_steps=None):
+
+        device = next(self.parameters()).device
 
-        # z_q = z_q.permute(0, 3, 1, 2)  # (B, D, H, W)
+        if self.decoding == "maskgit":
+            indices = self.maskgit_generate(
+                num_samples, num_steps or self.num_decoding_steps
+            )
+        else:
+            start_tokens = (
+                torch.ones(size=[num_samples, 1], dtype=torch.long, device=device) * 0
+            )
+            indices = self.transformer.generate(start_tokens, self.num_patches)[:, 1:]
 
-        # z_q = z_q.view(
-        #     num_samples,
-        #     self.embed_dim,
-        # ).transpose(
-        #     -2, -1
-        # )  # (B, D, C) -> [after transpose] -> (B, C, D)
+        z_q = self.indices_to_z_q(indices)  # (B, C, D)
         recon_imgs = self.vq_model.decode(z_q)
         return recon_imgs
@@ -0,0 +1,2 @@
+python trainers/cache_tokens.py \
+    --config_file "./configs/train-config.json"
\ No newline at end of file
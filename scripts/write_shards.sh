@@ -0,0 +1,3 @@
+python trainers/write_shards.py \
+    --image_dir "./data/images" \
+    --shard_dir "./data/shards"
\ No newline at end of file
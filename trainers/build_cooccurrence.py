@@ -0,0 +1,30 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import argparse
+import json
+from utils.cooccurrence import build_co_occurrence
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--corpus_dir", type=str, required=True, help="Corpus of utils/text_corpus.py")
+    arg_parser.add_argument("--out_dir", type=str, required=True)
+    arg_parser.add_argument("--window_size", type=int, default=10)
+    arg_parser.add_argument("--num_workers", type=int, default=os.cpu_count())
+    arg_parser.add_argument("--memory_cap", type=int, default=2**30, help="Bytes")
+    arg_parser.add_argument("--spill_dir", type=str, default=None)
+    args = vars(arg_parser.parse_args())
+
+    manifest = json.load(open(os.path.join(args["corpus_dir"], "manifest.json")))
+    co_occurrence = build_co_occurrence(
+        os.path.join(args["corpus_dir"], "tokens.npy"),
+        manifest["vocab_size"],
+        window_size=args["window_size"],
+        num_workers=args["num_workers"],
+        memory_cap=args["memory_cap"],
+        out_dir=args["out_dir"],
+        spill_dir=args["spill_dir"],
+    )
+    print(f"{co_occurrence.nnz} non zero co-occurrences of {manifest['vocab_size']} words in {args['out_dir']}")
@@ -0,0 +1,30 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import argparse
+import json
+from utils.token_cache import build_token_cache
+
+
+def main(config: dict):
+    cache_dir = config["token_cache_dir"]
+    num_workers = "tokenizer_workers" in config and config["tokenizer_workers"] or None
+    manifest = build_token_cache(cache_dir, config, num_workers=num_workers)
+    print(
+        f"Cached {manifest['num_images']} x {manifest['num_tokens']} tokens ({manifest['dtype']}) in {cache_dir}"
+    )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument(
+        "--config_file",
+        type=str,
+        required=True,
+        help="Path to the config JSON file",
+    )
+    args = vars(arg_parser.parse_args())
+    config_file = open(file=args["config_file"], mode="r")
+    config = json.load(config_file)
+    main(config)
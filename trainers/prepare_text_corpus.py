@@ -0,0 +1,33 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import argparse
+from utils.text_corpus import prepare_text_corpus
+from classes.BPE import BPETokenizer
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("paths", type=str, nargs="+", help="Text files to tokenize")
+    arg_parser.add_argument("--corpus_dir", type=str, required=True)
+    arg_parser.add_argument("--bpe_path", type=str, default=None, help="BPETokenizer to use instead of chars")
+    arg_parser.add_argument("--bpe_vocab_size", type=int, default=None, help="Train a BPETokenizer of this size on the files first, saved to bpe_path")
+    arg_parser.add_argument("--num_workers", type=int, default=None)
+    arg_parser.add_argument("--chunk_bytes", type=int, default=16 * 2**20)
+    args = vars(arg_parser.parse_args())
+    if args["bpe_vocab_size"]:
+        assert args["bpe_path"], "--bpe_vocab_size needs --bpe_path to save the tokenizer to"
+        texts = (open(path, encoding="utf-8").read() for path in args["paths"])
+        BPETokenizer.train(texts, args["bpe_vocab_size"]).save(args["bpe_path"])
+
+    manifest = prepare_text_corpus(
+        args["paths"],
+        args["corpus_dir"],
+        bpe_path=args["bpe_path"],
+        num_workers=args["num_workers"],
+        chunk_bytes=args["chunk_bytes"],
+    )
+    print(
+        f"{manifest['num_tokens']} tokens, vocab of {manifest['vocab_size']} ({manifest['dtype']}) in {args['corpus_dir']}"
+    )
@@ -4,15 +4,21 @@ import sys
 sys.path.append(os.path.abspath("."))
 import torch
 import torch.nn as nn
-from utils.logger import Logger
+from utils.metrics import MetricsWriter, metrics_path
 from utils.get_recons import get_recons
 from utils.get_dataset import get_dataset
+from utils.loader_state import LoaderState, ResumableRandomSampler, get_resumable
+from utils.shards import ShardedImageDataset, get_sharded_loader
+from utils.dataset_cache import get_cached_dataset, get_cached_loader
+from classes.Attention import set_attention_backend
+from classes.Augmentation import BatchAugmentation
 from classes.TiTok import TiTokTokenizer
 from utils.get_optimizer import get_optimizer
 import math
 from tqdm.auto import tqdm
 from torch.utils.data import DataLoader
 from accelerate import Accelerator, DistributedDataParallelKwargs
+from accelerate.utils import DataLoaderConfiguration
 import argparse
 import json
 import wandb
@@ -32,12 +38,18 @@ def main(config: dict):
         project_dir=model_dir,
         log_with="wandb",
         gradient_accumulation_steps=config["gradient_accumulation_steps"],
+        # Every rank reads its own batches, ShardedImageDataset relies on it
+        dataloader_config=DataLoaderConfiguration(dispatch_batches=False),
         kwargs_handlers=[ddp_kwargs],
     )
 
     # Print the config file
     accelerator.print(config)
 
+    # Attention implementation used by every transformer module
+    if "attention_backend" in config:
+        set_attention_backend(config["attention_backend"])
+
     if config["tracking"]:
         accelerator.init_trackers(
             project_name="VQ-Models",
@@ -52,26 +64,54 @@ def main(config: dict):
 
     if accelerator.is_main_process:
         os.makedirs(name=model_dir, exist_ok=True)
-        logger = Logger(os.path.join(model_dir, "log.txt"))
+        metrics_format = config["metrics_format"] if "metrics_format" in config else "jsonl"
+        metrics = MetricsWriter(metrics_path(model_dir, metrics_format), format=metrics_format)
 
     epochs = config["epochs"]
     batch_size = config["batch_size"]
 
     # Dataset and Dataloaders
+    num_workers = config["num_workers"] if "num_workers" in config else min(8, os.cpu_count())
 
-    train_dataset = get_dataset(
-        config["dataset"],
-        config["input_res"],
-        config["dataset_mean"],
-        config["dataset_std"],
-    )
+    # Shards written by trainers/write_shards.py are streamed, each rank and worker reading its own shards
+    if "shard_dir" in config and config["shard_dir"]:
+        train_dataset = ShardedImageDataset(
+            config["shard_dir"],
+            config["input_res"],
+            config["dataset_mean"],
+            config["dataset_std"],
+            batch_size,
+            num_workers,
+        )
+        train_loader = get_sharded_loader(train_dataset)
+    # With a dataset cache the resized uint8 images are read in contiguous batches and normalized at once
+    elif "dataset_cache_dir" in config and config["dataset_cache_dir"]:
+        with accelerator.main_process_first():
+            train_dataset = get_cached_dataset(config, num_workers)
+        train_loader = get_cached_loader(train_dataset, batch_size, num_workers)
+    else:
+        train_dataset = get_dataset(
+            config["dataset"],
+            config["input_res"],
+            config["dataset_mean"],
+            config["dataset_std"],
+        )
 
-    train_loader = DataLoader(
-        dataset=train_dataset,
-        batch_size=batch_size,
-        shuffle=True,
-        drop_last=True,
-    )
+        train_loader = DataLoader(
+            dataset=train_dataset,
+            batch_size=batch_size,
+            sampler=ResumableRandomSampler(len(train_dataset), batch_size),
+            drop_last=True,
+            num_workers=num_workers,
+            persistent_workers=num_workers > 0,
+        )
+
+    # Random augmentation of whole batches on the device, after collation
+    augment = None
+    if "augmentation" in config and config["augmentation"]:
+        augment = BatchAugmentation(
+            config["dataset_mean"], config["dataset_std"], **config["augmentation"]
+        ).to(accelerator.device)
 
     # Model
     model = TiTokTokenizer(
@@ -105,14 +145,19 @@ def main(config: dict):
     # Optimizers
     optim = get_optimizer(config["optimizer"])(model.parameters(), lr=config["lr"])
 
+    # Position in the data, saved with every checkpoint so training resumes at the next batch
+    loader_state = LoaderState(get_resumable(train_loader), accelerator.num_processes)
+
     # Acceleration :P
     train_loader = accelerator.prepare_data_loader(data_loader=train_loader)
     model = accelerator.prepare_model(model=model)
     optim = accelerator.prepare_optimizer(optimizer=optim)
+    accelerator.register_for_checkpointing(loader_state)
 
     # Load a state from checkpoint if required
     if config["state_from_checkpoint"]:
         accelerator.load_state(input_dir=config["state_checkpoint_path"])
+        loader_state.resume(train_loader)
         accelerator.print(
             "State loaded from checkpoint: ", config["state_checkpoint_path"]
         )
@@ -124,28 +169,38 @@ def main(config: dict):
     )
 
     if accelerator.is_main_process:
-        progress_bar = tqdm(range(epochs * len(train_loader)))
+        progress_bar = tqdm(range(epochs * len(train_loader)), initial=loader_state.total_steps)
 
-    total_steps = 0
+    total_steps = loader_state.total_steps
     total_loss = 0
+    start_epoch, start_batch = loader_state.epoch, loader_state.batch
 
-    for epoch in range(epochs):
+    for epoch in range(start_epoch, epochs):
         epoch_loss = 0
-        for step, batch in enumerate(train_loader):
+        # A resumed epoch starts after the batches it already consumed
+        first_batch = start_batch if epoch == start_epoch else 0
+        for step, batch in enumerate(train_loader, start=first_batch):
             with accelerator.accumulate(model):
                 x, y = batch
+                if augment is not None:
+                    x = augment(x)
 
                 # evaluate the loss
                 recon, codebook_indices, q_loss = model.forward(x)
                 recon_loss = nn.functional.mse_loss(x, recon)
                 loss: torch.Tensor = recon_loss
-                epoch_loss += loss.detach().item()
+                # Summed on the device, read once per epoch
+                epoch_loss += loss.detach()
                 optim.zero_grad()
                 accelerator.backward(loss)
                 optim.step()
                 total_steps += 1
 
-                accelerator.log({"train_loss": loss}, step=total_steps)
+                if accelerator.is_main_process:
+                    averages = metrics.log({"train_loss": loss}, step=total_steps)
+                    # Averages over flush_every steps, the tracker never reads the loss off the device itself
+                    if averages:
+                        accelerator.log(averages, step=total_steps)
 
                 if total_steps % checkpoint_step == 0:
                     ckpt_dir = os.path.join(model_dir, "checkpoints", f"{total_steps}")
@@ -166,6 +221,7 @@ def main(config: dict):
                             ),
                         }
                     )
+                    loader_state.update(epoch, step + 1, total_steps)
                     accelerator.save_state(
                         ckpt_dir,
                         safe_serialization=False,
@@ -174,10 +230,22 @@ def main(config: dict):
                 if accelerator.is_main_process:
                     progress_bar.update(1)
 
+        epoch_loss = float(epoch_loss)
         total_loss += epoch_loss
         if accelerator.is_main_process:
-            epoch_loss_log = f"Epoch: {epoch}, Avg Epoch Loss {epoch_loss / (step + 1)}, Net Avg Loss: {total_loss / (total_steps + 1)}"
-            logger.log(epoch_loss_log)
+            metrics.log(
+                {
+                    "epoch": epoch,
+                    "avg_epoch_loss": epoch_loss / (step + 1 - first_batch),
+                    "net_avg_loss": total_loss / (total_steps + 1),
+                },
+                step=total_steps,
+            )
+
+    if accelerator.is_main_process:
+        averages = metrics.close()
+        if averages:
+            accelerator.log(averages, step=total_steps)
 
     accelerator.wait_for_everyone()
     accelerator.end_training()
@@ -1,58 +1,101 @@
 import os
 import sys
 import torch
-from torch import nn
 import numpy as np
+import argparse
+import time
 
 sys.path.append(os.path.abspath("."))
-from classes.GloVe import GloVe, create_co_occurrence_matrix
+from classes.GloVe import GloVe
+from utils.cooccurrence import build_co_occurrence, SparseCoOccurrence
 
-# Sample text corpus
+# Sample text corpus, used when no co-occurrence matrix is given
 corpus = ["the", "quick", "brown", "fox", "jumped", "over", "the", "lazy", "dog"]
 
-# Define vocabulary and create word-to-index mapping
-vocab = set(corpus)
-word_to_index = {word: i for i, word in enumerate(vocab)}
-index_to_word = {i: word for word, i in word_to_index.items()}
-vocab_size = len(vocab)
-
-# Hyperparameters
-embedding_dim = 50
-window_size = 2
-learning_rate = 0.01
-num_epochs = 100
-
-# Create co-occurrence matrix
-co_occurrence_matrix = create_co_occurrence_matrix(corpus, window_size, vocab_size)
-
-# Convert co-occurrence matrix to PyTorch tensors
-i_indices, j_indices = np.nonzero(co_occurrence_matrix)
-i_indices = torch.LongTensor(i_indices)
-j_indices = torch.LongTensor(j_indices)
-co_occurrences = torch.FloatTensor(
-    co_occurrence_matrix[np.nonzero(co_occurrence_matrix)]
-)
-
-# Define GloVe model
-model = GloVe(vocab_size, embedding_dim)
-
-# Define loss function and optimizer
-criterion = nn.MSELoss()
-optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
-
-# Training loop
-for epoch in range(num_epochs):
-    optimizer.zero_grad()
-    output1, output2 = model(i_indices, j_indices)
-    loss = criterion(output1, co_occurrences) + criterion(output2, co_occurrences)
-    loss.backward()
-    optimizer.step()
-    if (epoch + 1) % 10 == 0:
-        print(f"Epoch [{epoch+1}/{num_epochs}], Loss: {loss.item():.4f}")
-
-# Get word embeddings
-embeddings = model.embedding.weight.data.numpy()
-
-# Print word embeddings
-for i, embedding in enumerate(embeddings):
-    print(f"{index_to_word[i]}: {embedding}")
+
+def get_optimizer(name: str, model: GloVe, lr: float):
+    # Both only update the rows present in the sparse gradients
+    if name == "sparse_adam":
+        return torch.optim.SparseAdam(list(model.parameters()), lr=lr)
+    elif name == "adagrad":
+        return torch.optim.Adagrad(model.parameters(), lr=lr)
+    raise ValueError(f"Unknown optimizer: {name}, must be sparse_adam or adagrad")
+
+
+def main(args: dict):
+    torch.manual_seed(args["seed"])
+    torch.set_num_threads(args["num_threads"])
+
+    if args["cooccurrence_dir"]:
+        co_occurrence = SparseCoOccurrence.load(args["cooccurrence_dir"])
+        index_to_word = None
+    else:
+        # Define vocabulary and create word-to-index mapping
+        vocab = sorted(set(corpus))
+        word_to_index = {word: i for i, word in enumerate(vocab)}
+        index_to_word = {i: word for word, i in word_to_index.items()}
+        co_occurrence = build_co_occurrence(
+            np.array([word_to_index[word] for word in corpus]), len(vocab), window_size=2
+        )
+
+    # Non zero (i, j, X_ij) entries, the only ones in the loss, copied out of the memory mapped arrays
+    i_indices, j_indices, co_occurrences = (
+        torch.from_numpy(np.array(array)) for array in co_occurrence.to_coo()
+    )
+    co_occurrences = co_occurrences.float()
+    nnz = co_occurrence.nnz
+    print(f"{co_occurrence.vocab_size} words, {nnz} non zero co-occurrences")
+
+    model = GloVe(co_occurrence.vocab_size, args["embedding_dim"])
+    optimizer = get_optimizer(args["optimizer"], model, args["lr"])
+    batch_size = args["batch_size"]
+
+    for epoch in range(args["epochs"]):
+        start = time.perf_counter()
+        epoch_loss = 0
+        # Shuffled mini-batches of entries, every entry once per epoch
+        permutation = torch.randperm(nnz)
+        for batch_start in range(0, nnz, batch_size):
+            batch = permutation[batch_start : batch_start + batch_size]
+            loss = model.loss(
+                i_indices[batch],
+                j_indices[batch],
+                co_occurrences[batch],
+                x_max=args["x_max"],
+                alpha=args["alpha"],
+            )
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            epoch_loss += loss.item() * len(batch)
+
+        elapsed = time.perf_counter() - start
+        print(
+            f"Epoch [{epoch+1}/{args['epochs']}], Loss: {epoch_loss / nnz:.4f}, {nnz / elapsed:.0f} pairs/sec"
+        )
+
+    # Get word embeddings
+    embeddings = model.embeddings().numpy()
+    if args["out_path"]:
+        np.save(args["out_path"], embeddings)
+
+    # Print word embeddings
+    if index_to_word is not None:
+        for i, embedding in enumerate(embeddings):
+            print(f"{index_to_word[i]}: {embedding[:4]}")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--cooccurrence_dir", type=str, default=None, help="Output of trainers/build_cooccurrence.py")
+    arg_parser.add_argument("--out_path", type=str, default=None, help=".npy to save the (vocab_size, embedding_dim) embeddings to")
+    arg_parser.add_argument("--embedding_dim", type=int, default=50)
+    arg_parser.add_argument("--batch_size", type=int, default=4096)
+    arg_parser.add_argument("--epochs", type=int, default=100)
+    arg_parser.add_argument("--lr", type=float, default=0.05)
+    arg_parser.add_argument("--optimizer", type=str, default="adagrad", choices=["sparse_adam", "adagrad"])
+    arg_parser.add_argument("--x_max", type=float, default=100.0)
+    arg_parser.add_argument("--alpha", type=float, default=0.75)
+    arg_parser.add_argument("--num_threads", type=int, default=os.cpu_count())
+    arg_parser.add_argument("--seed", type=int, default=0)
+    main(vars(arg_parser.parse_args()))
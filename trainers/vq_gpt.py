@@ -4,13 +4,21 @@ import sys
 sys.path.append(os.path.abspath("."))
 import torch
 import torch.nn as nn
-from utils.logger import Logger
+from utils.metrics import MetricsWriter, metrics_path
 from utils.get_recons import get_recons
 from utils.get_dataset import get_dataset
+from utils.loader_state import LoaderState, ResumableRandomSampler, get_resumable
+from utils.shards import ShardedImageDataset, get_sharded_loader
+from utils.dataset_cache import CachedImageDataset, get_cached_dataset, get_cached_loader
+from utils.get_model_arch import get_model_arch
+from utils.token_cache import TokenCacheDataset
+from classes.Attention import set_attention_backend
+from classes.Augmentation import BatchAugmentation
 import math
 from tqdm.auto import tqdm
 from torch.utils.data import DataLoader
 from accelerate import Accelerator, DistributedDataParallelKwargs
+from accelerate.utils import DataLoaderConfiguration
 import argparse
 import json
 import wandb
@@ -25,11 +33,17 @@ def main(config: dict):
         project_dir=model_dir,
         log_with="wandb",
         gradient_accumulation_steps=config["gradient_accumulation_steps"],
+        # Every rank reads its own batches, ShardedImageDataset relies on it
+        dataloader_config=DataLoaderConfiguration(dispatch_batches=False),
     )
 
     # Print the config file
     accelerator.print(config)
 
+    # Attention implementation used by every transformer module
+    if "attention_backend" in config:
+        set_attention_backend(config["attention_backend"])
+
     accelerator.init_trackers(
         project_name="VQ-Models",
         config=config,
@@ -43,22 +57,68 @@ def main(config: dict):
 
     if accelerator.is_main_process:
         os.makedirs(name=os.path.join(model_dir, "gpt"), exist_ok=True)
-        logger = Logger(os.path.join(model_dir, "gpt", "log.txt"))
+        metrics_format = config["metrics_format"] if "metrics_format" in config else "jsonl"
+        metrics = MetricsWriter(metrics_path(os.path.join(model_dir, "gpt"), metrics_format), format=metrics_format)
 
     epochs = config["epochs"]
     batch_size = config["batch_size"]
 
     # Dataset and Dataloaders
-    train_dataset = get_dataset(config["dataset"], config["input_res"])
+    num_workers = config["num_workers"] if "num_workers" in config else min(8, os.cpu_count())
+
+    # With a token cache (trainers/cache_tokens.py) the frozen tokenizer never runs during training
+    use_token_cache = "token_cache_dir" in config and config["token_cache_dir"]
+    if use_token_cache:
+        train_dataset = TokenCacheDataset(config["token_cache_dir"])
+        manifest = train_dataset.manifest
+        assert (
+            manifest["model_arch"] == config["model_arch"]
+            and manifest["dataset"] == config["dataset"]
+            and manifest["input_res"] == config["input_res"]
+            and manifest["model_checkpoint_path"] == config.get("model_checkpoint_path")
+        ), "Token cache was built for another tokenizer or dataset"
+    elif "shard_dir" in config and config["shard_dir"]:
+        train_dataset = ShardedImageDataset(
+            config["shard_dir"],
+            config["input_res"],
+            config["dataset_mean"],
+            config["dataset_std"],
+            batch_size,
+            num_workers,
+        )
+    elif "dataset_cache_dir" in config and config["dataset_cache_dir"]:
+        with accelerator.main_process_first():
+            train_dataset = get_cached_dataset(config, num_workers)
+    else:
+        train_dataset = get_dataset(
+            config["dataset"],
+            config["input_res"],
+            config["dataset_mean"],
+            config["dataset_std"],
+        )
 
-    train_loader = DataLoader(
-        dataset=train_dataset,
-        batch_size=batch_size,
-        shuffle=True,
-    )
+    if isinstance(train_dataset, ShardedImageDataset):
+        train_loader = get_sharded_loader(train_dataset)
+    elif isinstance(train_dataset, CachedImageDataset):
+        train_loader = get_cached_loader(train_dataset, batch_size, num_workers)
+    else:
+        train_loader = DataLoader(
+            dataset=train_dataset,
+            batch_size=batch_size,
+            sampler=ResumableRandomSampler(len(train_dataset), batch_size),
+            num_workers=num_workers,
+            persistent_workers=num_workers > 0,
+        )
+
+    # Random augmentation of whole batches on the device, after collation
+    augment = None
+    if not use_token_cache and "augmentation" in config and config["augmentation"]:
+        augment = BatchAugmentation(
+            config["dataset_mean"], config["dataset_std"], **config["augmentation"]
+        ).to(accelerator.device)
 
     # Model
-    model = ViT_PatchMergeExpand(**config)
+    model = get_model_arch(config["model_arch"])(**config)
 
     # Print # of model parameters
     accelerator.print(
@@ -67,13 +127,21 @@ def main(config: dict):
 
     # Load a model checkpoint
     if config["model_from_checkpoint"]:
-
+        model.load_state_dict(torch.load(f=config["model_checkpoint_path"]))
         accelerator.print(
             "Model loaded from checkpoint: ", config["model_checkpoint_path"]
         )
 
+    # The tokenizer is frozen, it only encodes images (without a token cache) and decodes samples
+    model.eval()
+    for param in model.parameters():
+        param.requires_grad = False
+
+    if "num_codebook_embeddings" not in config:
+        config["num_codebook_embeddings"] = model.quantizer.codebook_size
+
     # GPT
-    gpt = VQTransformer(vq_model=model, **config)
+    gpt = get_model_arch("vq_transformer")(vq_model=model, **config)
 
     # Print # of GPT parameters
     accelerator.print(
@@ -89,17 +157,22 @@ def main(config: dict):
     # Optimizers
     optim = torch.optim.AdamW(gpt.parameters(), lr=config["lr"])
 
-    # Load a state from checkpoint if required
-    if config["state_from_checkpoint"]:
-        accelerator.load_state(input_dir=config["state_checkpoint_path"])
-        accelerator.print(
-            "State loaded from checkpoint: ", config["state_checkpoint_path"]
-        )
+    # Position in the data, saved with every checkpoint so training resumes at the next batch
+    loader_state = LoaderState(get_resumable(train_loader), accelerator.num_processes)
 
     # Acceleration :P
     train_loader = accelerator.prepare_data_loader(data_loader=train_loader)
     gpt = accelerator.prepare_model(model=gpt)
     optim = accelerator.prepare_optimizer(optimizer=optim)
+    accelerator.register_for_checkpointing(loader_state)
+
+    # Load a state from checkpoint if required
+    if "state_from_checkpoint" in config and config["state_from_checkpoint"]:
+        accelerator.load_state(input_dir=config["state_checkpoint_path"])
+        loader_state.resume(train_loader)
+        accelerator.print(
+            "State loaded from checkpoint: ", config["state_checkpoint_path"]
+        )
 
     total_steps = epochs * len(train_loader)
     checkpoint_step = total_steps // config["num_checkpoints"]
@@ -108,26 +181,37 @@ def main(config: dict):
     )
 
     if accelerator.is_main_process:
-        progress_bar = tqdm(range(epochs * len(train_loader)))
+        progress_bar = tqdm(range(epochs * len(train_loader)), initial=loader_state.total_steps)
 
-    total_steps = 0
+    total_steps = loader_state.total_steps
     total_loss = 0
+    start_epoch, start_batch = loader_state.epoch, loader_state.batch
 
-    for epoch in range(epochs):
+    for epoch in range(start_epoch, epochs):
         epoch_loss = 0
-        for step, batch in enumerate(train_loader):
+        # A resumed epoch starts after the batches it already consumed
+        first_batch = start_batch if epoch == start_epoch else 0
+        for step, batch in enumerate(train_loader, start=first_batch):
             with accelerator.accumulate(gpt):
-                x, y = batch
+                # Token cache batches are (B, L) indices, image batches are (x, y)
+                x = batch if use_token_cache else batch[0]
+                if augment is not None:
+                    x = augment(x)
 
                 # evaluate the loss
                 logits, loss = gpt.forward(x)
-                epoch_loss += loss.detach().item()
+                # Summed on the device, read once per epoch
+                epoch_loss += loss.detach()
                 optim.zero_grad()
                 accelerator.backward(loss)
                 optim.step()
                 total_steps += 1
 
-                accelerator.log({"train_loss": loss}, step=total_steps)
+                if accelerator.is_main_process:
+                    averages = metrics.log({"train_loss": loss}, step=total_steps)
+                    # Averages over flush_every steps, the tracker never reads the loss off the device itself
+                    if averages:
+                        accelerator.log(averages, step=total_steps)
 
                 if total_steps % checkpoint_step == 0:
                     ckpt_dir = os.path.join(
@@ -137,6 +221,7 @@ def main(config: dict):
                     accelerator.log(
                         {"Samples": wandb.Image(images, caption=f"Step {total_steps}")}
                     )
+                    loader_state.update(epoch, step + 1, total_steps)
                     accelerator.save_state(
                         ckpt_dir,
                         safe_serialization=False,
@@ -145,10 +230,22 @@ def main(config: dict):
                 if accelerator.is_main_process:
                     progress_bar.update(1)
 
+        epoch_loss = float(epoch_loss)
         total_loss += epoch_loss
         if accelerator.is_main_process:
-            epoch_loss_log = f"Epoch: {epoch}, Avg Epoch Loss {epoch_loss / (step + 1)}, Net Avg Loss: {total_loss / (total_steps + 1)}"
-            logger.log(epoch_loss_log)
+            metrics.log(
+                {
+                    "epoch": epoch,
+                    "avg_epoch_loss": epoch_loss / (step + 1 - first_batch),
+                    "net_avg_loss": total_loss / (total_steps + 1),
+                },
+                step=total_steps,
+            )
+
+    if accelerator.is_main_process:
+        averages = metrics.close()
+        if averages:
+            accelerator.log(averages, step=total_steps)
 
     accelerator.wait_for_everyone()
     accelerator.end_training()
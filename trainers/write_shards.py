@@ -0,0 +1,29 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import argparse
+from utils.shards import write_shards
+
+
+def main(args: dict):
+    index = write_shards(
+        args["image_dir"],
+        args["shard_dir"],
+        shard_size=args["shard_size"],
+        num_workers=args["num_workers"],
+        seed=args["seed"],
+    )
+    print(
+        f"Wrote {index['num_samples']} images of {len(index['classes'])} classes in {len(index['shards'])} shards to {args['shard_dir']}"
+    )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--image_dir", type=str, required=True, help="Folder of images, sub folders are classes")
+    arg_parser.add_argument("--shard_dir", type=str, required=True, help="Where to write the shards")
+    arg_parser.add_argument("--shard_size", type=int, default=1000, help="Images per shard")
+    arg_parser.add_argument("--num_workers", type=int, default=None, help="Processes writing shards, every core by default")
+    arg_parser.add_argument("--seed", type=int, default=0, help="Seed of the order of the images")
+    main(vars(arg_parser.parse_args()))
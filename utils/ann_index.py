@@ -0,0 +1,170 @@
+"""
+Inverted file (IVF) index for approximate top-k cosine search over embedding tables, e.g. GloVe word vectors or the
+codebook vectors of a tokenizer.
+
+Vectors are normalized and clustered with spherical k-means. Each vector is stored in the list of its closest
+centroid, the lists contiguous in one array. A query only scores the vectors of its num_probe closest lists.
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import json
+import math
+import numpy as np
+import torch
+from torch import nn
+from torch.nn import functional
+from typing import Union
+
+
+def codebook_vectors(quantizer: nn.Module):
+    """(codebook_size, dim) vectors a quantizer decodes its indices to, FSQ implicit codebooks or VQ codebooks"""
+    with torch.no_grad():
+        if hasattr(quantizer, "implicit_codebook"):
+            return quantizer.project_out(quantizer.implicit_codebook)
+        return quantizer.codebook
+
+
+def spherical_kmeans(vectors: torch.Tensor, num_clusters: int, num_iters=10, batch_size=65536, seed=0):
+    """Unit norm (num_clusters, D) centroids of unit norm vectors, assignment by cosine similarity"""
+    generator = torch.Generator().manual_seed(seed)
+    init = torch.randperm(len(vectors), generator=generator)[:num_clusters]
+    centroids = vectors[init.to(vectors.device)].clone()
+
+    for _ in range(num_iters):
+        assignments = assign(vectors, centroids, batch_size)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, vectors)
+        counts = torch.bincount(assignments, minlength=num_clusters)
+        # Empty clusters keep their centroid
+        centroids = torch.where(counts[:, None] > 0, functional.normalize(sums, dim=-1), centroids)
+    return centroids
+
+
+def assign(vectors: torch.Tensor, centroids: torch.Tensor, batch_size=65536):
+    return torch.cat(
+        [
+            (vectors[start : start + batch_size] @ centroids.T).argmax(dim=-1)
+            for start in range(0, len(vectors), batch_size)
+        ]
+    )
+
+
+class IVFIndex:
+    """
+    Args:
+        vectors (torch.Tensor): (N, D) vectors to index, normalized internally,
+        num_lists (int): Number of k-means lists, defaults to sqrt(N),
+        num_iters (int): k-means iterations
+    """
+
+    def __init__(
+        self,
+        vectors: Union[None, torch.Tensor] = None,
+        num_lists: Union[None, int] = None,
+        num_iters=10,
+        seed=0,
+    ):
+        # Empty when loading
+        if vectors is None:
+            return
+
+        vectors = functional.normalize(vectors.detach().float(), dim=-1)
+        num_lists = num_lists or max(1, int(math.sqrt(len(vectors))))
+        self.centroids = spherical_kmeans(vectors, num_lists, num_iters, seed=seed)
+
+        # Vectors grouped by list, offsets[l]:offsets[l + 1] is list l
+        assignments = assign(vectors, self.centroids)
+        order = torch.argsort(assignments, stable=True)
+        self.ids = order
+        self.vectors = vectors[order]
+        counts = torch.bincount(assignments, minlength=num_lists)
+        self.offsets = torch.cat((counts.new_zeros(1), counts.cumsum(dim=0)))
+
+    @property
+    def num_lists(self):
+        return len(self.centroids)
+
+    def to(self, device: Union[str, torch.device]):
+        for name in ["centroids", "ids", "vectors", "offsets"]:
+            setattr(self, name, getattr(self, name).to(device))
+        return self
+
+    @torch.no_grad()
+    def search(self, queries: torch.Tensor, k=10, num_probe=8, batch_size=32):
+        """
+        Args:
+            queries: (Q, D)
+            num_probe: Lists scored per query, more is slower and closer to exact
+            batch_size: Queries searched at once, their (batch_size, candidates, D) vectors are gathered together
+
+        Returns:
+            scores: (Q, k) cosine similarities, ids: (Q, k) rows of the indexed vectors, -1 past the candidates found
+        """
+        queries = functional.normalize(queries.float().to(self.vectors.device), dim=-1)
+        num_probe = min(num_probe, self.num_lists)
+        scores, ids = [], []
+        for start in range(0, len(queries), batch_size):
+            batch_scores, batch_ids = self.search_batch(queries[start : start + batch_size], k, num_probe)
+            scores.append(batch_scores)
+            ids.append(batch_ids)
+        return torch.cat(scores), torch.cat(ids)
+
+    def search_batch(self, queries: torch.Tensor, k: int, num_probe: int):
+        Q = len(queries)
+        lists = (queries @ self.centroids.T).topk(num_probe, dim=-1).indices  # (Q, P)
+        starts = self.offsets[lists]
+        sizes = self.offsets[lists + 1] - starts  # (Q, P)
+
+        # Candidates of every query padded to the longest, position m of query q falls in list p where
+        # the cumulated sizes of q pass m
+        totals = sizes.sum(dim=-1)
+        max_total = max(int(totals.max()), 1)
+        positions = torch.arange(max_total, device=queries.device).expand(Q, -1).contiguous()
+        ends = sizes.cumsum(dim=-1)
+        list_idx = torch.searchsorted(ends, positions, right=True).clamp(max=num_probe - 1)
+        list_start = torch.gather(ends - sizes, 1, list_idx)
+        rows = torch.gather(starts, 1, list_idx) + positions - list_start
+        valid = positions < totals[:, None]
+        rows = torch.where(valid, rows, 0)
+
+        candidate_scores = torch.einsum("qd,qmd->qm", queries, self.vectors[rows])
+        candidate_scores = candidate_scores.masked_fill(~valid, -torch.inf)
+        top_scores, top = candidate_scores.topk(min(k, max_total), dim=-1)
+        top_ids = torch.where(torch.isinf(top_scores), -1, self.ids[torch.gather(rows, 1, top)])
+
+        if top.shape[1] < k:
+            padding = k - top.shape[1]
+            top_scores = functional.pad(top_scores, (0, padding), value=-torch.inf)
+            top_ids = functional.pad(top_ids, (0, padding), value=-1)
+        return top_scores, top_ids
+
+    def save(self, index_dir: str):
+        os.makedirs(index_dir, exist_ok=True)
+        for name in ["centroids", "ids", "vectors", "offsets"]:
+            np.save(os.path.join(index_dir, f"{name}.npy"), getattr(self, name).cpu().numpy())
+        with open(os.path.join(index_dir, "index.json"), "w") as file:
+            json.dump({"type": "ivf", "num_lists": self.num_lists, "num_vectors": len(self.ids)}, file)
+
+    @classmethod
+    def load(cls, index_dir: str, mmap=True):
+        """With mmap the vectors stay on disk (copy on write) and are paged in as lists get probed"""
+        index = cls()
+        for name in ["centroids", "ids", "vectors", "offsets"]:
+            array = np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="c" if mmap else None)
+            setattr(index, name, torch.from_numpy(array))
+        return index
+
+
+@torch.no_grad()
+def brute_force_search(vectors: torch.Tensor, queries: torch.Tensor, k=10, batch_size=256):
+    """Exact top-k cosine search, the reference of IVFIndex"""
+    vectors = functional.normalize(vectors.float(), dim=-1)
+    queries = functional.normalize(queries.float().to(vectors.device), dim=-1)
+    scores, ids = [], []
+    for start in range(0, len(queries), batch_size):
+        batch_scores, batch_ids = (queries[start : start + batch_size] @ vectors.T).topk(k, dim=-1)
+        scores.append(batch_scores)
+        ids.append(batch_ids)
+    return torch.cat(scores), torch.cat(ids)
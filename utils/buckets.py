@@ -0,0 +1,160 @@
+"""
+Aspect ratio bucketing: images of any size are resized, keeping their aspect ratio, to the closest of a few (H, W)
+buckets of about the area of input_res, every side divisible by multiple (patch_size * window_size and the
+downsampling of the model). Batches are drawn from one bucket at a time, so they need no padding and no crop beyond
+the few pixels of rounding to the bucket, for models which accept any resolution such as model_archs/swin_fsqvae.py.
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import math
+import numpy as np
+import torch
+import multiprocessing as mp
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader, Sampler
+from torchvision import transforms
+from typing import List, Tuple
+
+
+def bucket_multiple(config: dict):
+    """Multiple of every bucket side for a Swin config, full windows in the first layer and whole merges"""
+    patch_size = config["patch_size"]
+    return math.lcm(patch_size * config["window_size"], patch_size * 2 ** len(config["swin_depths"]))
+
+
+def make_buckets(input_res: List[int], multiple: int, max_aspect=2.0, max_area_ratio=1.25):
+    """
+    (H, W) buckets with sides divisible by multiple, aspect ratios up to max_aspect and areas within max_area_ratio of
+    the one of input_res
+    """
+    area = input_res[0] * input_res[1]
+    buckets = set()
+    for H in range(multiple, int(math.sqrt(area * max_aspect * max_area_ratio)) + 1, multiple):
+        for W in [math.floor(area / H / multiple) * multiple, math.ceil(area / H / multiple) * multiple]:
+            if (
+                W > 0
+                and 1 / max_aspect <= H / W <= max_aspect
+                and 1 / max_area_ratio <= H * W / area <= max_area_ratio
+            ):
+                # Landscape images get the same buckets as portrait ones
+                buckets.update([(H, W), (W, H)])
+    assert buckets, f"No bucket of input_res {input_res} has sides divisible by {multiple}"
+    return sorted(buckets)
+
+
+def _image_size(path: str):
+    # Only the header is read
+    with Image.open(path) as image:
+        return image.height, image.width
+
+
+def image_sizes(paths: List[str], num_workers: int = None):
+    """(N, 2) heights and widths of the images"""
+    with mp.get_context("spawn").Pool(num_workers or os.cpu_count()) as pool:
+        return np.array(pool.map(_image_size, paths, chunksize=256), dtype=np.int64).reshape(-1, 2)
+
+
+def assign_buckets(sizes: np.ndarray, buckets: List[Tuple[int, int]]):
+    """(N) bucket of every (H, W) size, the one closest in log aspect ratio"""
+    bucket_aspect = np.log(np.array([H / W for H, W in buckets]))
+    aspect = np.log(sizes[:, 0] / sizes[:, 1])
+    return np.abs(aspect[:, None] - bucket_aspect[None]).argmin(axis=1)
+
+
+class BucketedImageDataset(Dataset):
+    """Item idx is the image at paths[idx] resized to cover its bucket, center cropped to it and normalized"""
+
+    def __init__(
+        self,
+        paths: List[str],
+        labels: List[int],
+        buckets: List[Tuple[int, int]],
+        bucket_ids: np.ndarray,
+        mean: List[float],
+        std: List[float],
+    ):
+        self.paths = paths
+        self.labels = labels
+        self.buckets = buckets
+        self.bucket_ids = bucket_ids
+        self.to_tensor = transforms.Compose([transforms.ToTensor(), transforms.Normalize(mean=mean, std=std)])
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx: int):
+        H, W = self.buckets[self.bucket_ids[idx]]
+        image = Image.open(self.paths[idx]).convert("RGB")
+        scale = max(H / image.height, W / image.width)
+        size = (max(W, round(image.width * scale)), max(H, round(image.height * scale)))
+        image = image.resize(size, Image.Resampling.BICUBIC)
+        left, top = (size[0] - W) // 2, (size[1] - H) // 2
+        image = image.crop((left, top, left + W, top + H))
+        return self.to_tensor(image), self.labels[idx]
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batches of batch_size indices of a single bucket. Every epoch the indices of each bucket are shuffled and cut
+    into batches, a bucket's last partial batch dropped, and the batches of all the buckets shuffled together, seeded
+    by seed and the epoch. The epoch advances on every iteration unless set with set_epoch.
+    """
+
+    def __init__(self, bucket_ids: np.ndarray, batch_size: int, seed=0):
+        self.bucket_ids = torch.as_tensor(bucket_ids)
+        self.batch_size = batch_size
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+        self.members = [
+            torch.nonzero(self.bucket_ids == bucket).flatten() for bucket in range(int(self.bucket_ids.max()) + 1)
+        ]
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def set_position(self, epoch: int, batches: int):
+        """The next iteration is epoch without its first batches"""
+        self.epoch = epoch
+        self.start = batches
+
+    def __len__(self):
+        return sum(len(members) // self.batch_size for members in self.members)
+
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        self.epoch += 1
+        batches = []
+        for members in self.members:
+            members = members[torch.randperm(len(members), generator=generator)]
+            num_batches = len(members) // self.batch_size
+            batches.extend(members[: num_batches * self.batch_size].view(num_batches, self.batch_size))
+        order = torch.randperm(len(batches), generator=generator).tolist()
+        skip, self.start = self.start, 0
+        for idx in order[skip:]:
+            yield batches[idx].tolist()
+
+
+def get_bucketed_loader(
+    paths: List[str],
+    labels: List[int],
+    config: dict,
+    batch_size: int,
+    num_workers=0,
+    max_aspect=2.0,
+):
+    """DataLoader of BucketedImageDataset batches, buckets of config["input_res"] for the Swin config"""
+    buckets = make_buckets(config["input_res"], bucket_multiple(config), max_aspect)
+    bucket_ids = assign_buckets(image_sizes(paths, num_workers or None), buckets)
+    dataset = BucketedImageDataset(
+        paths, labels, buckets, bucket_ids, config["dataset_mean"], config["dataset_std"]
+    )
+    return DataLoader(
+        dataset,
+        batch_sampler=BucketBatchSampler(bucket_ids, batch_size),
+        num_workers=num_workers,
+        persistent_workers=num_workers > 0,
+    )
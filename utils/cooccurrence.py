@@ -0,0 +1,274 @@
+"""
+Sparse, streaming word co-occurrence counts for GloVe.
+
+The corpus (a flat array of word ids, e.g. tokens.npy of utils/text_corpus.py) is split in one shard per process.
+Every shard walks its tokens chunk by chunk, for every offset d in 1..window_size the (tokens[i - d], tokens[i]) pairs
+of the chunk are produced at once as int64 keys row * vocab_size + col, weighted 1 / d as in GloVe. Keys are merged
+into a sorted accumulator of unique keys periodically, and the accumulator is spilled to disk as a sorted run
+whenever it outgrows its share of the memory cap. The runs of every shard are finally merged block of rows by block
+of rows into CSR arrays, so no step needs more than the memory cap.
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import shutil
+import tempfile
+import numpy as np
+import multiprocessing as mp
+from typing import List, Union
+
+# Bytes per accumulated entry, int64 key and float32 value
+ENTRY_BYTES = 12
+
+
+def reduce_keys(keys: np.ndarray, values: np.ndarray):
+    """Sorted unique keys and the sum of the values of each"""
+    if len(keys) == 0:
+        return keys, values
+    order = np.argsort(keys, kind="stable")
+    keys, values = keys[order], values[order]
+    starts = np.flatnonzero(np.diff(keys, prepend=keys[0] - 1))
+    return keys[starts], np.add.reduceat(values, starts)
+
+
+def chunk_pairs(
+    tokens: np.ndarray,
+    start: int,
+    end: int,
+    window_size: int,
+    vocab_size: int,
+    weighting: bool,
+    symmetric: bool,
+):
+    """Keys and weights of every (tokens[i - d], tokens[i]) pair with i in [start, end), d in 1..window_size"""
+    centers = tokens[start:end].astype(np.int64)
+    keys, values = [], []
+    for d in range(1, window_size + 1):
+        first = max(start, d)
+        if first >= end:
+            break
+        right = centers[first - start :]
+        left = tokens[first - d : end - d].astype(np.int64)
+        weight = np.full(len(right), 1.0 / d if weighting else 1.0, dtype=np.float32)
+        keys.append(left * vocab_size + right)
+        values.append(weight)
+        if symmetric:
+            keys.append(right * vocab_size + left)
+            values.append(weight)
+    if not keys:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    return np.concatenate(keys), np.concatenate(values)
+
+
+def _count_shard(args: tuple):
+    tokens, start, end, window_size, vocab_size, weighting, symmetric = args[:7]
+    chunk_size, memory_cap, spill_dir = args[7:]
+    if isinstance(tokens, str):
+        tokens = np.load(tokens, mmap_mode="r")
+
+    acc_keys = np.zeros(0, dtype=np.int64)
+    acc_values = np.zeros(0, dtype=np.float32)
+    buffer_keys, buffer_values, buffer_len = [], [], 0
+    runs = []
+
+    def spill():
+        path = os.path.join(spill_dir, f"run_{start}_{len(runs)}")
+        np.save(path + "_keys.npy", acc_keys)
+        np.save(path + "_values.npy", acc_values)
+        runs.append(path)
+
+    def reduce():
+        nonlocal acc_keys, acc_values, buffer_keys, buffer_values, buffer_len
+        acc_keys, acc_values = reduce_keys(
+            np.concatenate([acc_keys, *buffer_keys]),
+            np.concatenate([acc_values, *buffer_values]),
+        )
+        buffer_keys, buffer_values, buffer_len = [], [], 0
+        if len(acc_keys) * ENTRY_BYTES >= memory_cap // 8:
+            spill()
+            acc_keys = np.zeros(0, dtype=np.int64)
+            acc_values = np.zeros(0, dtype=np.float32)
+
+    # Sorting in reduce_keys takes about five times the entries it reduces, so the buffered pairs are merged before
+    # they outgrow a sixteenth of the cap and the accumulator spills past an eighth of it
+    max_buffer = max(1, memory_cap // (16 * ENTRY_BYTES))
+    # A chunk alone makes window_size (twice as many symmetric) pairs per token, it fits the buffer
+    pairs_per_token = window_size * (2 if symmetric else 1)
+    chunk_size = max(1, min(chunk_size, max_buffer // pairs_per_token))
+    for chunk_start in range(start, end, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, end)
+        keys, values = chunk_pairs(
+            tokens, chunk_start, chunk_end, window_size, vocab_size, weighting, symmetric
+        )
+        if buffer_len + len(keys) > max_buffer:
+            reduce()
+        buffer_keys.append(keys)
+        buffer_values.append(values)
+        buffer_len += len(keys)
+    reduce()
+
+    if len(acc_keys):
+        spill()
+    return runs
+
+
+class SparseCoOccurrence:
+    """(vocab_size, vocab_size) co-occurrence counts in CSR form, row i holds the counts of the contexts of word i"""
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, data: np.ndarray, vocab_size: int):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.vocab_size = vocab_size
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    def to_coo(self):
+        """(rows, cols, values) of the non zero entries"""
+        rows = np.repeat(np.arange(self.vocab_size, dtype=np.int64), np.diff(self.indptr))
+        return rows, np.asarray(self.indices, dtype=np.int64), np.asarray(self.data)
+
+    def to_dense(self):
+        dense = np.zeros((self.vocab_size, self.vocab_size), dtype=np.float32)
+        rows, cols, values = self.to_coo()
+        dense[rows, cols] = values
+        return dense
+
+    def save(self, out_dir: str):
+        os.makedirs(out_dir, exist_ok=True)
+        np.save(os.path.join(out_dir, "indptr.npy"), self.indptr)
+        np.save(os.path.join(out_dir, "indices.npy"), self.indices)
+        np.save(os.path.join(out_dir, "data.npy"), self.data)
+
+    @classmethod
+    def load(cls, out_dir: str, mmap=True):
+        mmap_mode = "r" if mmap else None
+        indptr = np.load(os.path.join(out_dir, "indptr.npy"), mmap_mode=mmap_mode)
+        indices = np.load(os.path.join(out_dir, "indices.npy"), mmap_mode=mmap_mode)
+        data = np.load(os.path.join(out_dir, "data.npy"), mmap_mode=mmap_mode)
+        return cls(indptr, indices, data, len(indptr) - 1)
+
+
+def merge_runs(runs: List[str], vocab_size: int, memory_cap: int, out_dir: Union[None, str]):
+    """Merges sorted runs into CSR arrays, a block of rows at a time, written to out_dir when given"""
+    run_keys = [np.load(run + "_keys.npy", mmap_mode="r") for run in runs]
+    run_values = [np.load(run + "_values.npy", mmap_mode="r") for run in runs]
+
+    total = sum(len(keys) for keys in run_keys)
+    # Upper bound of the merged size, the real one is known once merged
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+        indices = np.lib.format.open_memmap(
+            os.path.join(out_dir, "indices.npy"), mode="w+", dtype=np.int32, shape=(total,)
+        )
+        data = np.lib.format.open_memmap(
+            os.path.join(out_dir, "data.npy"), mode="w+", dtype=np.float32, shape=(total,)
+        )
+    else:
+        indices = np.zeros(total, dtype=np.int32)
+        data = np.zeros(total, dtype=np.float32)
+    indptr = np.zeros(vocab_size + 1, dtype=np.int64)
+
+    # Rows per block so that reducing a block of every run, about eight times its entries, fits the cap on average
+    rows_per_block = max(1, int(vocab_size * memory_cap / max(1, 8 * total * ENTRY_BYTES)))
+    nnz = 0
+    for row_start in range(0, vocab_size, rows_per_block):
+        row_end = min(row_start + rows_per_block, vocab_size)
+        key_range = (row_start * vocab_size, row_end * vocab_size)
+        block_keys, block_values = [], []
+        for keys, values in zip(run_keys, run_values):
+            lo, hi = np.searchsorted(keys, key_range)
+            block_keys.append(np.asarray(keys[lo:hi]))
+            block_values.append(np.asarray(values[lo:hi]))
+        keys, values = reduce_keys(np.concatenate(block_keys), np.concatenate(block_values))
+
+        rows = keys // vocab_size
+        indices[nnz : nnz + len(keys)] = keys % vocab_size
+        data[nnz : nnz + len(keys)] = values
+        indptr[row_start + 1 : row_end + 1] = nnz + np.cumsum(
+            np.bincount(rows - row_start, minlength=row_end - row_start)
+        )
+        nnz += len(keys)
+
+    if out_dir is not None:
+        indices.flush()
+        data.flush()
+        del indices, data, run_keys, run_values
+        # Trim the files to the merged size
+        for name in ["indices.npy", "data.npy"]:
+            path = os.path.join(out_dir, name)
+            array = np.load(path, mmap_mode="r")[:nnz]
+            np.save(path + ".tmp.npy", array)
+            del array
+            os.replace(path + ".tmp.npy", path)
+        np.save(os.path.join(out_dir, "indptr.npy"), indptr)
+        return SparseCoOccurrence.load(out_dir)
+
+    return SparseCoOccurrence(indptr, indices[:nnz].copy(), data[:nnz].copy(), vocab_size)
+
+
+def build_co_occurrence(
+    tokens: Union[str, np.ndarray],
+    vocab_size: int,
+    window_size=10,
+    weighting=True,
+    symmetric=True,
+    num_workers=1,
+    chunk_size=2**20,
+    memory_cap=2**30,
+    out_dir: Union[None, str] = None,
+    spill_dir: Union[None, str] = None,
+):
+    """
+    Args:
+        tokens: (N) word ids, or the path to a .npy of them which every worker memory maps
+        window_size: Number of words on each side counted as context
+        weighting: Weight a pair d words apart by 1 / d, plain counts otherwise
+        symmetric: Count (left, right) and (right, left), only (left, right) otherwise
+        num_workers: Processes, each counting its own shard of the corpus
+        chunk_size: Tokens whose pairs are generated at once, at most what fits a worker's share of the cap
+        memory_cap: Bytes of pairs held in memory over all the workers before spilling to disk
+        out_dir: Where to write the CSR arrays (memory mapped when loading), kept in memory when not given
+        spill_dir: Where to spill sorted runs, a temporary directory by default
+
+    Returns:
+        SparseCoOccurrence
+    """
+    N = len(np.load(tokens, mmap_mode="r")) if isinstance(tokens, str) else len(tokens)
+    own_spill_dir = spill_dir is None
+    spill_dir = spill_dir or tempfile.mkdtemp(prefix="cooccurrence_")
+    os.makedirs(spill_dir, exist_ok=True)
+
+    shard_size = -(-N // num_workers)
+    worker_cap = memory_cap // num_workers
+    shards = [
+        (
+            tokens,
+            start,
+            min(start + shard_size, N),
+            window_size,
+            vocab_size,
+            weighting,
+            symmetric,
+            chunk_size,
+            worker_cap,
+            spill_dir,
+        )
+        for start in range(0, N, shard_size)
+    ]
+
+    try:
+        if num_workers > 1:
+            ctx = mp.get_context("spawn")
+            with ctx.Pool(num_workers) as pool:
+                runs = [run for shard_runs in pool.map(_count_shard, shards) for run in shard_runs]
+        else:
+            runs = [run for shard in shards for run in _count_shard(shard)]
+        return merge_runs(runs, vocab_size, memory_cap, out_dir)
+    finally:
+        if own_spill_dir:
+            shutil.rmtree(spill_dir, ignore_errors=True)
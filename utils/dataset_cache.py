@@ -0,0 +1,200 @@
+"""
+Preprocessed image cache: the deterministic resize (and crop) of a dataset is applied once and the images are stored
+as a memory mapped uint8 (N, H, W, C) array, keyed by dataset and input_res. Images are stored in a seeded random
+order so contiguous slices are random images. Every epoch batches are made of a new permutation of small contiguous
+blocks of them, read with one slice per block and converted and normalized with one vectorized op.
+
+Layout of cache_dir:
+    manifest.json   dataset, input_res and array description
+    images.npy      (N, H, W, C) uint8 images
+    labels.npy      (N) labels
+    indices.npy     (N) index of every image in the source dataset
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import json
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader, Sampler
+from typing import List
+from utils.get_dataset import get_raw_dataset
+
+MANIFEST_FILE = "manifest.json"
+IMAGES_FILE = "images.npy"
+LABELS_FILE = "labels.npy"
+INDICES_FILE = "indices.npy"
+
+
+def dataset_cache_dir(cache_root: str, dataset_name: str, input_res: List[int]):
+    return os.path.join(cache_root, f"{dataset_name}_{input_res[0]}x{input_res[1]}")
+
+
+def build_dataset_cache(
+    cache_dir: str, dataset_name: str, input_res: List[int], num_workers=0, batch_size=256, seed=0
+):
+    """Writes the get_raw_dataset images of dataset_name into cache_dir, decoded by num_workers loader processes"""
+    os.makedirs(cache_dir, exist_ok=True)
+    dataset = get_raw_dataset(dataset_name, input_res)
+    order = np.random.default_rng(seed).permutation(len(dataset))
+    C = dataset[0][0].shape[0]
+
+    images = np.lib.format.open_memmap(
+        os.path.join(cache_dir, IMAGES_FILE),
+        mode="w+",
+        dtype=np.uint8,
+        shape=(len(dataset), *input_res, C),
+    )
+    labels = []
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        sampler=order.tolist(),
+        num_workers=num_workers,
+    )
+    offset = 0
+    for x, y in loader:
+        images[offset : offset + len(x)] = x.permute(0, 2, 3, 1).numpy()
+        labels.append(torch.as_tensor(y).reshape(len(x), -1)[:, 0].numpy())
+        offset += len(x)
+    images.flush()
+    del images
+    np.save(os.path.join(cache_dir, LABELS_FILE), np.concatenate(labels).astype(np.int64))
+    np.save(os.path.join(cache_dir, INDICES_FILE), order.astype(np.int64))
+
+    manifest = {
+        "dataset": dataset_name,
+        "input_res": list(input_res),
+        "num_images": len(order),
+        "num_channels": C,
+        "seed": seed,
+    }
+    # Written last, a cache without a manifest is incomplete
+    with open(os.path.join(cache_dir, MANIFEST_FILE), "w") as file:
+        json.dump(manifest, file)
+    return manifest
+
+
+def get_cached_dataset(config: dict, num_workers=0):
+    """CachedImageDataset of config["dataset"] at config["input_res"] under config["dataset_cache_dir"], built if missing"""
+    cache_dir = dataset_cache_dir(config["dataset_cache_dir"], config["dataset"], config["input_res"])
+    if not os.path.exists(os.path.join(cache_dir, MANIFEST_FILE)):
+        build_dataset_cache(cache_dir, config["dataset"], config["input_res"], num_workers)
+    return CachedImageDataset(cache_dir, config["dataset_mean"], config["dataset_std"])
+
+
+class CachedImageDataset(Dataset):
+    """
+    Normalized (C, H, W) float images of a build_dataset_cache directory. Batches of indices are fetched at once by
+    __getitems__, every contiguous run of indices with a single slice of the memory mapped array.
+    """
+
+    def __init__(self, cache_dir: str, mean: List[float], std: List[float]):
+        manifest_path = os.path.join(cache_dir, MANIFEST_FILE)
+        assert os.path.exists(manifest_path), f"No dataset cache in {cache_dir}, build it with build_dataset_cache"
+        self.manifest = json.load(open(manifest_path))
+        self.images = np.load(os.path.join(cache_dir, IMAGES_FILE), mmap_mode="r")
+        self.labels = torch.from_numpy(np.load(os.path.join(cache_dir, LABELS_FILE)))
+
+        # x / 255 and the normalization folded into one multiply add
+        mean = torch.tensor(mean, dtype=torch.float32)
+        std = torch.tensor(std, dtype=torch.float32)
+        self.scale = (1 / (255 * std)).reshape(1, -1, 1, 1)
+        self.shift = (-mean / std).reshape(1, -1, 1, 1)
+
+    def __len__(self):
+        return len(self.images)
+
+    def normalize(self, images: np.ndarray):
+        """(B, H, W, C) uint8 to normalized (B, C, H, W) float"""
+        x = torch.from_numpy(np.array(images)).permute(0, 3, 1, 2).float()
+        return (x * self.scale + self.shift).contiguous()
+
+    def __getitems__(self, indices: List[int]):
+        indices = np.asarray(indices)
+        runs = np.split(indices, np.flatnonzero(np.diff(indices) != 1) + 1)
+        if len(runs) == 1:
+            images = self.images[indices[0] : indices[-1] + 1]
+            labels = self.labels[indices[0] : indices[-1] + 1]
+        else:
+            images = np.concatenate([self.images[run[0] : run[-1] + 1] for run in runs])
+            labels = np.concatenate([self.labels[run[0] : run[-1] + 1] for run in runs])
+        return self.normalize(images), labels
+
+    def __getitem__(self, idx: int):
+        x, y = self.__getitems__([idx])
+        return x[0], y[0]
+
+
+def collate_batch(batch: tuple):
+    # CachedImageDataset.__getitems__ already returns the batch
+    return batch
+
+
+class ContiguousBatchSampler(Sampler):
+    """
+    Batches of batch_size indices made of contiguous blocks of block_size. Shuffled, every epoch cuts the indices into
+    blocks at a new offset in [0, block_size), the block past the end wrapping around to the start, and batches the
+    blocks in a new random order, seeded by seed and the epoch. The epoch advances on every iteration unless set with
+    set_epoch. Not shuffled, batches are the indices in order.
+
+    block_size trades randomness for reads: the cache is stored shuffled, but the images of a block stay together in
+    every epoch, and a batch takes batch_size / block_size slices. block_size = 1 is fully random batches (one read
+    per image), block_size = batch_size the same groups of images every epoch in a new order (one read per batch).
+    """
+
+    def __init__(self, num_samples: int, batch_size: int, shuffle=True, drop_last=True, seed=0, block_size=8):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.block_size = min(block_size, num_samples)
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def set_position(self, epoch: int, batches: int):
+        """The next iteration is epoch without its first batches"""
+        self.epoch = epoch
+        self.start = batches
+
+    def stream_length(self):
+        # Shuffled, the samples past the last whole block are left out of the epoch
+        if self.shuffle:
+            return self.num_samples // self.block_size * self.block_size
+        return self.num_samples
+
+    def __len__(self):
+        if self.drop_last:
+            return self.stream_length() // self.batch_size
+        return -(-self.stream_length() // self.batch_size)
+
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        self.epoch += 1
+        length = self.stream_length()
+        if self.shuffle:
+            offset = int(torch.randint(self.block_size, size=[], generator=generator))
+            num_blocks = length // self.block_size
+            block_starts = offset + torch.randperm(num_blocks, generator=generator) * self.block_size
+        skip, self.start = self.start, 0
+        for batch in range(skip, len(self)):
+            positions = torch.arange(batch * self.batch_size, min((batch + 1) * self.batch_size, length))
+            if self.shuffle:
+                positions = block_starts[positions // self.block_size] + positions % self.block_size
+            yield (positions % self.num_samples).tolist()
+
+
+def get_cached_loader(dataset: CachedImageDataset, batch_size: int, num_workers=0, seed=0, block_size=8):
+    return DataLoader(
+        dataset,
+        batch_sampler=ContiguousBatchSampler(len(dataset), batch_size, seed=seed, block_size=block_size),
+        collate_fn=collate_batch,
+        num_workers=num_workers,
+        persistent_workers=num_workers > 0,
+    )
@@ -15,3 +15,26 @@ def get_dataset(
         path=os.path.join(base_dataset_dir, f"{dataset_name}.py"),
     )
     return all_modules.get_dataset(input_res, mean, std)
+
+
+def get_raw_dataset(dataset_name: str, input_res: list[int] = [32, 32]):
+
+    base_dataset_dir = os.path.join(os.getcwd(), "datasets")
+    all_modules = import_file(
+        "",
+        path=os.path.join(base_dataset_dir, f"{dataset_name}.py"),
+    )
+    return all_modules.get_raw_dataset(input_res)
+
+
+def get_image_paths(dataset_name: str):
+
+    base_dataset_dir = os.path.join(os.getcwd(), "datasets")
+    all_modules = import_file(
+        "",
+        path=os.path.join(base_dataset_dir, f"{dataset_name}.py"),
+    )
+    assert hasattr(
+        all_modules, "get_image_paths"
+    ), f"{dataset_name} has no image files to bucket, set image_dir instead"
+    return all_modules.get_image_paths()
@@ -0,0 +1,63 @@
+import math
+import torch
+from typing import List
+
+
+def bits_per_index(codebook_size: int):
+    """Bits needed to store an index in [0, codebook_size), 12 for the 3087 codes of [9, 7, 7, 7]"""
+    return max(1, math.ceil(math.log2(codebook_size)))
+
+
+def index_dtype(codebook_size: int):
+    """Smallest integer dtype holding every index in [0, codebook_size)"""
+    if codebook_size <= 2**8:
+        return torch.uint8
+    if codebook_size <= 2**15:
+        return torch.int16
+    return torch.int32
+
+
+def pack_indices(indices: torch.Tensor, codebook_size: int):
+    """
+    Packs indices into a flat uint8 tensor using bits_per_index(codebook_size) bits each, little endian. Works on any
+    device, pack before moving indices between host and device to move fewer bytes.
+
+    Returns:
+        (ceil(indices.numel() * bits / 8)) uint8 tensor, unpack_indices needs indices.shape back
+    """
+    bits = bits_per_index(codebook_size)
+    device = indices.device
+    shifts = torch.arange(bits, device=device, dtype=torch.int32)
+    # (N, bits) of 0 / 1
+    bit_array = (indices.reshape(-1, 1).to(torch.int32) >> shifts) & 1
+    bit_array = bit_array.reshape(-1).to(torch.uint8)
+
+    padding = -bit_array.numel() % 8
+    if padding:
+        bit_array = torch.cat((bit_array, bit_array.new_zeros(padding)))
+    byte_shifts = torch.arange(8, device=device, dtype=torch.uint8)
+    return (bit_array.view(-1, 8) << byte_shifts).sum(dim=-1, dtype=torch.uint8)
+
+
+def unpack_indices(packed: torch.Tensor, codebook_size: int, shape: List[int]):
+    """Inverse of pack_indices, returns indices of shape in index_dtype(codebook_size)"""
+    bits = bits_per_index(codebook_size)
+    numel = math.prod(shape)
+    device = packed.device
+
+    byte_shifts = torch.arange(8, device=device, dtype=torch.uint8)
+    bit_array = (packed.reshape(-1, 1) >> byte_shifts) & 1
+    bit_array = bit_array.reshape(-1)[: numel * bits].view(numel, bits)
+
+    shifts = torch.arange(bits, device=device, dtype=torch.int32)
+    indices = (bit_array.to(torch.int32) << shifts).sum(dim=-1, dtype=torch.int32)
+    return indices.to(index_dtype(codebook_size)).view(shape)
+
+
+def indices_to_z_q(quantizer: torch.nn.Module, indices: torch.Tensor):
+    """
+    FSQ codes of indices of any integer dtype as a lookup into the implicit_codebook buffer instead of recomputing the
+    levels, then projected back to the quantizer dim.
+    """
+    codes = quantizer.implicit_codebook[indices.long()]
+    return quantizer.project_out(codes)
@@ -0,0 +1,97 @@
+"""
+Mid-epoch resumable data loading. LoaderState holds the position of training in the data, the epoch, the batches of
+it every rank consumed and the total steps, and is saved with every accelerator.save_state through
+register_for_checkpointing. On resume the sampler (or streaming dataset) is moved to that batch with set_position,
+which recomputes the epoch order from its seed and starts after the consumed batches, so no skipped batch goes
+through the loader again.
+
+Samplers and datasets expose set_position(epoch, batches), batches being consumed over all the ranks:
+    ResumableRandomSampler      plain map-style datasets
+    ContiguousBatchSampler      utils/dataset_cache.py
+    ShardedImageDataset         utils/shards.py
+"""
+
+import torch
+from torch.utils.data import DataLoader, Sampler
+
+
+class ResumableRandomSampler(Sampler):
+    """
+    Random permutation of num_samples indices every epoch, seeded by seed and the epoch, the shuffle=True of a
+    DataLoader which can start anywhere in an epoch. The epoch advances on every iteration unless set with set_epoch.
+    """
+
+    def __init__(self, num_samples: int, batch_size: int, seed=0):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def set_position(self, epoch: int, batches: int):
+        self.epoch = epoch
+        self.start = batches * self.batch_size
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        start, self.start = self.start, 0
+        self.epoch += 1
+        return iter(torch.randperm(self.num_samples, generator=generator)[start:].tolist())
+
+
+def get_resumable(loader: DataLoader):
+    """The object of an unprepared loader that decides its order, one with set_position"""
+    for obj in [loader.dataset, loader.batch_sampler, loader.sampler]:
+        if hasattr(obj, "set_position"):
+            return obj
+    raise ValueError("Loader is not resumable, build it with a ResumableRandomSampler")
+
+
+class LoaderState:
+    """
+    Args:
+        resumable: get_resumable of the train loader,
+        num_ranks (int): Processes training, accelerator.num_processes
+    """
+
+    def __init__(self, resumable, num_ranks=1):
+        self.resumable = resumable
+        self.num_ranks = num_ranks
+        self.epoch = 0
+        self.batch = 0
+        self.total_steps = 0
+
+    def update(self, epoch: int, batch: int, total_steps: int):
+        """Called before every save_state, batch is the number of batches of the epoch this rank consumed"""
+        self.epoch = epoch
+        self.batch = batch
+        self.total_steps = total_steps
+
+    def state_dict(self):
+        return {
+            "epoch": self.epoch,
+            "batch": self.batch,
+            "total_steps": self.total_steps,
+            "num_ranks": self.num_ranks,
+        }
+
+    def load_state_dict(self, state: dict):
+        assert state["num_ranks"] == self.num_ranks, "Loader state was saved with another number of processes"
+        self.epoch = state["epoch"]
+        self.batch = state["batch"]
+        self.total_steps = state["total_steps"]
+
+    def resume(self, train_loader: DataLoader):
+        """Moves the prepared train_loader to the loaded position, the next batch it yields is the one after it"""
+        if self.batch >= len(train_loader):
+            self.epoch, self.batch = self.epoch + 1, 0
+        # The prepared loader sets the epoch of the sampler or dataset from its own count on every iteration
+        if hasattr(train_loader, "set_epoch"):
+            train_loader.set_epoch(self.epoch)
+        self.resumable.set_position(self.epoch, self.batch * self.num_ranks)
@@ -0,0 +1,196 @@
+"""
+Append-only metrics log written from a background thread.
+
+Step metrics given as tensors are summed on their device and only averaged, moved to the host and written every
+flush_every steps, so logging does not sync with the device on every step. The averaged records are also returned,
+for trackers such as accelerator.log to get them without syncing themselves. Records go through a bounded queue to a
+writer thread which appends them and fsyncs the file every fsync_interval seconds.
+
+Formats:
+    jsonl: one {"step": ..., name: value, ...} object per line
+    binary: fixed size (step int64, key uint16, value float64) records, key names in the <path>.keys.json sidecar
+"""
+
+import os
+import json
+import queue
+import threading
+import time
+import numpy as np
+import torch
+from typing import Dict, Union
+
+FORMATS = ["jsonl", "binary"]
+BINARY_RECORD = np.dtype([("step", "<i8"), ("key", "<u2"), ("value", "<f8")])
+EXTENSIONS = {"jsonl": "jsonl", "binary": "bin"}
+
+
+def metrics_path(log_dir: str, format="jsonl"):
+    return os.path.join(log_dir, f"metrics.{EXTENSIONS[format]}")
+
+
+class MetricsWriter:
+    """
+    Args:
+        path (str): File appended to, None to only average the step metrics for the returned records,
+        format (str): One of FORMATS,
+        flush_every (int): Steps whose tensor metrics are averaged into one record,
+        fsync_interval (float): Seconds between fsyncs of the file,
+        max_queue (int): Records buffered before log blocks
+    """
+
+    def __init__(self, path: Union[None, str], format="jsonl", flush_every=50, fsync_interval=10.0, max_queue=1024):
+        assert format in FORMATS, f"format must be one of {FORMATS}"
+        self.path = path
+        self.format = format
+        self.flush_every = flush_every
+        self.fsync_interval = fsync_interval
+
+        # Running sums of the tensor metrics since the last flush
+        self.sums: Dict[str, torch.Tensor] = {}
+        self.counts: Dict[str, int] = {}
+        self.last_step = 0
+
+        self.keys: Dict[str, int] = {}
+        if path is not None and format == "binary" and os.path.exists(self.keys_path):
+            self.keys = json.load(open(self.keys_path))
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.thread = None
+        if path is not None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    @property
+    def keys_path(self):
+        return self.path + ".keys.json"
+
+    def log(self, metrics: Dict[str, Union[torch.Tensor, float]], step: int):
+        """
+        Tensors are aggregated until the next flush, anything else is written right away. Returns the record of
+        averages when this step flushed, None otherwise.
+        """
+        record = {}
+        for name, value in metrics.items():
+            if isinstance(value, torch.Tensor):
+                value = value.detach().float()
+                self.sums[name] = self.sums[name] + value if name in self.sums else value.clone()
+                self.counts[name] = self.counts.get(name, 0) + 1
+            else:
+                record[name] = value
+        self.last_step = step
+
+        if record:
+            self.put((step, record))
+        if self.counts and max(self.counts.values()) >= self.flush_every:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """Writes and returns the averages of the aggregated tensor metrics, a single device to host copy"""
+        if not self.sums:
+            return None
+        names = list(self.sums)
+        means = torch.stack([self.sums[name] / self.counts[name] for name in names]).cpu().tolist()
+        self.sums, self.counts = {}, {}
+        record = dict(zip(names, means))
+        self.put((self.last_step, record))
+        return record
+
+    def put(self, item: Union[None, tuple]):
+        if self.thread is None:
+            return
+        # Blocks while the queue is full, unless the writer thread died
+        while True:
+            if self.error is not None:
+                raise RuntimeError(f"Metrics writer failed: {self.error}")
+            try:
+                self.queue.put(item, timeout=1.0)
+                return
+            except queue.Full:
+                continue
+
+    def encode(self, step: int, record: dict):
+        if self.format == "jsonl":
+            return (json.dumps({"step": step, **record}) + "\n").encode()
+
+        new_keys = [name for name in record if name not in self.keys]
+        for name in new_keys:
+            self.keys[name] = len(self.keys)
+        if new_keys:
+            # New names are rare, the sidecar is replaced atomically
+            with open(self.keys_path + ".tmp", "w") as file:
+                json.dump(self.keys, file)
+            os.replace(self.keys_path + ".tmp", self.keys_path)
+
+        records = np.zeros(len(record), dtype=BINARY_RECORD)
+        records["step"] = step
+        records["key"] = [self.keys[name] for name in record]
+        records["value"] = list(record.values())
+        return records.tobytes()
+
+    def run(self):
+        try:
+            with open(self.path, "ab") as file:
+                last_fsync = time.monotonic()
+                while True:
+                    item = self.queue.get()
+                    if item is None:
+                        break
+                    # Write everything already queued in one go
+                    chunks = [self.encode(*item)]
+                    while not self.queue.empty():
+                        item = self.queue.get()
+                        if item is None:
+                            break
+                        chunks.append(self.encode(*item))
+                    file.write(b"".join(chunks))
+                    file.flush()
+
+                    if time.monotonic() - last_fsync >= self.fsync_interval:
+                        os.fsync(file.fileno())
+                        last_fsync = time.monotonic()
+                    if item is None:
+                        break
+                file.flush()
+                os.fsync(file.fileno())
+        except Exception as error:
+            self.error = error
+
+    def close(self):
+        """Flushes and stops the writer, returns the last record of averages like flush"""
+        record = self.flush()
+        if self.thread is not None:
+            self.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise RuntimeError(f"Metrics writer failed: {self.error}")
+        return record
+
+
+def read_metrics(path: str):
+    """
+    Reads a MetricsWriter file, binary files in one vectorized read.
+
+    Returns:
+        {name: (steps, values)} numpy arrays per metric
+    """
+    if os.path.exists(path + ".keys.json"):
+        keys = json.load(open(path + ".keys.json"))
+        records = np.fromfile(path, dtype=BINARY_RECORD)
+        metrics = {}
+        for name, key in keys.items():
+            selected = records[records["key"] == key]
+            metrics[name] = (selected["step"], selected["value"])
+        return metrics
+
+    steps, values = {}, {}
+    with open(path) as file:
+        for line in file:
+            record = json.loads(line)
+            step = record.pop("step")
+            for name, value in record.items():
+                steps.setdefault(name, []).append(step)
+                values.setdefault(name, []).append(value)
+    return {name: (np.array(steps[name]), np.array(values[name])) for name in steps}
@@ -0,0 +1,296 @@
+"""
+Sharded image dataset for corpora too large for random small file access. An image folder is written once into tar
+shards of shard_size encoded images, in a seeded random order, and training streams whole shards sequentially.
+
+Layout of shard_dir:
+    index.json          classes, shard names and sample counts
+    shard-000000.tar    {key}.{ext} encoded images and {key}.cls labels
+    shard-000000.npy    (n, 3) int64 data offset, size and label of every image, to read a shard without parsing it
+
+Every epoch the shards are permuted with seed + epoch. Rank r of R takes every R-th shard and worker w of W of its
+shards every W-th, each worker then streams its shards through a shuffle buffer seeded by (seed, epoch, rank, worker).
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import io
+import json
+import tarfile
+import numpy as np
+import torch
+import multiprocessing as mp
+from PIL import Image
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+from torchvision import transforms
+from typing import List
+
+INDEX_FILE = "index.json"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+def list_images(image_dir: str):
+    """(paths, labels, classes), images of a sub folder labelled by the sorted folder names, 0 at the top level"""
+    classes = sorted(
+        entry.name for entry in os.scandir(image_dir) if entry.is_dir() and not entry.name.startswith(".")
+    )
+    class_idx = {name: idx for idx, name in enumerate(classes)}
+    paths, labels = [], []
+    for root, _, files in os.walk(image_dir):
+        relative = os.path.relpath(root, image_dir)
+        label = class_idx[relative.split(os.sep)[0]] if relative != "." else 0
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(root, name))
+                labels.append(label)
+    return paths, labels, classes
+
+
+def shard_name(idx: int):
+    return f"shard-{idx:06d}"
+
+
+def _write_shard(args: tuple):
+    shard_dir, idx, start, paths, labels = args
+    name = shard_name(idx)
+    records = np.zeros((len(paths), 3), dtype=np.int64)
+    with tarfile.open(os.path.join(shard_dir, name + ".tar"), "w") as tar:
+        for i, (path, label) in enumerate(zip(paths, labels)):
+            key = f"{start + i:09d}"
+            data = open(path, "rb").read()
+            info = tarfile.TarInfo(key + os.path.splitext(path)[1].lower())
+            info.size = len(data)
+            # The data of a member follows its header
+            records[i] = (tar.offset + len(info.tobuf(tar.format)), len(data), label)
+            tar.addfile(info, io.BytesIO(data))
+
+            data = str(label).encode()
+            info = tarfile.TarInfo(key + ".cls")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    np.save(os.path.join(shard_dir, name + ".npy"), records)
+    return name, len(paths)
+
+
+def write_shards(image_dir: str, shard_dir: str, shard_size=1000, num_workers: int = None, seed=0):
+    """Writes every image of image_dir into shards of shard_size images, num_workers processes writing shards"""
+    os.makedirs(shard_dir, exist_ok=True)
+    paths, labels, classes = list_images(image_dir)
+    assert paths, f"No images in {image_dir}"
+    order = np.random.default_rng(seed).permutation(len(paths))
+    paths = [paths[idx] for idx in order]
+    labels = [labels[idx] for idx in order]
+
+    jobs = [
+        (shard_dir, idx, start, paths[start : start + shard_size], labels[start : start + shard_size])
+        for idx, start in enumerate(range(0, len(paths), shard_size))
+    ]
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(num_workers or os.cpu_count()) as pool:
+        shards = pool.map(_write_shard, jobs)
+
+    index = {
+        "image_dir": image_dir,
+        "classes": classes,
+        "num_samples": len(paths),
+        "shards": [{"name": name, "num_samples": num_samples} for name, num_samples in shards],
+    }
+    # Written last, shards without an index are incomplete
+    with open(os.path.join(shard_dir, INDEX_FILE), "w") as file:
+        json.dump(index, file)
+    return index
+
+
+def get_rank():
+    """(rank, num_ranks) of this process from torch.distributed or the launcher environment"""
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return int(os.environ.get("RANK", 0)), int(os.environ.get("WORLD_SIZE", 1))
+
+
+class ShardedImageDataset(IterableDataset):
+    """
+    Streams the (x, y) images of a write_shards directory, resized to cover input_res, center cropped and normalized.
+
+    With R ranks, accelerator.prepare_data_loader (without dispatch_batches) keeps the r-th batch_size slice of
+    every R * batch_size samples of each stream. Each rank only reads its own shards and fills the slices of the
+    other ranks with None, so every rank yields the same number of samples: the smallest count of its workers
+    over the ranks, in whole batches.
+
+    Args:
+        shard_dir (str): Output of write_shards,
+        batch_size (int): Per rank batch size of the DataLoader,
+        num_workers (int): Workers of the DataLoader,
+        shuffle_buffer (int): Samples shuffled together, 0 streams the shards in order,
+        seed (int): Seed of the shard permutations and shuffle buffers
+    """
+
+    def __init__(
+        self,
+        shard_dir: str,
+        input_res: List[int],
+        mean: List[float],
+        std: List[float],
+        batch_size: int,
+        num_workers=0,
+        shuffle_buffer=1000,
+        seed=0,
+    ):
+        index_path = os.path.join(shard_dir, INDEX_FILE)
+        assert os.path.exists(index_path), f"No shards in {shard_dir}, write them with trainers/write_shards.py"
+        self.index = json.load(open(index_path))
+        self.shard_dir = shard_dir
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.skip_batches = 0
+        self.transform = transforms.Compose(
+            [
+                transforms.ToTensor(),
+                transforms.Resize(size=min(input_res)),
+                transforms.CenterCrop(size=input_res),
+                transforms.Normalize(mean=mean, std=std),
+            ]
+        )
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def shard_order(self, epoch: int):
+        generator = torch.Generator().manual_seed(self.seed + epoch)
+        return torch.randperm(len(self.index["shards"]), generator=generator).tolist()
+
+    def worker_shards(self, epoch: int, rank: int, num_ranks: int, worker: int, num_workers: int):
+        return self.shard_order(epoch)[rank::num_ranks][worker::num_workers]
+
+    def worker_length(self, epoch: int, num_ranks: int, worker: int, num_workers: int):
+        """Samples worker yields on every rank, the same whole number of batches for all of them"""
+        counts = [
+            sum(
+                self.index["shards"][shard]["num_samples"]
+                for shard in self.worker_shards(epoch, rank, num_ranks, worker, num_workers)
+            )
+            for rank in range(num_ranks)
+        ]
+        return min(counts) // self.batch_size * self.batch_size
+
+    def __len__(self):
+        # Over the workers of every rank, what prepare_data_loader expects of the dataset
+        _, num_ranks = get_rank()
+        return num_ranks * sum(
+            self.worker_length(self.epoch, num_ranks, worker, max(1, self.num_workers))
+            for worker in range(max(1, self.num_workers))
+        )
+
+    def records(self, shard: int):
+        name = self.index["shards"][shard]["name"]
+        return np.load(os.path.join(self.shard_dir, name + ".npy"))
+
+    def read(self, shard: int, offset: int, size: int):
+        name = self.index["shards"][shard]["name"]
+        with open(os.path.join(self.shard_dir, name + ".tar"), "rb") as file:
+            file.seek(offset)
+            return file.read(size)
+
+    def decode(self, data: bytes, label: int):
+        image = Image.open(io.BytesIO(data)).convert("RGB")
+        return self.transform(image), label
+
+    def samples(self, shards: List[int], generator: torch.Generator, skip=0):
+        """
+        (data, label) of the shards in order through the shuffle buffer, after the first skip of them. While skipping
+        only the records are shuffled, the images still in the buffer after it are read on their own.
+        """
+        buffer = []
+        taken = 0
+
+        def take():
+            nonlocal taken
+            idx = int(torch.randint(len(buffer), size=[], generator=generator))
+            sample, buffer[idx] = buffer[idx], buffer[-1]
+            buffer.pop()
+            taken += 1
+            return sample
+
+        def load(sample: tuple):
+            shard, offset, size, label, data = sample
+            return (data if data is not None else self.read(shard, offset, size)), label
+
+        for shard in shards:
+            name = self.index["shards"][shard]["name"]
+            with open(os.path.join(self.shard_dir, name + ".tar"), "rb") as file:
+                for offset, size, label in self.records(shard).tolist():
+                    data = None
+                    if taken >= skip:
+                        file.seek(offset)
+                        data = file.read(size)
+                    buffer.append((shard, offset, size, label, data))
+                    if len(buffer) > self.shuffle_buffer:
+                        sample = take()
+                        if taken > skip:
+                            yield load(sample)
+        while buffer:
+            sample = take()
+            if taken > skip:
+                yield load(sample)
+
+    def set_position(self, epoch: int, batches: int):
+        """Starts the next iteration at epoch after batches consumed over all the ranks"""
+        _, num_ranks = get_rank()
+        self.epoch = epoch
+        self.skip_batches = batches // num_ranks
+
+    def resume_plan(self, epoch: int, num_ranks: int, num_workers: int, batches: int):
+        """
+        Batches consumed of every worker once the loader yielded batches, the loader taking turns over the workers
+        still streaming, and the worker to act as each worker of the loader, which starts its turns at worker 0
+        """
+        lengths = [
+            self.worker_length(epoch, num_ranks, worker, num_workers) // self.batch_size
+            for worker in range(num_workers)
+        ]
+        skips = [0] * num_workers
+        turn = 0
+        for _ in range(min(batches, sum(lengths))):
+            while skips[turn] >= lengths[turn]:
+                turn = (turn + 1) % num_workers
+            skips[turn] += 1
+            turn = (turn + 1) % num_workers
+        return skips, [(turn + worker) % num_workers for worker in range(num_workers)]
+
+    def __iter__(self):
+        epoch = self.epoch
+        # Persistent workers keep their copy, the next iteration is the next epoch from the start
+        self.epoch += 1
+        skip_batches, self.skip_batches = self.skip_batches, 0
+        rank, num_ranks = get_rank()
+        worker_info = get_worker_info()
+        worker, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+
+        skips, order = self.resume_plan(epoch, num_ranks, num_workers, skip_batches)
+        worker = order[worker]
+        skip = skips[worker]
+        shards = self.worker_shards(epoch, rank, num_ranks, worker, num_workers)
+        length = self.worker_length(epoch, num_ranks, worker, num_workers)
+        generator = torch.Generator().manual_seed(hash((self.seed, epoch, rank, worker)) % 2**63)
+
+        samples = self.samples(shards, generator, skip * self.batch_size)
+        for _ in range(length // self.batch_size - skip):
+            # Slices of the other ranks are dropped by prepare_data_loader before collation
+            for slot in range(num_ranks):
+                for _ in range(self.batch_size):
+                    yield self.decode(*next(samples)) if slot == rank else None
+
+
+def get_sharded_loader(dataset: ShardedImageDataset):
+    # Persistent, so the copy of the dataset in every worker keeps counting epochs
+    return DataLoader(
+        dataset,
+        batch_size=dataset.batch_size,
+        drop_last=True,
+        num_workers=dataset.num_workers,
+        persistent_workers=dataset.num_workers > 0,
+    )
@@ -0,0 +1,211 @@
+"""
+Pre-tokenized text corpus for GPT: text files are tokenized once, character level with ByteTokenizer or with a
+BPETokenizer (classes/BPE.py), in parallel chunks into a flat memory mapped array. Training then samples random
+windows from it without tokenizing anything.
+
+Layout of corpus_dir:
+    manifest.json   tokenizer, vocab and array description
+    tokens.npy      (N) token ids, uint8 for vocabs of up to 256 ids else uint16
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import json
+import numpy as np
+import torch
+import multiprocessing as mp
+from torch.utils.data import Dataset, Sampler
+from typing import List, Union
+from classes.Transformers import ByteTokenizer
+from classes.BPE import BPETokenizer
+
+MANIFEST_FILE = "manifest.json"
+TOKENS_FILE = "tokens.npy"
+
+
+def chunk_bounds(path: str, chunk_bytes: int):
+    """(path, start, end) byte ranges of about chunk_bytes, cut after a newline so no UTF-8 character is split"""
+    size = os.path.getsize(path)
+    bounds = []
+    with open(path, "rb") as file:
+        start = 0
+        while start < size:
+            file.seek(min(start + chunk_bytes, size))
+            file.readline()
+            end = min(file.tell(), size)
+            bounds.append((path, start, end))
+            start = end
+    return bounds
+
+
+def read_chunk(bounds: tuple):
+    path, start, end = bounds
+    with open(path, "rb") as file:
+        file.seek(start)
+        return file.read(end - start).decode("utf-8")
+
+
+def text_to_codepoints(text: str):
+    return np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+
+
+# Tokenizer of every worker, loaded on first use
+_tokenizers = {}
+
+
+def get_tokenizer(chars: Union[None, List[str]], bpe_path: Union[None, str]):
+    key = bpe_path or "".join(chars)
+    if key not in _tokenizers:
+        _tokenizers[key] = BPETokenizer.load(bpe_path) if bpe_path else ByteTokenizer(chars)
+    return _tokenizers[key]
+
+
+def _chunk_vocab(bounds: tuple):
+    codepoints = text_to_codepoints(read_chunk(bounds))
+    return np.unique(codepoints), len(codepoints)
+
+
+def _encode_chunk(args: tuple):
+    bounds, offset, chars, tokens_path = args
+    ids = get_tokenizer(chars, None).encode(read_chunk(bounds))
+    tokens = np.load(tokens_path, mmap_mode="r+")
+    tokens[offset : offset + len(ids)] = ids
+    tokens.flush()
+    return len(ids)
+
+
+def _bpe_encode_chunk(args: tuple):
+    # BPE lengths are only known after encoding, chunks go to their own file first
+    bounds, bpe_path, chunk_path = args
+    ids = get_tokenizer(None, bpe_path).encode(read_chunk(bounds))
+    np.save(chunk_path, ids.astype(np.uint16))
+    return len(ids)
+
+
+def prepare_text_corpus(
+    paths: List[str],
+    corpus_dir: str,
+    chars: Union[None, List[str]] = None,
+    bpe_path: Union[None, str] = None,
+    num_workers: int = None,
+    chunk_bytes=16 * 2**20,
+):
+    """
+    Tokenizes the text files into corpus_dir with num_workers processes, defaulting to every core, character level
+    (vocab chars, collected from the text when not given) or with the BPETokenizer saved at bpe_path.
+    Character level, the first pass measures every chunk and the second writes the ids of each chunk straight to its
+    offset in the memory mapped array. With BPE every chunk is encoded to a temporary file and then copied in order.
+    No process ever holds more than a chunk.
+    """
+    os.makedirs(corpus_dir, exist_ok=True)
+    bounds = [bound for path in paths for bound in chunk_bounds(path, chunk_bytes)]
+    tokens_path = os.path.join(corpus_dir, TOKENS_FILE)
+
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(num_workers or os.cpu_count()) as pool:
+        if bpe_path is not None:
+            vocab_size = BPETokenizer.load(bpe_path).vocab_size
+            assert vocab_size <= 2**16, "BPE vocabs of more than 65536 ids are not supported"
+            dtype = np.uint16
+            chunk_paths = [
+                os.path.join(corpus_dir, f"chunk_{idx}.npy") for idx in range(len(bounds))
+            ]
+            lengths = pool.map(
+                _bpe_encode_chunk,
+                [(bound, bpe_path, chunk_path) for bound, chunk_path in zip(bounds, chunk_paths)],
+            )
+            tokens = np.lib.format.open_memmap(
+                tokens_path, mode="w+", dtype=dtype, shape=(sum(lengths),)
+            )
+            offset = 0
+            for chunk_path, length in zip(chunk_paths, lengths):
+                tokens[offset : offset + length] = np.load(chunk_path)
+                offset += length
+                os.remove(chunk_path)
+            tokens.flush()
+            del tokens
+        else:
+            measured = pool.map(_chunk_vocab, bounds)
+
+            if chars is None:
+                vocab_codepoints = np.unique(np.concatenate([chunk[0] for chunk in measured]))
+                chars = [chr(codepoint) for codepoint in vocab_codepoints]
+            vocab_size = len(chars)
+            assert vocab_size <= 2**16, "Vocabs of more than 65536 chars are not supported"
+            dtype = np.uint8 if vocab_size <= 2**8 else np.uint16
+
+            lengths = [chunk[1] for chunk in measured]
+            offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            tokens = np.lib.format.open_memmap(
+                tokens_path, mode="w+", dtype=dtype, shape=(sum(lengths),)
+            )
+            del tokens
+
+            pool.map(
+                _encode_chunk,
+                [
+                    (bound, int(offset), chars, tokens_path)
+                    for bound, offset in zip(bounds, offsets)
+                ],
+            )
+
+    manifest = {
+        "paths": paths,
+        "tokenizer": "bpe" if bpe_path is not None else "char",
+        "chars": chars,
+        "bpe_path": bpe_path,
+        "vocab_size": vocab_size,
+        "num_tokens": int(sum(lengths)),
+        "dtype": np.dtype(dtype).name,
+    }
+    # Written last, a corpus without a manifest is incomplete
+    with open(os.path.join(corpus_dir, MANIFEST_FILE), "w") as file:
+        json.dump(manifest, file)
+    return manifest
+
+
+class TextWindowDataset(Dataset):
+    """
+    Every context long window of a prepare_text_corpus directory, item idx is the (x, y) pair starting at token idx,
+    y shifted by one. Windows are sliced straight out of the memory mapped array.
+    """
+
+    def __init__(self, corpus_dir: str, context: int):
+        manifest_path = os.path.join(corpus_dir, MANIFEST_FILE)
+        assert os.path.exists(manifest_path), f"No text corpus in {corpus_dir}, build it with prepare_text_corpus"
+        self.manifest = json.load(open(manifest_path))
+        self.chars = self.manifest["chars"]
+        self.vocab_size = self.manifest["vocab_size"]
+        self.tokens = np.load(os.path.join(corpus_dir, TOKENS_FILE), mmap_mode="r")
+        self.context = context
+        assert len(self.tokens) > context, "Corpus is shorter than the context"
+
+    def __len__(self):
+        return len(self.tokens) - self.context
+
+    def __getitem__(self, idx: int):
+        window = torch.from_numpy(self.tokens[idx : idx + self.context + 1].astype(np.int64))
+        return window[:-1], window[1:]
+
+
+class RandomWindowSampler(Sampler):
+    """num_samples random window starts per epoch, with replacement, seeded by seed and the epoch"""
+
+    def __init__(self, dataset: TextWindowDataset, num_samples: int, seed=0):
+        self.num_windows = len(dataset)
+        self.num_samples = num_samples
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        starts = torch.randint(self.num_windows, size=[self.num_samples], generator=generator)
+        return iter(starts.tolist())
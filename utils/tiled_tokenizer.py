@@ -0,0 +1,156 @@
+import torch
+from torch import nn
+from typing import List
+
+
+def tile_starts(size: int, tile: int, stride: int) -> List[int]:
+    """Start offsets covering [0, size), the last tile is moved back to end at the border"""
+    if size <= tile:
+        return [0]
+    starts = list(range(0, size - tile, stride))
+    starts.append(size - tile)
+    return starts
+
+
+def blend_ramp(tile: int, overlap: int, device=None):
+    """(tile) weights rising linearly across the overlap on both sides, 1 in the middle"""
+    pos = torch.arange(tile, device=device, dtype=torch.float32)
+    ramp = torch.minimum(pos + 0.5, tile - pos - 0.5)
+    return (ramp / max(overlap, 1)).clamp(max=1.0)
+
+
+def clamp_tiling(tile_size: int, overlap: int, H: int, W: int, factor: int):
+    """tile_size and overlap for an (H, W) image, a single tile has no overlap"""
+    tile_size = min(tile_size, H, W)
+    if tile_size >= H and tile_size >= W:
+        return tile_size, 0
+    return tile_size, min(overlap, tile_size - factor)
+
+
+def _tiles(B: int, H: int, W: int, tile: int, overlap: int):
+    # (b, top, left) of every tile of every image
+    stride = tile - overlap
+    return [
+        (b, top, left)
+        for b in range(B)
+        for top in tile_starts(H, tile, stride)
+        for left in tile_starts(W, tile, stride)
+    ]
+
+
+@torch.no_grad()
+def tiled_encode(
+    model: nn.Module, img: torch.Tensor, tile_size=256, overlap=32, batch_size=8
+):
+    """
+    Tokenizes an image of any size tile by tile with a Swin tokenizer (model_archs/swin_fsqvae.py).
+
+    Tiles of tile_size pixels overlapping by overlap pixels are encoded and quantized batch_size at a time, so the
+    activation memory is that of one batch of tiles whatever the image size. Each tile only contributes the tokens
+    of its central region, up to overlap / 2 pixels from the neighbouring tiles.
+    Throughput is that of model.encode on batch_size tiles, ceil((H - overlap) / (tile_size - overlap)) *
+    ceil((W - overlap) / (tile_size - overlap)) tiles per image.
+
+    Args:
+        img: (B, C, H, W), H and W divisible by the model's downsampling factor
+        tile_size, overlap: in pixels, divisible by the downsampling factor, clamped to the image
+
+    Returns:
+        indices: (B, H / factor, W / factor) token grid
+    """
+    B, C, H, W = img.shape
+    factor = model.downsample_factor
+    tile_size, overlap = clamp_tiling(tile_size, overlap, H, W, factor)
+    assert (
+        tile_size % factor == 0 and overlap % factor == 0
+    ), f"tile_size and overlap must be divisible by {factor}"
+    assert 0 <= overlap < tile_size, "overlap must be smaller than tile_size"
+
+    latent_tile = tile_size // factor
+    latent_overlap = overlap // factor
+    indices = None
+
+    tiles = _tiles(B, H, W, tile_size, overlap)
+    for start in range(0, len(tiles), batch_size):
+        batch = tiles[start : start + batch_size]
+        x = torch.stack(
+            [img[b, :, top : top + tile_size, left : left + tile_size] for b, top, left in batch]
+        )
+        _, tile_indices = model.quantize(model.encode(x))
+        tile_indices = tile_indices.view(len(batch), latent_tile, latent_tile)
+
+        if indices is None:
+            indices = tile_indices.new_zeros(B, H // factor, W // factor)
+
+        for tile_idx, (b, top, left) in enumerate(batch):
+            top, left = top // factor, left // factor
+            # Central region, extended to the border for tiles at the image border
+            h0 = 0 if top == 0 else latent_overlap // 2
+            w0 = 0 if left == 0 else latent_overlap // 2
+            h1 = latent_tile if top + latent_tile == H // factor else latent_tile - latent_overlap // 2
+            w1 = latent_tile if left + latent_tile == W // factor else latent_tile - latent_overlap // 2
+            indices[b, top + h0 : top + h1, left + w0 : left + w1] = tile_indices[
+                tile_idx, h0:h1, w0:w1
+            ]
+
+    return indices
+
+
+@torch.no_grad()
+def tiled_decode(
+    model: nn.Module, indices: torch.Tensor, tile_size=256, overlap=32, batch_size=8
+):
+    """
+    Decodes a (B, H_l, W_l) token grid of any size tile by tile, the inverse of tiled_encode.
+
+    Latent tiles are decoded batch_size at a time and blended into the image with weights ramping linearly across
+    the overlap, which hides the tile seams. Activation memory is that of one batch of tiles, only the output image
+    grows with the size. Throughput is that of model.decode on batch_size tiles.
+
+    Args:
+        indices: (B, H_l, W_l) token grid
+        tile_size, overlap: in pixels, divisible by the downsampling factor, clamped to the image
+
+    Returns:
+        (B, C, H, W) image
+    """
+    B, H_l, W_l = indices.shape
+    factor = model.downsample_factor
+    tile_size, overlap = clamp_tiling(tile_size, overlap, H_l * factor, W_l * factor, factor)
+    assert (
+        tile_size % factor == 0 and overlap % factor == 0
+    ), f"tile_size and overlap must be divisible by {factor}"
+    assert 0 <= overlap < tile_size, "overlap must be smaller than tile_size"
+
+    latent_tile = tile_size // factor
+    ramp = blend_ramp(tile_size, overlap, indices.device)
+    weight = ramp[:, None] * ramp[None, :]  # (T, T)
+
+    img = None
+    weight_sum = torch.zeros(H_l * factor, W_l * factor, device=indices.device)
+
+    tiles = _tiles(B, H_l, W_l, latent_tile, overlap // factor)
+    for start in range(0, len(tiles), batch_size):
+        batch = tiles[start : start + batch_size]
+        tile_indices = torch.stack(
+            [
+                indices[b, top : top + latent_tile, left : left + latent_tile].reshape(-1)
+                for b, top, left in batch
+            ]
+        )
+        z_q = model.quantizer.indices_to_codes(tile_indices)
+        recon = model.decode(z_q, [latent_tile, latent_tile])  # (n, C, T, T)
+
+        if img is None:
+            img = recon.new_zeros(B, recon.shape[1], H_l * factor, W_l * factor)
+
+        for tile_idx, (b, top, left) in enumerate(batch):
+            top, left = top * factor, left * factor
+            img[b, :, top : top + tile_size, left : left + tile_size] += (
+                recon[tile_idx] * weight
+            )
+            # Every image shares the same tiling
+            if b == 0:
+                weight_sum[top : top + tile_size, left : left + tile_size] += weight
+
+    return img / weight_sum
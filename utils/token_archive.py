@@ -0,0 +1,267 @@
+"""
+Entropy coded archive of tokenized images.
+
+Every image is an independent rANS stream, the offsets table gives random access to each of them. The probability
+model is measured on the indices being archived (unigram or per position frequencies) and stored in the archive, or
+comes from a GPT prior (classes/Transformers.py) which has to be passed again when reading.
+
+Layout:
+    b"TKAR" | header length (uint32) | json header | model tables (uint32) | offsets (uint64, N + 1) | streams
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import json
+import numpy as np
+import torch
+from typing import List, Union
+from utils.index_packing import bits_per_index, index_dtype
+
+MAGIC = b"TKAR"
+VERSION = 1
+
+# rANS state is kept in [RANS_L, 256 * RANS_L) and renormalized a byte at a time
+RANS_L = 1 << 23
+MODELS = ["unigram", "positional", "gpt"]
+
+
+def quantize_probs(probs: np.ndarray, scale_bits: int):
+    """(..., V) probabilities to integer frequencies summing to 2 ** scale_bits, every symbol keeps at least 1"""
+    total = 1 << scale_bits
+    V = probs.shape[-1]
+    probs = probs / probs.sum(axis=-1, keepdims=True)
+    freqs = np.floor(probs * (total - V)).astype(np.int64) + 1
+    # Rounding leftovers go to the most likely symbol
+    top = probs.argmax(axis=-1)[..., None]
+    remainder = total - freqs.sum(axis=-1, keepdims=True)
+    np.put_along_axis(freqs, top, np.take_along_axis(freqs, top, axis=-1) + remainder, axis=-1)
+    return freqs
+
+
+def cumulative(freqs: np.ndarray):
+    """(..., V) frequencies to (..., V + 1) starts"""
+    cum = np.zeros((*freqs.shape[:-1], freqs.shape[-1] + 1), dtype=np.int64)
+    np.cumsum(freqs, axis=-1, out=cum[..., 1:])
+    return cum
+
+
+def rans_encode(symbols: List[int], freqs: List[np.ndarray], cums: List[np.ndarray], scale_bits: int):
+    """Encodes symbols, symbol t with the frequencies freqs[t], returns the stream as bytes"""
+    out = bytearray()
+    x = RANS_L
+    # rANS is last in first out, encode backwards so that decoding runs forwards
+    for t in range(len(symbols) - 1, -1, -1):
+        s = symbols[t]
+        freq, start = int(freqs[t][s]), int(cums[t][s])
+        x_max = ((RANS_L >> scale_bits) << 8) * freq
+        while x >= x_max:
+            out.append(x & 0xFF)
+            x >>= 8
+        x = ((x // freq) << scale_bits) + (x % freq) + start
+    out.extend(x.to_bytes(4, "little"))
+    out.reverse()
+    return bytes(out)
+
+
+class RANSDecoder:
+    def __init__(self, stream: Union[bytes, np.ndarray], scale_bits: int):
+        self.stream = bytes(stream)
+        self.scale_bits = scale_bits
+        self.x = int.from_bytes(self.stream[:4], "big")
+        self.pos = 4
+
+    def decode(self, freqs: np.ndarray, cum: np.ndarray):
+        slot = self.x & ((1 << self.scale_bits) - 1)
+        s = int(np.searchsorted(cum, slot, side="right")) - 1
+        self.x = int(freqs[s]) * (self.x >> self.scale_bits) + slot - int(cum[s])
+        while self.x < RANS_L:
+            self.x = (self.x << 8) | self.stream[self.pos]
+            self.pos += 1
+        return s
+
+
+class GPTPrior:
+    """
+    Next token frequencies from a GPT over the indices, started with start_token as in model_archs/vq_transformer.py.
+    Encoding and decoding both step through the KV cache one token at a time so that they see identical
+    probabilities.
+    """
+
+    def __init__(self, gpt: torch.nn.Module, codebook_size: int, scale_bits: int, start_token=0):
+        self.gpt = gpt
+        self.codebook_size = codebook_size
+        self.scale_bits = scale_bits
+        self.start_token = start_token
+        self.device = next(gpt.parameters()).device
+
+    @torch.no_grad()
+    def start(self):
+        self.kv_caches = self.gpt.new_kv_caches()
+        return self.step(self.start_token)
+
+    @torch.no_grad()
+    def step(self, token: int):
+        """Feeds token, returns the (freqs, cum) of the next one"""
+        x = torch.tensor([[token]], device=self.device)
+        logits, _ = self.gpt.forward(x, kv_caches=self.kv_caches)
+        # Tokens past the codebook (e.g. a mask token) are never coded
+        probs = self.gpt.probs(logits[0, -1])[: self.codebook_size]
+        freqs = quantize_probs(probs.double().cpu().numpy(), self.scale_bits)
+        return freqs, cumulative(freqs)
+
+
+def fit_tables(indices: np.ndarray, codebook_size: int, model: str, scale_bits: int):
+    """(N, L) indices to the (1 or L, V) frequency tables of model, add one smoothed"""
+    if model == "unigram":
+        counts = np.bincount(indices.reshape(-1), minlength=codebook_size)[None]
+    else:
+        N, L = indices.shape
+        flat = (np.arange(L)[None] * codebook_size + indices).reshape(-1)
+        counts = np.bincount(flat, minlength=L * codebook_size).reshape(L, codebook_size)
+    return quantize_probs(counts + 1.0, scale_bits)
+
+
+def write_token_archive(
+    path: str,
+    indices: Union[torch.Tensor, np.ndarray],
+    codebook_size: int,
+    model="positional",
+    gpt: Union[None, torch.nn.Module] = None,
+    scale_bits=16,
+):
+    """
+    Args:
+        indices: (N, ...) tokens of N images, e.g. (N, H_l * W_l) from encode_to_indices
+        model: one of MODELS, "gpt" needs the gpt prior
+        scale_bits: precision of the quantized probabilities, 2 ** scale_bits must exceed codebook_size
+
+    Returns:
+        stats: bits per token of the streams alone and of the whole file, against the packed raw indices
+    """
+    assert model in MODELS, f"model must be one of {MODELS}"
+    assert (1 << scale_bits) > codebook_size, "2 ** scale_bits must exceed codebook_size"
+    assert scale_bits <= 23, "scale_bits must be at most 23"
+    assert model != "gpt" or gpt is not None, "model gpt needs the gpt prior"
+
+    if isinstance(indices, torch.Tensor):
+        indices = indices.cpu().numpy()
+    token_shape = list(indices.shape[1:])
+    indices = indices.reshape(indices.shape[0], -1).astype(np.int64)
+    N, L = indices.shape
+
+    if model == "gpt":
+        assert L < gpt.context, "tokens per image plus the start token must fit the gpt context"
+        prior = GPTPrior(gpt, codebook_size, scale_bits)
+        tables = np.zeros((0, codebook_size), dtype=np.int64)
+    else:
+        tables = fit_tables(indices, codebook_size, model, scale_bits)
+        table_cums = cumulative(tables)
+
+    streams = []
+    for image in indices:
+        if model == "gpt":
+            steps = [prior.start()]
+            steps += [prior.step(int(token)) for token in image[:-1]]
+            freqs, cums = [step[0] for step in steps], [step[1] for step in steps]
+        elif model == "unigram":
+            freqs, cums = [tables[0]] * L, [table_cums[0]] * L
+        else:
+            freqs, cums = tables, table_cums
+        streams.append(rans_encode(image.tolist(), freqs, cums, scale_bits))
+
+    offsets = np.zeros(N + 1, dtype=np.uint64)
+    offsets[1:] = np.cumsum([len(stream) for stream in streams])
+    header = json.dumps(
+        {
+            "version": VERSION,
+            "model": model,
+            "codebook_size": codebook_size,
+            "token_shape": token_shape,
+            "num_images": N,
+            "scale_bits": scale_bits,
+            "table_shape": list(tables.shape),
+        }
+    ).encode()
+
+    with open(path, "wb") as file:
+        file.write(MAGIC)
+        file.write(np.uint32(len(header)).tobytes())
+        file.write(header)
+        file.write(tables.astype(np.uint32).tobytes())
+        file.write(offsets.tobytes())
+        for stream in streams:
+            file.write(stream)
+
+    stream_bits = 8 * int(offsets[-1])
+    return {
+        "bits_per_token": stream_bits / (N * L),
+        "file_bits_per_token": 8 * os.path.getsize(path) / (N * L),
+        "raw_bits_per_token": bits_per_index(codebook_size),
+    }
+
+
+class TokenArchive:
+    """
+    Random access reader of write_token_archive files, archive[idx] decodes a single image. Archives written with the
+    gpt model need the same gpt.
+    """
+
+    def __init__(self, path: str, gpt: Union[None, torch.nn.Module] = None):
+        self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        assert bytes(self.data[:4]) == MAGIC, f"{path} is not a token archive"
+        header_len = int(self.data[4:8].view(np.uint32)[0])
+        self.header = json.loads(bytes(self.data[8 : 8 + header_len]))
+        assert self.header["version"] == VERSION, "Unsupported archive version"
+
+        self.codebook_size = self.header["codebook_size"]
+        self.token_shape = self.header["token_shape"]
+        self.num_tokens = int(np.prod(self.token_shape))
+        self.scale_bits = self.header["scale_bits"]
+        self.model = self.header["model"]
+
+        start = 8 + header_len
+        table_shape = self.header["table_shape"]
+        table_len = int(np.prod(table_shape)) * 4
+        self.tables = (
+            self.data[start : start + table_len].view(np.uint32).reshape(table_shape).astype(np.int64)
+        )
+        self.table_cums = cumulative(self.tables)
+        start += table_len
+
+        offsets_len = (self.header["num_images"] + 1) * 8
+        self.offsets = self.data[start : start + offsets_len].view(np.uint64)
+        self.streams_start = start + offsets_len
+
+        if self.model == "gpt":
+            assert gpt is not None, "Archive was written with a gpt prior, pass the same gpt"
+            self.prior = GPTPrior(gpt, self.codebook_size, self.scale_bits)
+
+    def __len__(self):
+        return self.header["num_images"]
+
+    def __getitem__(self, idx: int):
+        begin = self.streams_start + int(self.offsets[idx])
+        end = self.streams_start + int(self.offsets[idx + 1])
+        decoder = RANSDecoder(self.data[begin:end], self.scale_bits)
+
+        tokens = []
+        if self.model == "gpt":
+            freqs, cum = self.prior.start()
+            for t in range(self.num_tokens):
+                tokens.append(decoder.decode(freqs, cum))
+                if t < self.num_tokens - 1:
+                    freqs, cum = self.prior.step(tokens[-1])
+        else:
+            for t in range(self.num_tokens):
+                row = 0 if self.model == "unigram" else t
+                tokens.append(decoder.decode(self.tables[row], self.table_cums[row]))
+
+        return torch.tensor(tokens, dtype=index_dtype(self.codebook_size)).view(
+            self.token_shape
+        )
+
+    @property
+    def bits_per_token(self):
+        return 8 * int(self.offsets[-1]) / (len(self) * self.num_tokens)
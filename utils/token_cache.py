@@ -0,0 +1,140 @@
+"""
+Offline token cache: a frozen tokenizer is run once over a dataset and its indices are stored as a memory mapped
+(N, L) array next to a manifest, so prior training reads tokens instead of re-encoding images every epoch.
+
+Layout of cache_dir:
+    manifest.json   dataset, tokenizer and array description
+    tokens.npy      (N, L) indices in the smallest dtype holding the codebook
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.abspath("."))
+import json
+import numpy as np
+import torch
+import multiprocessing as mp
+from torch.utils.data import Dataset
+from utils.get_model_arch import get_model_arch
+from utils.get_dataset import get_dataset
+from utils.index_packing import index_dtype
+
+MANIFEST_FILE = "manifest.json"
+TOKENS_FILE = "tokens.npy"
+
+# Set in every worker by _init_worker
+_worker = {}
+
+
+def _init_worker(config: dict, tokens_path: str):
+    # One thread per process, the pool already uses every core
+    torch.set_num_threads(1)
+    model = get_model_arch(config["model_arch"])(**config)
+    if "model_checkpoint_path" in config and config["model_checkpoint_path"]:
+        model.load_state_dict(torch.load(f=config["model_checkpoint_path"], map_location="cpu"))
+    model.eval()
+
+    _worker["model"] = model
+    _worker["dataset"] = get_dataset(
+        config["dataset"],
+        config["input_res"],
+        config["dataset_mean"],
+        config["dataset_std"],
+    )
+    _worker["tokens"] = np.load(tokens_path, mmap_mode="r+")
+
+
+def _tokenize_range(bounds: tuple):
+    start, end, batch_size = bounds
+    model, dataset, tokens = _worker["model"], _worker["dataset"], _worker["tokens"]
+    for batch_start in range(start, end, batch_size):
+        batch_end = min(batch_start + batch_size, end)
+        x = torch.stack([dataset[idx][0] for idx in range(batch_start, batch_end)])
+        indices = model.encode_to_indices(x)
+        tokens[batch_start:batch_end] = indices.reshape(batch_end - batch_start, -1).numpy()
+    tokens.flush()
+    return end - start
+
+
+def build_token_cache(
+    cache_dir: str, config: dict, num_workers: int = None, batch_size=64, chunk_size=1024
+):
+    """
+    Tokenizes config["dataset"] with config["model_arch"] (loaded from config["model_checkpoint_path"]) into cache_dir.
+    num_workers CPU processes, defaulting to every core, each encode chunks of chunk_size images straight into the
+    shared memory mapped array.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Loaded once here so that the download does not race between the workers
+    dataset = get_dataset(
+        config["dataset"],
+        config["input_res"],
+        config["dataset_mean"],
+        config["dataset_std"],
+    )
+    model = get_model_arch(config["model_arch"])(**config)
+    model.eval()
+    codebook_size = model.quantizer.codebook_size
+    num_tokens = model.encode_to_indices(dataset[0][0][None]).shape[1]
+    dtype = torch.empty(0, dtype=index_dtype(codebook_size)).numpy().dtype
+    del model
+
+    tokens_path = os.path.join(cache_dir, TOKENS_FILE)
+    tokens = np.lib.format.open_memmap(
+        tokens_path, mode="w+", dtype=dtype, shape=(len(dataset), num_tokens)
+    )
+    del tokens
+
+    bounds = [
+        (start, min(start + chunk_size, len(dataset)), batch_size)
+        for start in range(0, len(dataset), chunk_size)
+    ]
+    num_workers = num_workers or os.cpu_count()
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(num_workers, initializer=_init_worker, initargs=(config, tokens_path)) as pool:
+        for _ in pool.imap_unordered(_tokenize_range, bounds):
+            pass
+
+    manifest = {
+        "dataset": config["dataset"],
+        "input_res": config["input_res"],
+        "model_arch": config["model_arch"],
+        "model_checkpoint_path": config.get("model_checkpoint_path"),
+        "codebook_size": codebook_size,
+        "num_images": len(dataset),
+        "num_tokens": num_tokens,
+        "dtype": str(dtype),
+    }
+    # Written last, a cache without a manifest is incomplete
+    with open(os.path.join(cache_dir, MANIFEST_FILE), "w") as file:
+        json.dump(manifest, file, indent=4)
+    return manifest
+
+
+def load_manifest(cache_dir: str):
+    manifest_path = os.path.join(cache_dir, MANIFEST_FILE)
+    assert os.path.exists(manifest_path), f"No token cache in {cache_dir}, build it with build_token_cache"
+    return json.load(open(manifest_path))
+
+
+class TokenCacheDataset(Dataset):
+    """
+    (L) token sequences of a build_token_cache directory. Items are views into the memory mapped array (copy on
+    write, the file is never modified), the copy happens once when the DataLoader collates the batch.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.manifest = load_manifest(cache_dir)
+        self.tokens = np.load(os.path.join(cache_dir, TOKENS_FILE), mmap_mode="c")
+        assert self.tokens.shape == (
+            self.manifest["num_images"],
+            self.manifest["num_tokens"],
+        ), "Token cache does not match its manifest"
+
+    def __len__(self):
+        return self.tokens.shape[0]
+
+    def __getitem__(self, idx: int):
+        return torch.from_numpy(self.tokens[idx])